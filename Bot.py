@@ -5,13 +5,53 @@ import json
 import os
 import pytz
 import asyncio
+import io
+import signal
+import tempfile
+from time import perf_counter
+from persistence import WriteBehindStore
+from sqlite_storage import SqliteStorage
+from eventlog import EventLog
+from presence import PresenceGate, PresenceMatcher, activity_fingerprint
+from members import MemberRegistry
+from aggregates import PlaytimeAggregates, week_key
+from scheduler import Scheduler, DailyAt
+from outbound import OutboundDispatcher
+from reports import ATTACHMENT_SPOOL_SIZE, report_lines, send_report
+from visits import VisitIndex
+from zones import load_zones
+from intervals import DutyIntervals
+import analytics
+import export
+from querycache import Generations, QueryCache
+from actor import StateActor
+from records import LEGACY_ZONE_KEY, ActivityState, DutySession, ZoneVisit, to_epoch, to_iso
+from metrics import metrics, LoopLagMonitor, MetricsServer
 
 intents = discord.Intents.default()
 intents.presences = True
 intents.members = True
 intents.message_content = True
 intents.guilds = True
-bot = commands.Bot(command_prefix="!", intents=intents)
+
+# Chia shard: BOT_SHARD_COUNT là tổng số shard, BOT_SHARD_IDS (ví dụ "0,1") là các shard tiến trình này chạy.
+# Nhiều tiến trình trên một máy dùng chung bot.db (BOT_STORAGE=sqlite), mỗi tiến trình giữ trạng thái của các guild thuộc shard của nó:
+#   BOT_STORAGE=sqlite BOT_SHARD_COUNT=2 BOT_SHARD_IDS=0 python Bot.py
+#   BOT_STORAGE=sqlite BOT_SHARD_COUNT=2 BOT_SHARD_IDS=1 python Bot.py
+SHARD_COUNT = int(os.environ.get("BOT_SHARD_COUNT", "0")) or None
+SHARD_IDS = [int(shard_id) for shard_id in os.environ["BOT_SHARD_IDS"].split(",")] if os.environ.get("BOT_SHARD_IDS") else None
+MULTI_PROCESS = bool(SHARD_COUNT and SHARD_IDS is not None and len(SHARD_IDS) < SHARD_COUNT)
+# Báo cáo chung (ngày/tuần) chỉ do tiến trình chạy shard 0 gửi
+IS_PRIMARY_PROCESS = not MULTI_PROCESS or 0 in SHARD_IDS
+PROCESS_TAG = f".shard{'-'.join(map(str, SHARD_IDS))}" if MULTI_PROCESS else ""
+if SHARD_COUNT:
+    bot = commands.AutoShardedBot(command_prefix="!", intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
+else:
+    bot = commands.Bot(command_prefix="!", intents=intents)
+
+def owns_guild(guild_id):
+    """True if the guild is served by this process (always, unless shards are split across processes)."""
+    return not MULTI_PROCESS or (int(guild_id) >> 22) % SHARD_COUNT in SHARD_IDS
 
 bot.remove_command("help")
 
@@ -34,12 +74,114 @@ AUTHORIZED_VEHICLES = [
     "2018 Dodge Charger LEO Edition"
 ]
 
+# Các khu vực theo dõi, đọc từ ZONES_FILE: danh sách {"key", "name", "channel_id", "require_vehicle",
+# "authorized_vehicles", "retention_days", "notify_cooldown"}; trường nào thiếu lấy theo ZONE_DEFAULTS.
+# Không có file thì chỉ theo dõi Vinewood Park Dr như trước.
+ZONES_FILE = "zones.json"
+ZONE_DEFAULTS = {
+    "require_vehicle": True,
+    "authorized_vehicles": AUTHORIZED_VEHICLES,
+    "retention_days": 30,
+    "notify_cooldown": 300,
+}
+DEFAULT_ZONE = {"key": LEGACY_ZONE_KEY, "name": "Vinewood Park Dr", "channel_id": VINEWOOD_CHANNEL_ID}
+zone_index = load_zones(ZONES_FILE, ZONE_DEFAULTS, DEFAULT_ZONE)
+
+# Nhận diện Rich Presence
+GAME_KEYWORDS = ["gta5vn.net", "gta5vn", "gta v", "gta 5", "fivem"]
+PRESENCE_CACHE_SIZE = 4096
+# Cập nhật presence của cùng một người trong PRESENCE_DEBOUNCE_WINDOW giây được gộp lại (chỉ xử lý bản mới nhất);
+# offline, online lại và vào/rời khu vực luôn được xử lý ngay
+PRESENCE_DEBOUNCE_WINDOW = 2.0
+presence_matcher = PresenceMatcher(GAME_KEYWORDS, zone_index, cache_size=PRESENCE_CACHE_SIZE)
+
 # File paths
 ACTIVITY_FILE = "activity.json"
 USER_MAPPING_FILE = "user_mapping.json"
 PLAYTIME_FILE = "playtime.json"
 ONLINE_TIMES_FILE = "online_times.json"
-VINEWOOD_ACTIVITY_FILE = "vinewood_activity.json"
+# Lượt vào mọi khu vực (tên file giữ nguyên từ khi chỉ có Vinewood)
+ZONE_VISITS_FILE = "vinewood_activity.json"
+# Các khoảng on-duty thực tế (bắt đầu, kết thúc) đã được cộng vào playtime; tổng theo ngày vẫn lấy từ playtime.json
+# (gồm cả phần sửa bằng !time, vốn không có khoảng tương ứng)
+DUTY_INTERVALS_FILE = "duty_intervals.json"
+
+# Ngày có lượt vào khu vực cũ hơn retention_days của khu vực đó (lấy số lớn nhất nếu ngày có nhiều khu vực)
+# được nén vào ZONE_ARCHIVE_DIR (mỗi ngày một file), vẫn xem lại được bằng !zone khu_vực ngày/tháng
+ZONE_ARCHIVE_DIR = "vinewood_archive"
+
+# Ghi file JSON trễ tối đa SAVE_DELAY giây, hoặc ngay khi có SAVE_MAX_PENDING thay đổi chưa ghi
+SAVE_DELAY = 2.0
+SAVE_MAX_PENDING = 100
+store = WriteBehindStore(delay=SAVE_DELAY, max_pending=SAVE_MAX_PENDING)
+
+# Backend lưu trữ: "json" (mặc định) hoặc "sqlite", chọn bằng biến môi trường BOT_STORAGE.
+# Dữ liệu JSON cũ được chuyển sang SQLite bằng: python migrate_to_sqlite.py
+STORAGE_BACKEND = os.environ.get("BOT_STORAGE", "json")
+SQLITE_FILE = "bot.db"
+sqlite_storage = SqliteStorage(SQLITE_FILE) if STORAGE_BACKEND == "sqlite" else None
+if MULTI_PROCESS and not sqlite_storage:
+    raise SystemExit("Chạy nhiều tiến trình shard cần BOT_STORAGE=sqlite để dùng chung dữ liệu.")
+
+# Nhật ký sự kiện on/off-duty, vào/rời khu vực và !time: ghi nối tiếp, fsync theo lô mỗi EVENT_LOG_FSYNC_DELAY giây.
+# Khi khởi động, trạng thái được dựng lại từ snapshot gần nhất + phần log phía sau.
+EVENT_LOG_ENABLED = True
+EVENT_LOG_FILE = f"events{PROCESS_TAG}.log"
+SNAPSHOT_FILE = f"state_snapshot{PROCESS_TAG}.json"
+EVENT_LOG_FSYNC_DELAY = 0.5
+SNAPSHOT_EVERY = 1000
+event_log = EventLog(EVENT_LOG_FILE, SNAPSHOT_FILE, WriteBehindStore(delay=EVENT_LOG_FSYNC_DELAY, max_pending=SNAPSHOT_EVERY),
+                     snapshot_every=SNAPSHOT_EVERY) if EVENT_LOG_ENABLED else None
+
+# Tác vụ hẹn giờ (giờ Việt Nam). Lần chạy cuối được lưu lại để chạy bù sau khi bot tắt, không bao giờ chạy lặp.
+SCHEDULER_STATE_FILE = f"scheduler_state{PROCESS_TAG}.json"
+DAILY_REPORT_AT = (23, 59)
+# Khi chạy nhiều tiến trình, mỗi tiến trình cộng dồn các phiên đang mở vào bot.db trước giờ báo cáo
+REPORT_SPLIT_AT = (23, 58)
+WEEKLY_REPORT_AT = (0, 5)
+ZONE_ARCHIVE_AT = (0, 10)
+scheduler = Scheduler(SCHEDULER_STATE_FILE)
+
+# Thông báo gửi vào các kênh được xếp hàng theo kênh: gộp các tin trong NOTIFY_BATCH_WINDOW giây,
+# cắt theo giới hạn 2000 ký tự và giới hạn tốc độ mỗi kênh NOTIFY_CHANNEL_RATE tin / NOTIFY_CHANNEL_PER giây
+NOTIFY_BATCH_WINDOW = 1.0
+NOTIFY_CHANNEL_RATE = 5
+NOTIFY_CHANNEL_PER = 5.0
+outbound = OutboundDispatcher(bot.get_channel, batch_window=NOTIFY_BATCH_WINDOW,
+                              channel_rate=NOTIFY_CHANNEL_RATE, channel_per=NOTIFY_CHANNEL_PER)
+
+# Báo cáo của lệnh admin dài hơn REPORT_MAX_PAGES tin nhắn được gửi kèm file đầy đủ
+REPORT_MAX_PAGES = 5
+# File của !export lớn hơn mức này không gửi được qua Discord, khi đó dùng: python export.py
+EXPORT_MAX_BYTES = 10 * 1024 * 1024
+
+# Mọi thay đổi trạng thái của một người (on/off-duty, offline, vào/rời khu vực, !time) chạy lần lượt trong
+# state_actor, theo shard user_id % STATE_ACTOR_SHARDS; người thuộc các shard khác nhau vẫn được xử lý song song
+STATE_ACTOR_SHARDS = 16
+state_actor = StateActor(shards=STATE_ACTOR_SHARDS)
+
+# Số kết quả lệnh admin (!checkduty, !checkoff, !checkreg, !zone, !playtime) được giữ lại giữa hai lần thay đổi trạng thái
+QUERY_CACHE_SIZE = 256
+
+# Số liệu vận hành (độ trễ handler/lệnh, event loop, ghi file, gửi Discord, kích thước trạng thái):
+# xem bằng !checkstatus, hoặc Prometheus đọc http://127.0.0.1:BOT_METRICS_PORT/metrics (0 để tắt).
+# Chạy nhiều tiến trình shard thì đặt BOT_METRICS_PORT khác nhau cho từng tiến trình.
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = int(os.environ.get("BOT_METRICS_PORT", "9108"))
+LOOP_LAG_INTERVAL = 0.5
+loop_lag_monitor = LoopLagMonitor(metrics, interval=LOOP_LAG_INTERVAL)
+metrics_server = MetricsServer(metrics, host=METRICS_HOST, port=METRICS_PORT) if METRICS_PORT else None
+metrics.describe("handler_seconds", "Thời gian xử lý mỗi sự kiện gateway và vòng đối soát.")
+metrics.describe("command_seconds", "Thời gian xử lý mỗi lệnh.")
+metrics.describe("event_loop_lag_seconds", "Độ trễ đánh thức của event loop.")
+metrics.describe("save_seconds", "Thời gian ghi mỗi file (JSON, event log).")
+metrics.describe("save_bytes_total", "Tổng số byte đã ghi theo file.")
+metrics.describe("discord_send_seconds", "Thời gian gửi mỗi tin nhắn thông báo.")
+metrics.describe("discord_rate_limited_total", "Số lần Discord trả về 429.")
+metrics.describe("state_size", "Số phần tử của trạng thái trong bộ nhớ.")
+metrics.describe("actor_wait_seconds", "Thời gian một thay đổi trạng thái chờ trong hàng đợi của state_actor.")
+metrics.describe("query_cache_total", "Số lần tra query_cache của lệnh admin: hit, miss.")
+metrics.describe("presence_updates_total", "Số cập nhật presence theo kết quả: duplicate, coalesced, delivered.")
 
 def load_json_file(file_path, default_value):
     """Safely load a JSON file, return default_value if it fails."""
@@ -53,362 +195,897 @@ def load_json_file(file_path, default_value):
     return default_value
 
 async def save_json_file(file_path, data):
-    """Safely save data to a JSON file."""
-    try:
-        with open(file_path, "w") as f:
-            json.dump(data, f, indent=4)
-    except Exception as e:
-        print(f"Error saving {file_path}: {e}")
+    """Queue data to be written to a JSON file by the write-behind store."""
+    store.mark_dirty(file_path, data)
+
+def queue_sqlite_flush():
+    store.mark_dirty(SQLITE_FILE, sqlite_storage.take_ops, writer=sqlite_storage.write_ops)
+
+def from_epoch(epoch):
+    return datetime.fromtimestamp(epoch, VN_TIMEZONE)
+
+def owns_user(user_id):
+    """True if this process keeps the user's duty state (the user's guild is on one of its shards)."""
+    return not MULTI_PROCESS or user_id in user_mapping
 
 def load_activity_data():
-    return load_json_file(ACTIVITY_FILE, {})
+    data = sqlite_storage.load_activity() if sqlite_storage else load_json_file(ACTIVITY_FILE, {})
+    return {user_id: ActivityState.from_json(state) for user_id, state in data.items() if owns_user(user_id)}
+
+def activity_to_json(data):
+    return {user_id: state.to_json(VN_TIMEZONE) for user_id, state in data.items()}
 
 async def save_activity_data(data):
-    await save_json_file(ACTIVITY_FILE, data)
+    # Backend SQLite chỉ ghi dòng của những người có trong activity_changes
+    if sqlite_storage:
+        sqlite_storage.queue_activity({user_id: data[user_id].to_json(VN_TIMEZONE) for user_id in activity_changes if user_id in data})
+        activity_changes.clear()
+        queue_sqlite_flush()
+        return
+    activity_changes.clear()
+    store.mark_dirty(ACTIVITY_FILE, lambda: activity_to_json(data))
 
 def load_user_mapping():
+    if sqlite_storage:
+        return sqlite_storage.load_user_mapping(owns_guild)
     data = load_json_file(USER_MAPPING_FILE, {})
     filtered_data = {user_id: user_info for user_id, user_info in data.items()
                      if isinstance(user_info, dict) and "guild_id" in user_info}
     if data != filtered_data:
-        asyncio.create_task(save_json_file(USER_MAPPING_FILE, filtered_data))
+        store.mark_dirty(USER_MAPPING_FILE, filtered_data)
     return filtered_data
 
 async def save_user_mapping(data):
+    changed = list(member_changes)
+    member_changes.clear()
+    if sqlite_storage:
+        # Tên hiển thị được lưu kèm để báo cáo của tiến trình khác đọc được
+        display_names = {}
+        for user_id in changed:
+            entry = member_registry.get(user_id)
+            if entry:
+                display_names[user_id] = entry.display_name
+        sqlite_storage.queue_user_mapping(data, display_names, changed)
+        queue_sqlite_flush()
+        return
     await save_json_file(USER_MAPPING_FILE, data)
 
+async def report_members():
+    """[(user_id, display_name)] of every registered player; read from bot.db when shards run in several processes."""
+    if MULTI_PROCESS:
+        await store.flush()
+        return list((await asyncio.to_thread(sqlite_storage.member_names)).items())
+    return [(entry.key, entry.display_name) for entry in member_registry]
+
+def register_user(member, guild_id=None):
+    """Map a member to guild_id (default: their guild) if not mapped yet and keep the member registry in sync. Returns True if user_mapping changed."""
+    user_id = str(member.id)
+    changed = user_id not in user_mapping
+    if changed:
+        user_mapping[user_id] = {"guild_id": guild_id or str(member.guild.id)}
+        member_changes.add(user_id)
+    if user_mapping[user_id]["guild_id"] == str(member.guild.id):
+        member_registry.add(member)
+    return changed
+
+def owned_elsewhere_message(display_name):
+    return f"Dữ liệu on-duty của {display_name} do tiến trình bot của server khác quản lý, hãy dùng lệnh trong server đó."
+
+def load_foreign_users():
+    """User ids stored in bot.db with a guild served by another shard process."""
+    return {user_id for user_id, guild_id in sqlite_storage.member_guilds().items() if not owns_guild(guild_id)}
+
+async def register_members(members):
+    """register_user for each member. Returns True if user_mapping changed.
+
+    When shards run in several processes a user belongs to the process
+    serving the guild first stored for them in bot.db: new users are
+    claimed there before being mapped, and members owned by another
+    process are skipped, so only one process ever writes a user's rows.
+    """
+    owners = {}
+    if MULTI_PROCESS:
+        claims = {}
+        for member in members:
+            user_id = str(member.id)
+            if user_id not in user_mapping and user_id not in foreign_users:
+                claims.setdefault(user_id, (int(user_id), str(member.guild.id), member.display_name))
+        if claims:
+            owners = await asyncio.to_thread(sqlite_storage.claim_members, list(claims.values()))
+            foreign_users.update(user_id for user_id, guild_id in owners.items() if not owns_guild(guild_id))
+    changed = False
+    for member in members:
+        if str(member.id) not in foreign_users:
+            changed = register_user(member, owners.get(str(member.id))) or changed
+    return changed
+
+async def unregister_users(user_ids, current_time=None, display_names=None):
+    """Remove users from user_mapping and the registry, first ending their open session and zone visit at current_time (default: now)."""
+    current_time = current_time or datetime.now(VN_TIMEZONE)
+    for user_id in user_ids:
+        entry = member_registry.get(user_id)
+        display_name = entry.display_name if entry else (display_names or {}).get(user_id, user_id)
+        # Phiên còn mở của người đã rời đi sẽ không bao giờ được đóng (và mỗi lần chia phiên lúc nửa đêm lại được cộng thêm)
+        await state_actor.run(user_id, end_duty, user_id, current_time, display_name, display_name, "rời server")
+        user_mapping.pop(user_id, None)
+        member_registry.remove(user_id)
+        member_changes.add(user_id)
+    if user_ids:
+        await save_user_mapping(user_mapping)
+
 def load_playtime_data():
-    return load_json_file(PLAYTIME_FILE, {})
+    data = sqlite_storage.load_playtime() if sqlite_storage else load_json_file(PLAYTIME_FILE, {})
+    # Tổng của người thuộc tiến trình khác có thể đã cũ: chỉ giữ người mà tiến trình này ghi
+    return {user_id: user_data for user_id, user_data in data.items() if owns_user(user_id)}
+
+def get_daily_online(user_id, date_str):
+    return playtime_data.get(user_id, {}).get("daily_online", {}).get(date_str, 0)
+
+def set_daily_online(user_id, date_str, minutes):
+    """Set a user's on-duty minutes for one day and record the old value in the change journal."""
+    user_data = playtime_data.setdefault(user_id, {"daily_online": {}})
+    daily_online = user_data.setdefault("daily_online", {})
+    playtime_changes.setdefault((user_id, date_str), daily_online.get(date_str, 0))
+    daily_online[date_str] = minutes
+    state_generations.bump("playtime")
+    aggregate = playtime_aggregates.set(user_id, date_str, minutes)
+    week = week_key(date_str)
+    user_data.setdefault("weekly_online", {})[week] = aggregate.weekly[week]
+
+def add_online_time(user_id, start_time, end_time):
+    """Record an on-duty period as a raw interval and add its per-day minutes to playtime_data."""
+    if end_time <= start_time:
+        return
+    for date_str, seconds in duty_intervals.add(user_id, int(start_time.timestamp()), int(end_time.timestamp())):
+        set_daily_online(user_id, date_str, get_daily_online(user_id, date_str) + seconds / 60)
+
+def open_session_days(user_id, now):
+    """{date_str: minutes} of the part of the user's open session not yet in playtime_data, for live totals."""
+    session = duty_sessions.get(user_id)
+    if not session:
+        return {}
+    return {date_str: seconds / 60 for date_str, seconds in duty_intervals.split_by_day(credited_from(user_id, session.start), int(now.timestamp()))}
+
+def load_duty_intervals():
+    data = sqlite_storage.load_duty_intervals() if sqlite_storage else load_json_file(DUTY_INTERVALS_FILE, {})
+    return DutyIntervals.from_json({user_id: pairs for user_id, pairs in data.items() if owns_user(user_id)}, VN_TIMEZONE)
+
+def save_duty_intervals(intervals):
+    added = intervals.take_dirty()
+    if sqlite_storage:
+        sqlite_storage.queue_duty_intervals((user_id, to_iso(start, VN_TIMEZONE), to_iso(end, VN_TIMEZONE)) for user_id, start, end in added)
+        return
+    if added:
+        store.mark_dirty(DUTY_INTERVALS_FILE, intervals.to_json)
 
 async def save_playtime_data(data, notify_changes=False):
-    old_data = load_playtime_data()
-    await save_json_file(PLAYTIME_FILE, data)
-    if notify_changes and old_data != data:
-        channel = bot.get_channel(PLAYTIME_UPDATE_CHANNEL_ID)
-        if channel:
-            changes = []
-            for user_id, user_data in data.items():
-                guild_id = user_mapping.get(user_id, {}).get("guild_id")
-                if not guild_id:
-                    continue
-                guild = bot.get_guild(int(guild_id))
-                if not guild:
-                    continue
-                member = guild.get_member(int(user_id))
-                if not member:
-                    continue
-                display_name = member.display_name
-                old_user_data = old_data.get(user_id, {})
-                for date_str, minutes in user_data.get("daily_online", {}).items():
-                    old_minutes = old_user_data.get("daily_online", {}).get(date_str, 0)
-                    if minutes != old_minutes:
-                        hours_new = int(minutes // 60)
-                        mins_new = int(minutes % 60)
-                        hours_old = int(old_minutes // 60)
-                        mins_old = int(old_minutes % 60)
-                        changes.append(f"- {display_name} ({date_str}): {hours_new}h {mins_new}m (trước: {hours_old}h {mins_old}m)")
-            if changes:
-                await channel.send(f"📝 **Cập nhật playtime.json**:\n" + "\n".join(changes))
+    # Lấy các thay đổi đã ghi nhận từ lần lưu trước, không cần đọc lại file
+    changes_journal = dict(playtime_changes)
+    playtime_changes.clear()
+    save_duty_intervals(duty_intervals)
+    if sqlite_storage:
+        for user_id, date_str in changes_journal:
+            sqlite_storage.queue_daily_online(user_id, date_str, data.get(user_id, {}).get("daily_online", {}).get(date_str, 0))
+        queue_sqlite_flush()
+    else:
+        await save_json_file(PLAYTIME_FILE, data)
+    if notify_changes and changes_journal:
+        changes = []
+        for (user_id, date_str), old_minutes in changes_journal.items():
+            minutes = data.get(user_id, {}).get("daily_online", {}).get(date_str, 0)
+            if minutes == old_minutes:
+                continue
+            entry = member_registry.get(user_id)
+            if not entry:
+                continue
+            display_name = entry.display_name
+            hours_new = int(minutes // 60)
+            mins_new = int(minutes % 60)
+            hours_old = int(old_minutes // 60)
+            mins_old = int(old_minutes % 60)
+            changes.append(f"- {display_name} ({date_str}): {hours_new}h {mins_new}m (trước: {hours_old}h {mins_old}m)")
+        if changes:
+            outbound.send(PLAYTIME_UPDATE_CHANNEL_ID, f"📝 **Cập nhật playtime.json**:\n" + "\n".join(changes))
 
 def load_online_times():
-    data = load_json_file(ONLINE_TIMES_FILE, {})
-    return {user_id: datetime.fromisoformat(time_str).astimezone(VN_TIMEZONE)
-            for user_id, time_str in data.items()}
-
-async def save_online_times(data):
-    await save_json_file(ONLINE_TIMES_FILE, {user_id: time.isoformat() for user_id, time in data.items()})
+    data = sqlite_storage.load_online_times() if sqlite_storage else load_json_file(ONLINE_TIMES_FILE, {})
+    sessions = {user_id: DutySession(int(user_id), to_epoch(time_str)) for user_id, time_str in data.items() if owns_user(user_id)}
+    if sqlite_storage:
+        sqlite_storage.remember_online_times(online_times_to_json(sessions))
+    return sessions
 
-def load_vinewood_activity_data():
-    return load_json_file(VINEWOOD_ACTIVITY_FILE, {})
+def online_times_to_json(sessions):
+    return {user_id: to_iso(session.start, VN_TIMEZONE) for user_id, session in sessions.items()}
 
-async def save_vinewood_activity_data(data):
-    await save_json_file(VINEWOOD_ACTIVITY_FILE, data)
+async def save_online_times(data):
+    changed = list(session_changes)
+    session_changes.clear()
+    if sqlite_storage:
+        online_times = {user_id: to_iso(data[user_id].start, VN_TIMEZONE) for user_id in changed if user_id in data}
+        sqlite_storage.queue_online_times(online_times, datetime.now(VN_TIMEZONE), changed)
+        queue_sqlite_flush()
+        return
+    store.mark_dirty(ONLINE_TIMES_FILE, lambda: online_times_to_json(data))
+
+def load_zone_visits():
+    if sqlite_storage:
+        # Lịch sử nằm trong SQLite, chỉ các lượt chưa kết thúc được giữ trong bộ nhớ
+        open_visits = {user_id: user_data for user_id, user_data in sqlite_storage.load_open_vinewood_visits().items() if owns_user(user_id)}
+        return VisitIndex.from_json(open_visits, VN_TIMEZONE)
+    return VisitIndex.from_json(load_json_file(ZONE_VISITS_FILE, {}), VN_TIMEZONE, ZONE_ARCHIVE_DIR)
+
+async def save_zone_visits(index):
+    changed_visits = index.take_dirty()
+    if sqlite_storage:
+        sqlite_storage.queue_vinewood_visits((visit.user_id, visit.to_json(VN_TIMEZONE)) for visit in changed_visits)
+        queue_sqlite_flush()
+        return
+    store.mark_dirty(ZONE_VISITS_FILE, index.to_json)
+
+async def daily_online_on(date_str):
+    """Return {user_id: minutes} for one day."""
+    if sqlite_storage:
+        await store.flush()
+        rows = await asyncio.to_thread(sqlite_storage.daily_online_on, date_str)
+        return {str(user_id): minutes for user_id, minutes in rows}
+    return {user_id: user_data["daily_online"][date_str] for user_id, user_data in playtime_data.items()
+            if date_str in user_data.get("daily_online", {})}
+
+async def daily_online_between(start_date, end_date, user_id=None):
+    """Return {user_id: [(date_str, minutes), ...]} for days in [start_date, end_date], oldest first."""
+    start_date_str, end_date_str = start_date.isoformat(), end_date.isoformat()
+    result = {}
+    if sqlite_storage:
+        await store.flush()
+        rows = await asyncio.to_thread(sqlite_storage.daily_online_between, start_date_str, end_date_str, user_id)
+        for row_user_id, date_str, minutes in rows:
+            result.setdefault(str(row_user_id), []).append((date_str, minutes))
+        return result
+    return playtime_aggregates.days_between(start_date_str, end_date_str, user_id)
+
+async def stored_playtime(user_id):
+    """Total on-duty minutes saved for the user, or None if they have no data; read from bot.db for a user owned by another process."""
+    if MULTI_PROCESS and not owns_user(user_id):
+        await store.flush()
+        return await asyncio.to_thread(sqlite_storage.playtime_total, user_id)
+    return query_cache.get(("playtime", user_id), ("playtime",), lambda: playtime_aggregates.total(user_id)
+                           if "daily_online" in playtime_data.get(user_id, {}) else None)
+
+def load_hour_intervals(hour_start, now):
+    """DutyIntervals of every process's users for the hour starting at epoch hour_start, open sessions counted up to now (blocking; reads bot.db)."""
+    hour_start -= hour_start % 3600
+    intervals = DutyIntervals(VN_TIMEZONE)
+    # Phiên đang mở được thêm trước: các phần đã cộng của nó nằm trong phiên nên không bị tính hai lần
+    for user_id, start_time in sqlite_storage.load_online_times().items():
+        intervals.add(user_id, to_epoch(start_time), now)
+    for user_id, start_time, end_time in sqlite_storage.duty_intervals_between(to_iso(hour_start, VN_TIMEZONE), to_iso(hour_start + 3600, VN_TIMEZONE)):
+        intervals.add(str(user_id), to_epoch(start_time), to_epoch(end_time))
+    return intervals
+
+async def zone_visits_on(day, zone=None):
+    """Return {user_id: [visit, ...]} for zone visits started on the given date, only those in `zone` if given."""
+    result = {}
+    if sqlite_storage:
+        await store.flush()
+        rows = await asyncio.to_thread(sqlite_storage.zone_visits_between, day.isoformat(), (day + timedelta(days=1)).isoformat())
+        for user_id, visit in rows:
+            result.setdefault(str(user_id), []).append(ZoneVisit.from_json(user_id, visit))
+    else:
+        day_str = day.isoformat()
+        if day_str not in zone_visits.days and zone_visits.is_archived(day_str):
+            result = await asyncio.to_thread(zone_visits.read_archive, day_str)
+        else:
+            result = zone_visits.visits_on(day_str)
+    if zone is None:
+        return result
+    filtered = {}
+    for user_id, visits in result.items():
+        in_zone = [visit for visit in visits if visit.zone == zone]
+        if in_zone:
+            filtered[user_id] = in_zone
+    return filtered
 
 def has_admin_role(member):
     return str(member.id) in ADMIN_USER_IDS
 
-online_start_times = load_online_times()
-activity_data = load_activity_data()
+def credited_from(user_id, start):
+    """Epoch start of the part of an on-duty session not yet added to playtime (after a restore or midnight split)."""
+    state = activity_data.get(user_id)
+    if state is None or state.duty_credited_until is None:
+        return start
+    return max(start, state.duty_credited_until)
+
+def clear_credited(user_id):
+    state = activity_data.get(user_id)
+    if state:
+        state.duty_credited_until = None
+        activity_changes.add(user_id)
+
+def apply_event(event):
+    """Apply one duty event to the in-memory state. Used both for live events and for log replay."""
+    event_type = event["type"]
+    user_id = event["user_id"]
+    if event_type == "on_duty":
+        duty_sessions[user_id] = DutySession(int(user_id), to_epoch(event["time"]))
+        session_changes.add(user_id)
+        state_generations.bump("sessions")
+        clear_credited(user_id)
+    elif event_type == "off_duty":
+        duty_sessions.pop(user_id, None)
+        session_changes.add(user_id)
+        state_generations.bump("sessions")
+        start = credited_from(user_id, to_epoch(event["start"]))
+        clear_credited(user_id)
+        add_online_time(user_id, from_epoch(start), from_epoch(to_epoch(event["time"])))
+    elif event_type in ("restore", "split"):
+        # Cộng phần phiên on-duty tính đến event["time"] (khôi phục sau khi bot reset, hoặc chia phiên lúc nửa đêm);
+        # phiên vẫn tiếp tục và off_duty chỉ cộng phần còn lại
+        if user_id not in duty_sessions:
+            return
+        end = to_epoch(event["time"])
+        start = credited_from(user_id, duty_sessions[user_id].start)
+        # Một lần chia phiên bù (scheduler chạy trước khi khôi phục phiên) có thể mang thời điểm đã được cộng rồi
+        if end <= start:
+            return
+        add_online_time(user_id, from_epoch(start), from_epoch(end))
+        activity_data.setdefault(user_id, ActivityState()).duty_credited_until = end
+        activity_changes.add(user_id)
+    elif event_type == "time_adjust":
+        set_daily_online(user_id, event["date"], event["minutes"])
+    elif event_type in ("zone_enter", "vinewood_enter"):
+        # vinewood_enter/vinewood_leave là sự kiện của các log cũ, trước khi có nhiều khu vực
+        time = to_epoch(event["time"])
+        zone = event.get("zone", LEGACY_ZONE_KEY)
+        state = activity_data.setdefault(user_id, ActivityState())
+        state.zone = zone
+        activity_changes.add(user_id)
+        state_generations.bump("zones")
+        users_in_zone.add(user_id)
+        state.zone_start = time
+        state.last_notified = time
+        zone_visits.add(ZoneVisit(int(user_id), time, None, event["vehicle"], event["unauthorized"], zone))
+    elif event_type in ("zone_leave", "vinewood_leave"):
+        time = to_epoch(event["time"])
+        state = activity_data.setdefault(user_id, ActivityState())
+        state.zone = None
+        activity_changes.add(user_id)
+        state_generations.bump("zones")
+        users_in_zone.discard(user_id)
+        state.zone_start = None
+        state.last_notified = time
+        zone_visits.close(user_id, time)
+
+def record_event(event_type, user_id, **fields):
+    """Append a duty event to the event log and apply it to the in-memory state."""
+    if event_log:
+        event = event_log.append(event_type, user_id=user_id, **fields)
+    else:
+        event = {"type": event_type, "user_id": user_id, **fields}
+    apply_event(event)
+    if event_log and event_log.needs_snapshot():
+        event_log.snapshot(state_snapshot())
+
+def state_snapshot():
+    return {
+        "playtime": playtime_data,
+        "online_times": online_times_to_json(duty_sessions),
+        "activity": activity_to_json(activity_data),
+        "vinewood": zone_visits.to_json(),
+        "intervals": duty_intervals.to_json(),
+    }
+
+def recover_from_event_log():
+    """Rebuild state from the latest snapshot plus the log tail. Returns True if log events were replayed."""
+    global playtime_data, activity_data, zone_visits, duty_intervals
+    snapshot, events = event_log.recover()
+    if snapshot is None:
+        if events:
+            print(f"Không có {SNAPSHOT_FILE}, bỏ qua {len(events)} sự kiện trong {EVENT_LOG_FILE}.")
+        # Snapshot đầu tiên lấy từ dữ liệu vừa tải, log cũ (nếu có) được thu gọn
+        event_log.snapshot(state_snapshot())
+        return False
+    playtime_data = snapshot["playtime"]
+    # Backend SQLite chỉ ghi các ngày có trong nhật ký thay đổi: đưa mọi ngày của snapshot vào để lưu lại toàn bộ
+    playtime_changes.update(((user_id, date_str), minutes) for user_id, user_data in playtime_data.items()
+                            for date_str, minutes in user_data.get("daily_online", {}).items())
+    activity_data = {user_id: ActivityState.from_json(state) for user_id, state in snapshot["activity"].items()}
+    activity_changes.update(activity_data)
+    zone_visits = VisitIndex.from_json(snapshot["vinewood"], VN_TIMEZONE, None if sqlite_storage else ZONE_ARCHIVE_DIR)
+    zone_visits.mark_all_dirty()
+    if "intervals" in snapshot:
+        duty_intervals = DutyIntervals.from_json(snapshot["intervals"], VN_TIMEZONE)
+        duty_intervals.mark_all_dirty()
+    # Phiên đã lưu trước đó cũng được so lại: phiên không còn trong snapshot sẽ được đóng
+    session_changes.update(duty_sessions)
+    duty_sessions.clear()
+    duty_sessions.update({user_id: DutySession(int(user_id), to_epoch(time_str))
+                          for user_id, time_str in snapshot["online_times"].items()})
+    session_changes.update(duty_sessions)
+    for event in events:
+        apply_event(event)
+    print(f"Đã khôi phục trạng thái từ {SNAPSHOT_FILE} và {len(events)} sự kiện trong {EVENT_LOG_FILE}.")
+    return True
+
+# Bộ đếm thay đổi của từng phần trạng thái; kết quả lệnh admin trong query_cache hết hạn khi phần nó đọc thay đổi
+state_generations = Generations("roster", "sessions", "zones", "playtime")
+query_cache = QueryCache(state_generations, max_entries=QUERY_CACHE_SIZE)
 user_mapping = load_user_mapping()
+# Người đã được tiến trình shard khác đăng ký: tiến trình này không ghi dữ liệu của họ
+foreign_users = load_foreign_users() if MULTI_PROCESS else set()
+duty_sessions = load_online_times()
+activity_data = load_activity_data()
+# Người chơi đã đăng ký -> (guild, member, display_name), cập nhật theo sự kiện gateway
+member_registry = MemberRegistry(on_change=lambda: state_generations.bump("roster"))
 playtime_data = load_playtime_data()
-vinewood_activity_data = load_vinewood_activity_data()
+# (user_id, date_str) -> số phút trước khi thay đổi, kể từ lần save_playtime_data gần nhất
+playtime_changes = {}
+# user_id có trạng thái activity / phiên on-duty / thông tin thành viên thay đổi từ lần lưu gần nhất;
+# backend SQLite chỉ ghi các dòng này thay vì so lại toàn bộ
+activity_changes = set()
+session_changes = set()
+member_changes = set()
+zone_visits = load_zone_visits()
+duty_intervals = load_duty_intervals()
+# Tổng on-duty theo ngày/tuần của từng người, cập nhật mỗi lần set_daily_online
+playtime_aggregates = PlaytimeAggregates()
+# Người đang được ghi nhận ở một khu vực, để vòng đối soát không phải duyệt toàn bộ activity_data
+users_in_zone = set()
+# True nếu trạng thái được dựng lại từ event log và cần ghi lại toàn bộ vào backend lưu trữ
+state_needs_resave = recover_from_event_log() if event_log else False
+# Các phiên on-duty còn mở từ lần chạy trước chỉ được khôi phục ở on_ready đầu tiên
+sessions_recovered = False
+# Lúc mất kết nối gateway gần nhất: người offline trong lúc mất kết nối được tính off-duty từ thời điểm này
+gateway_disconnected_at = None
+users_in_zone.update(user_id for user_id, state in activity_data.items() if state.zone)
+playtime_aggregates.load(playtime_data)
+for user_id, aggregate in playtime_aggregates.users.items():
+    playtime_data[user_id]["weekly_online"] = dict(aggregate.weekly)
+
+def state_sizes():
+    return {
+        "users": len(user_mapping),
+        "registered_members": len(member_registry),
+        "duty_sessions": len(duty_sessions),
+        "in_zone": len(users_in_zone),
+        "zone_days": len(zone_visits.days),
+        "zone_visits": sum(len(visits) for users in zone_visits.days.values() for visits in users.values()),
+        "playtime_users": len(playtime_data),
+        "outbound_pending": outbound.pending(),
+        "presence_pending": presence_gate.pending(),
+        "query_cache": len(query_cache),
+        "actor_pending": state_actor.pending(),
+    }
+
+metrics.gauge("state_size", state_sizes, label="kind")
+metrics.gauge("discord_latency_seconds", lambda: bot.latency if bot.latency == bot.latency else 0.0)
+
+@bot.before_invoke
+async def start_command_timer(ctx):
+    ctx.metrics_start = perf_counter()
+
+@bot.after_invoke
+async def record_command_time(ctx):
+    if hasattr(ctx, "metrics_start"):
+        metrics.observe("command_seconds", perf_counter() - ctx.metrics_start, command=ctx.command.qualified_name)
 
 @bot.event
+@metrics.timed("handler_seconds", handler="on_ready")
 async def on_ready():
-    global online_start_times, user_mapping, vinewood_activity_data, playtime_data
-    bot.start_time = datetime.now(VN_TIMEZONE)
-    online_start_times = load_online_times()  # Tải lại từ file
+    global user_mapping, zone_visits, playtime_data, state_needs_resave, sessions_recovered
+    if not hasattr(bot, "start_time"):
+        bot.start_time = datetime.now(VN_TIMEZONE)
     print(f"Bot đã sẵn sàng: {bot.user}")
-    for guild in bot.guilds:
-        guild_id = str(guild.id)
-        for member in guild.members:
-            user_id = str(member.id)
-            if user_id not in user_mapping:
-                user_mapping[user_id] = {"guild_id": guild_id}
-    await save_user_mapping(user_mapping)
-    check_vinewood_activity.start()
-    daily_report.start()
-    current_time = datetime.now(VN_TIMEZONE)
-    for user_id, start_time in list(online_start_times.items()):
-        time_online = (current_time - start_time).total_seconds() / 60
-        if time_online > 0:
-            if user_id not in playtime_data:
-                playtime_data[user_id] = {"daily_online": {}}
-            current_date = start_time
-            while current_date.date() <= current_time.date():
-                date_str = current_date.date().isoformat()
-                playtime_data[user_id]["daily_online"].setdefault(date_str, 0)
-                end_of_period = min(current_time, datetime.combine(current_date.date() + timedelta(days=1), datetime.min.time(), tzinfo=VN_TIMEZONE) - timedelta(seconds=1))
-                start_of_period = max(start_time, datetime.combine(current_date.date(), datetime.min.time(), tzinfo=VN_TIMEZONE))
-                time_in_day = (end_of_period - start_of_period).total_seconds() / 60
-                playtime_data[user_id]["daily_online"][date_str] += time_in_day
-                current_date += timedelta(days=1)
-            await save_playtime_data(playtime_data, notify_changes=True)
-            channel = bot.get_channel(NOTIFICATION_CHANNEL_ID)
-            if channel:
-                hours = int(time_online // 60)
-                mins = int(time_online % 60)
-                await channel.send(f"Bot đã reset, thời gian on-duty của {user_id} từ {start_time.strftime('%H:%M:%S %Y-%m-%d')} được khôi phục: {hours}h {mins}m.")
-
-@tasks.loop(minutes=5)
-async def check_vinewood_activity():
-    global activity_data, vinewood_activity_data
-    current_time = datetime.now(VN_TIMEZONE)
-    channel = bot.get_channel(VINEWOOD_CHANNEL_ID)
-    if not channel:
-        print(f"Không tìm thấy kênh Vinewood với ID {VINEWOOD_CHANNEL_ID}")
+    if state_needs_resave:
+        state_needs_resave = False
+        await save_playtime_data(playtime_data)
+        await save_online_times(duty_sessions)
+        await save_activity_data(activity_data)
+        await save_zone_visits(zone_visits)
+    await resync_gateway_state()
+    # on_ready được gọi lại sau mỗi lần kết nối lại: các tác vụ nền chỉ khởi động một lần
+    if not check_zone_activity.is_running():
+        check_zone_activity.start()
+    scheduler.start()
+    loop_lag_monitor.start()
+    if metrics_server:
+        await metrics_server.start()
+    if not sessions_recovered:
+        sessions_recovered = True
+        await recover_open_sessions(datetime.now(VN_TIMEZONE))
+
+async def recover_open_sessions(current_time):
+    """Credit every on-duty session left open by the last run up to current_time, then save once and post one summary."""
+    restored = []
+    for user_id, session in list(duty_sessions.items()):
+        if session.start >= current_time.timestamp():
+            continue
+        record_event("restore", user_id, start=from_epoch(session.start).isoformat(), time=current_time.isoformat())
+        restored.append((user_id, from_epoch(session.start)))
+    if not restored:
         return
+    await save_playtime_data(playtime_data, notify_changes=True)
+    await save_activity_data(activity_data)
 
-    users_to_remove = []
-    for user_id in list(user_mapping.keys()):
-        if user_id not in user_mapping:
-            continue
-        user_info = user_mapping[user_id]
-        guild_id = user_info.get("guild_id")
-        if not guild_id:
-            users_to_remove.append(user_id)
-            continue
-        guild = bot.get_guild(int(guild_id))
-        if not guild:
-            users_to_remove.append(user_id)
-            continue
-        member = guild.get_member(int(user_id))
-        if not member:
-            continue
+    def summary_lines():
+        yield f"Bot đã reset, thời gian on-duty của {len(restored)} người được khôi phục:"
+        for user_id, start_time in restored:
+            entry = member_registry.get(user_id)
+            name = entry.display_name if entry else user_id
+            time_online = (current_time - start_time).total_seconds() / 60
+            yield f"- {name}: từ {start_time.strftime('%H:%M:%S %Y-%m-%d')}, {int(time_online // 60)}h {int(time_online % 60)}m"
 
-        if user_id not in online_start_times:
-            if activity_data.get(user_id, {}).get("in_vinewood", False):
-                activity_data[user_id]["in_vinewood"] = False
-                activity_data[user_id]["vinewood_start_time"] = None
-                activity_data[user_id]["last_notified"] = current_time.isoformat()
-                await save_activity_data(activity_data)
-                if user_id in vinewood_activity_data and vinewood_activity_data[user_id]["visits"] and not vinewood_activity_data[user_id]["visits"][-1].get("end_time"):
-                    vinewood_activity_data[user_id]["visits"][-1]["end_time"] = current_time.isoformat()
-                    await save_vinewood_activity_data(vinewood_activity_data)
-            continue
+    await send_report(channel_sender(NOTIFICATION_CHANNEL_ID), summary_lines())
 
-        vinewood_active = False
-        vehicle = "CARNOTFOUND"
-        for activity in member.activities:
-            if isinstance(activity, (discord.Game, discord.Activity)):
-                activity_text = f"{activity.name} {activity.state or ''} {activity.details or ''}"
-                if "Vinewood Park Dr" in activity_text and "bên trong xe" in activity_text:
-                    vinewood_active = True
-                    vehicle_part = activity_text.split("bên trong xe")[-1].strip()
-                    vehicle = vehicle_part.split(" tại ")[0].split(" vào ")[0].strip() or "CARNOTFOUND"
-                    break
-
-        if user_id not in activity_data:
-            activity_data[user_id] = {"in_vinewood": False, "vinewood_start_time": None, "last_notified": None}
-        if user_id not in vinewood_activity_data:
-            vinewood_activity_data[user_id] = {"visits": []}
-
-        last_notified = activity_data[user_id].get("last_notified")
-        can_notify = not last_notified or (current_time - datetime.fromisoformat(last_notified)).total_seconds() >= 300
-
-        vehicle_status = " (xe không được phép)" if vinewood_active and vehicle not in AUTHORIZED_VEHICLES else ""
-
-        if vinewood_active and not activity_data[user_id]["in_vinewood"] and can_notify:
-            activity_data[user_id]["in_vinewood"] = True
-            activity_data[user_id]["vinewood_start_time"] = current_time.isoformat()
-            activity_data[user_id]["last_notified"] = current_time.isoformat()
-            await save_activity_data(activity_data)
-            await channel.send(
-                f"{member.display_name} đã vào khu vực Vinewood Park Dr lúc {current_time.strftime('%H:%M:%S %Y-%m-%d')} "
-                f"bên trong xe {vehicle}{vehicle_status} (đang on-duty)."
-            )
-            vinewood_activity_data[user_id]["visits"].append({
-                "start_time": current_time.isoformat(),
-                "vehicle": vehicle,
-                "end_time": None,
-                "unauthorized": vehicle not in AUTHORIZED_VEHICLES
-            })
-            await save_vinewood_activity_data(vinewood_activity_data)
-
-        elif not vinewood_active and activity_data[user_id]["in_vinewood"] and can_notify:
-            start_time_str = activity_data[user_id]["vinewood_start_time"]
-            if start_time_str:
-                start_time = datetime.fromisoformat(start_time_str).astimezone(VN_TIMEZONE)
-                time_spent_seconds = (current_time - start_time).total_seconds()
-                hours = int(time_spent_seconds // 3600)
-                minutes = int((time_spent_seconds % 3600) // 60)
-                seconds = int(time_spent_seconds % 60)
-                await channel.send(
-                    f"{member.display_name} đã rời khỏi khu vực Vinewood Park Dr sau {hours}h {minutes}m {seconds}s "
-                    f"vào lúc {current_time.strftime('%H:%M:%S %Y-%m-%d')} (đang on-duty)."
-                )
-                if vinewood_activity_data[user_id]["visits"] and not vinewood_activity_data[user_id]["visits"][-1].get("end_time"):
-                    vinewood_activity_data[user_id]["visits"][-1]["end_time"] = current_time.isoformat()
-                    await save_vinewood_activity_data(vinewood_activity_data)
-            activity_data[user_id]["in_vinewood"] = False
-            activity_data[user_id]["vinewood_start_time"] = None
-            activity_data[user_id]["last_notified"] = current_time.isoformat()
-            await save_activity_data(activity_data)
-
-    if users_to_remove:
-        for user_id in users_to_remove:
-            if user_id in user_mapping:
-                del user_mapping[user_id]
-        await save_user_mapping(user_mapping)
+async def end_duty_offline(member, current_time):
+    """Actor job: end an on-duty member's session (and open zone visit) at current_time because they went offline."""
+    await end_duty(str(member.id), current_time, member.name, member.display_name, "offline")
 
-@tasks.loop(minutes=1)
-async def daily_report():
+async def end_duty(user_id, current_time, name, display_name, reason):
+    """Actor job: end a user's session and open zone visit at current_time without a command, e.g. reason "offline"."""
+    state = activity_data.get(user_id)
+    if state and state.zone:
+        record_zone_leave(user_id, current_time, name, f"do {reason} (đang on-duty)")
+        await save_activity_data(activity_data)
+        await save_zone_visits(zone_visits)
+
+    if user_id not in duty_sessions:
+        return
+    start_time = from_epoch(duty_sessions[user_id].start)
+    time_online = max(0, (current_time - start_time).total_seconds() / 60)
+    record_event("off_duty", user_id, start=start_time.isoformat(), time=current_time.isoformat())
+    await save_playtime_data(playtime_data, notify_changes=True)
+    await save_online_times(duty_sessions)
+    hours = int(time_online // 60)
+    mins = int(time_online % 60)
+    outbound.send(NOTIFICATION_CHANNEL_ID, f"{display_name} đã dừng on-duty lúc {current_time.strftime('%H:%M:%S %Y-%m-%d')}. Thời gian: {hours}h {mins}m (tự động do {reason}).")
+
+async def resync_gateway_state():
+    """Reconcile state with the gateway cache after READY/RESUMED, applying only what changed while disconnected.
+
+    New and departed members update user_mapping (saved only if it changed);
+    a departed member's open session is ended at the time the connection
+    dropped. On-duty members who are now offline are taken off duty at the time the
+    connection dropped; the others get their zone state re-checked.
+    """
+    global gateway_disconnected_at, foreign_users
     current_time = datetime.now(VN_TIMEZONE)
-    if current_time.hour != 23 or current_time.minute != 59:
+    offline_since = min(gateway_disconnected_at or current_time, current_time)
+    gateway_disconnected_at = None
+
+    # READY tạo lại cache thành viên nên registry được dựng lại từ cache (chỉ tra dict, không ghi file)
+    display_names = {entry.key: entry.display_name for entry in member_registry}
+    missing = member_registry.rebuild(bot.guilds, user_mapping)
+    changed = bool(missing)
+    await unregister_users(missing, offline_since, display_names)
+    if MULTI_PROCESS:
+        foreign_users = await asyncio.to_thread(load_foreign_users)
+    new_members = [member for guild in bot.guilds for member in guild.members if str(member.id) not in user_mapping]
+    changed = await register_members(new_members) or changed
+    if changed:
+        await save_user_mapping(user_mapping)
+
+    for user_id in list(duty_sessions):
+        entry = member_registry.get(user_id)
+        if not entry:
+            continue
+        if entry.member.status == discord.Status.offline:
+            await state_actor.run(user_id, end_duty_offline, entry.member, offline_since)
+        else:
+            await state_actor.run(user_id, refresh_zone_state, entry.member, current_time)
+    for user_id in list(users_in_zone):
+        await state_actor.run(user_id, close_zone_if_off_duty, user_id, current_time)
+
+def record_zone_leave(user_id, current_time, name=None, reason="(đang on-duty)"):
+    """Close the user's open zone visit at current_time; with name, announce it in the zone's channel. Callers save."""
+    state = activity_data[user_id]
+    zone_key, zone_start = state.zone, state.zone_start
+    record_event("zone_leave", user_id, time=current_time.isoformat(), zone=zone_key)
+    zone = zone_index.get(zone_key)
+    if name is None or zone is None or zone_start is None:
         return
+    time_spent_seconds = max(0, int(current_time.timestamp()) - zone_start)
+    hours = int(time_spent_seconds // 3600)
+    minutes = int((time_spent_seconds % 3600) // 60)
+    seconds = int(time_spent_seconds % 60)
+    outbound.send(
+        zone.channel_id,
+        f"{name} đã rời khỏi khu vực {zone.name} sau {hours}h {minutes}m {seconds}s "
+        f"vào lúc {current_time.strftime('%H:%M:%S %Y-%m-%d')} {reason}."
+    )
 
-    channel = bot.get_channel(REPORT_CHANNEL_ID)
-    if not channel:
-        print(f"Không tìm thấy kênh báo cáo với ID {REPORT_CHANNEL_ID}")
+async def update_zone_state(member, current_time, presence=None):
+    """Actor job: detect a zone enter/leave (or a move between zones) for an on-duty member from their current activities."""
+    user_id = str(member.id)
+    presence = presence or presence_matcher.match(member.activities)
+    zone = zone_index.get(presence.zone) if presence.zone else None
+    state = activity_data.setdefault(user_id, ActivityState())
+    if (zone.key if zone else None) == state.zone:
         return
 
-    report = f"📊 **Báo cáo on-duty ngày {current_time.strftime('%d/%m/%Y')}**:\n"
-    users_reported = 0
-    current_date_str = current_time.date().isoformat()
+    # Thời gian chờ giữa hai thông báo lấy theo khu vực vừa vào, hoặc khu vực vừa rời
+    gate = zone or zone_index.get(state.zone)
+    cooldown = gate.notify_cooldown if gate else ZONE_DEFAULTS["notify_cooldown"]
+    now = int(current_time.timestamp())
+    if state.last_notified is not None and now - state.last_notified < cooldown:
+        return
 
-    users_to_remove = []
-    for user_id, user_info in user_mapping.items():
-        if not isinstance(user_info, dict):
-            users_to_remove.append(user_id)
-            continue
-        guild_id = user_info.get("guild_id")
-        if not guild_id or not (guild := bot.get_guild(int(guild_id))) or not (member := guild.get_member(int(user_id))):
-            users_to_remove.append(user_id)
-            continue
-        total_online = playtime_data.get(user_id, {}).get("daily_online", {}).get(current_date_str, 0)
+    if state.zone:
+        record_zone_leave(user_id, current_time, member.display_name)
+    if zone:
+        record_event("zone_enter", user_id, time=current_time.isoformat(), zone=zone.key,
+                     vehicle=presence.vehicle, unauthorized=not presence.authorized)
+        if presence.vehicle:
+            vehicle_status = "" if presence.authorized else " (xe không được phép)"
+            where = f" bên trong xe {presence.vehicle}{vehicle_status}"
+        else:
+            where = ""
+        outbound.send(
+            zone.channel_id,
+            f"{member.display_name} đã vào khu vực {zone.name} lúc {current_time.strftime('%H:%M:%S %Y-%m-%d')}"
+            f"{where} (đang on-duty)."
+        )
+    await save_activity_data(activity_data)
+    await save_zone_visits(zone_visits)
+
+async def refresh_zone_state(member, current_time):
+    """Actor job: re-check the zone of a member who is still on duty."""
+    if str(member.id) in duty_sessions:
+        await update_zone_state(member, current_time)
+
+async def close_zone_if_off_duty(user_id, current_time):
+    state = activity_data.get(user_id)
+    if user_id not in duty_sessions and state and state.zone:
+        record_zone_leave(user_id, current_time)
+        await save_activity_data(activity_data)
+        await save_zone_visits(zone_visits)
+
+@tasks.loop(minutes=5)
+@metrics.timed("handler_seconds", handler="check_zone_activity")
+async def check_zone_activity():
+    """Reconciliation pass behind on_presence_update: only on-duty users and users still marked in a zone are visited."""
+    current_time = datetime.now(VN_TIMEZONE)
+    for user_id in list(users_in_zone):
+        await state_actor.run(user_id, close_zone_if_off_duty, user_id, current_time)
+
+    for user_id in list(duty_sessions):
+        entry = member_registry.get(user_id)
+        if entry:
+            await state_actor.run(user_id, refresh_zone_state, entry.member, current_time)
+
+async def split_open_sessions(split_time):
+    """Credit every open on-duty session up to split_time, so daily totals include people still on duty."""
+    split_epoch = split_time.timestamp()
+    split_users = [user_id for user_id, session in duty_sessions.items() if session.start < split_epoch]
+    for user_id in split_users:
+        record_event("split", user_id, time=split_time.isoformat())
+    if split_users:
+        await save_playtime_data(playtime_data)
+        await save_activity_data(activity_data)
+
+async def midnight_split(scheduled_time):
+    await split_open_sessions(scheduled_time)
+
+def channel_sender(channel_id):
+    """send() for send_report that queues each page on the outbound dispatcher."""
+    async def send(content):
+        outbound.send(channel_id, content)
+    return send
+
+def format_minutes(total_minutes):
+    return f"{int(total_minutes // 60)}h {int(total_minutes % 60)}m"
+
+def format_visit(visit, current_time):
+    start_time = from_epoch(visit.start)
+    end_time = from_epoch(visit.end) if visit.end is not None else current_time
+    time_spent_seconds = (end_time - start_time).total_seconds()
+    hours = int(time_spent_seconds // 3600)
+    minutes = int((time_spent_seconds % 3600) // 60)
+    seconds = int(time_spent_seconds % 60)
+    # Khu vực không bắt buộc lái xe lưu vehicle là None
+    vehicle = visit.vehicle or "đi bộ"
+    vehicle_status = " (xe không được phép)" if visit.unauthorized else ""
+    return f"  - {start_time.strftime('%H:%M:%S')} - {end_time.strftime('%H:%M:%S')}: {vehicle}{vehicle_status}, {hours}h {minutes}m {seconds}s"
+
+async def daily_report(scheduled_time):
+    current_time = scheduled_time.astimezone(VN_TIMEZONE)
+    await split_open_sessions(current_time)
+    daily_totals = await daily_online_on(current_time.date().isoformat())
+    visits_today = await zone_visits_on(current_time.date())
+    members = await report_members()
+
+    def duty_lines():
+        for user_id, display_name in members:
+            total_online = daily_totals.get(user_id, 0)
+            if total_online > 0:
+                yield f"- {display_name}: {format_minutes(total_online)}"
+
+    # Khu vực đã cấu hình luôn có mục trong báo cáo; khu vực đã bỏ khỏi cấu hình chỉ hiện khi có lượt vào
+    zone_keys = [zone.key for zone in zone_index]
+    zone_keys += sorted({visit.zone for visits in visits_today.values() for visit in visits} - set(zone_keys))
+
+    def zone_lines(zone_key):
+        for user_id, display_name in members:
+            daily_visits = [visit for visit in visits_today.get(user_id, []) if visit.zone == zone_key]
+            if daily_visits:
+                yield f"- {display_name}:"
+                for visit in daily_visits:
+                    yield format_visit(visit, current_time)
+
+    def lines():
+        yield from report_lines(f"📊 **Báo cáo on-duty ngày {current_time.strftime('%d/%m/%Y')}**:",
+                                duty_lines(), "Không có ai on-duty hôm nay.")
+        for zone_key in zone_keys:
+            zone_name = zone_index.name_of(zone_key)
+            yield ""
+            yield from report_lines(f"📍 **Báo cáo hoạt động tại {zone_name} ngày {current_time.strftime('%d/%m/%Y')}**:",
+                                    zone_lines(zone_key), f"Không có ai vào {zone_name} hôm nay.")
+
+    await send_report(channel_sender(REPORT_CHANNEL_ID), lines())
+
+async def weekly_report(scheduled_time):
+    """Weekly rollup of the week that just ended."""
+    week_start = scheduled_time.astimezone(VN_TIMEZONE).date() - timedelta(days=7)
+    week_totals = await daily_online_between(week_start, week_start + timedelta(days=6))
+    totals = []
+    for user_id, display_name in await report_members():
+        total_online = sum(minutes for _, minutes in week_totals.get(user_id, []))
         if total_online > 0:
-            hours = int(total_online // 60)
-            mins = int(total_online % 60)
-            report += f"- {member.display_name}: {hours}h {mins}m\n"
-            users_reported += 1
-
-    if users_reported == 0:
-        report += "Không có ai on-duty hôm nay.\n"
-
-    report += f"\n📍 **Báo cáo hoạt động tại Vinewood Park Dr ngày {current_time.strftime('%d/%m/%Y')}**:\n"
-    vinewood_users_reported = 0
-    for user_id, user_info in user_mapping.items():
-        if not isinstance(user_info, dict):
+            totals.append((total_online, display_name))
+    header = f"📅 **Báo cáo on-duty tuần {week_start.strftime('%d/%m/%Y')} - {(week_start + timedelta(days=6)).strftime('%d/%m/%Y')}**:"
+    body = (f"- {display_name}: {format_minutes(total_online)}" for total_online, display_name in sorted(totals, reverse=True))
+    await send_report(channel_sender(REPORT_CHANNEL_ID), report_lines(header, body, "Không có ai on-duty tuần này."))
+
+async def archive_zone_visits(scheduled_time):
+    """Move day partitions past the retention window out of memory (into gzip archives with the JSON backend).
+
+    A day is kept until it is older than the longest retention_days of the zones visited that day.
+    """
+    today = scheduled_time.astimezone(VN_TIMEZONE).date()
+    # Không ngày nào hết hạn sớm hơn khu vực có retention ngắn nhất
+    cutoff = (today - timedelta(days=min(zone.retention_days for zone in zone_index))).isoformat()
+    archived = False
+    for day_str in zone_visits.expired_days(cutoff):
+        retention_days = zone_index.max_retention_days(zone_visits.zones_on(day_str)) or ZONE_DEFAULTS["retention_days"]
+        if day_str >= (today - timedelta(days=retention_days)).isoformat():
             continue
-        guild_id = user_info.get("guild_id")
-        if not guild_id or not (guild := bot.get_guild(int(guild_id))) or not (member := guild.get_member(int(user_id))):
-            continue
-        visits = vinewood_activity_data.get(user_id, {}).get("visits", [])
-        daily_visits = [v for v in visits if datetime.fromisoformat(v["start_time"]).astimezone(VN_TIMEZONE).date() == current_time.date()]
-        if daily_visits:
-            report += f"- {member.display_name}:\n"
-            for visit in daily_visits:
-                start_time = datetime.fromisoformat(visit["start_time"]).astimezone(VN_TIMEZONE)
-                end_time = datetime.fromisoformat(visit["end_time"]).astimezone(VN_TIMEZONE) if visit.get("end_time") else current_time
-                time_spent_seconds = (end_time - start_time).total_seconds()
-                hours = int(time_spent_seconds // 3600)
-                minutes = int((time_spent_seconds % 3600) // 60)
-                seconds = int(time_spent_seconds % 60)
-                vehicle = visit.get("vehicle", "CARNOTFOUND")
-                vehicle_status = " (xe không được phép)" if visit.get("unauthorized", False) else ""
-                report += f"  - {start_time.strftime('%H:%M:%S')} - {end_time.strftime('%H:%M:%S')}: {vehicle}{vehicle_status}, {hours}h {minutes}m {seconds}s\n"
-            vinewood_users_reported += 1
-
-    if vinewood_users_reported == 0:
-        report += "Không có ai vào Vinewood Park Dr hôm nay.\n"
-
-    await channel.send(report)
-    if users_to_remove:
-        for user_id in users_to_remove:
-            if user_id in user_mapping:
-                del user_mapping[user_id]
-        await save_user_mapping(user_mapping)
+        if zone_visits.archive_dir:
+            try:
+                await asyncio.to_thread(zone_visits.write_archive, day_str)
+            except OSError as e:
+                print(f"Lỗi khi nén lịch sử khu vực ngày {day_str}: {e}")
+                continue
+        zone_visits.drop(day_str)
+        archived = True
+    if archived:
+        await save_zone_visits(zone_visits)
+
+if IS_PRIMARY_PROCESS:
+    scheduler.add_job("daily_report", DailyAt(VN_TIMEZONE, *DAILY_REPORT_AT), daily_report)
+    scheduler.add_job("weekly_report", DailyAt(VN_TIMEZONE, *WEEKLY_REPORT_AT, weekdays=[0]), weekly_report)
+if MULTI_PROCESS:
+    scheduler.add_job("report_split", DailyAt(VN_TIMEZONE, *REPORT_SPLIT_AT), split_open_sessions)
+scheduler.add_job("midnight_split", DailyAt(VN_TIMEZONE, 0, 0), midnight_split)
+scheduler.add_job("vinewood_archive", DailyAt(VN_TIMEZONE, *ZONE_ARCHIVE_AT), archive_zone_visits, catch_up=False)
 
 @bot.event
+@metrics.timed("handler_seconds", handler="on_presence_update")
 async def on_presence_update(before, after):
-    global activity_data, user_mapping, vinewood_activity_data
+    await presence_gate.submit(before, after)
+
+@metrics.timed("handler_seconds", handler="process_presence_update")
+async def process_presence_update(before, after, presence):
+    """Actor job: handle one presence change that passed presence_gate (deduplicated across guilds, bursts collapsed)."""
+    global activity_data, user_mapping, zone_visits
     user_id = str(after.id)
     current_time = datetime.now(VN_TIMEZONE)
 
-    game_active = any(
-        isinstance(activity, (discord.Game, discord.Activity)) and (
-            any(keyword in str(activity.name).lower() for keyword in ["gta5vn.net", "gta5vn", "gta v", "gta 5", "fivem"])
-        )
-        for activity in after.activities
-    )
+    if presence.game_active and user_id not in user_mapping and after.guild and await register_members([after]):
+        await save_user_mapping(user_mapping)
+        outbound.send(NOTIFICATION_CHANNEL_ID, f"Người chơi {after.name} đã được tự động thêm vào danh sách.")
+    elif user_id in user_mapping and after.id not in member_registry and after.guild:
+        # Người đã đăng ký nhưng chưa có trong cache thành viên lúc dựng lại registry
+        register_user(after)
+
+    # Chỉ kết thúc on-duty khi người dùng offline
+    if after.status == discord.Status.offline and user_id in duty_sessions:
+        await end_duty_offline(after, current_time)
+        return
+
+    # Phát hiện vào/rời khu vực ngay khi Rich Presence thay đổi, thay vì chờ vòng quét 5 phút
+    if user_id in duty_sessions and activity_fingerprint(before.activities) != activity_fingerprint(after.activities):
+        await update_zone_state(after, current_time, presence)
 
-    if game_active and user_id not in user_mapping and after.guild:
-        guild_id = str(after.guild.id)
-        user_mapping[user_id] = {"guild_id": guild_id}
+async def queue_presence_update(before, after, presence):
+    await state_actor.run(after.id, process_presence_update, before, after, presence)
+
+presence_gate = PresenceGate(presence_matcher, queue_presence_update, window=PRESENCE_DEBOUNCE_WINDOW)
+
+@bot.event
+@metrics.timed("handler_seconds", handler="on_disconnect")
+async def on_disconnect():
+    global gateway_disconnected_at
+    if gateway_disconnected_at is None:
+        gateway_disconnected_at = datetime.now(VN_TIMEZONE)
+
+@bot.event
+@metrics.timed("handler_seconds", handler="on_resumed")
+async def on_resumed():
+    await resync_gateway_state()
+
+@bot.event
+@metrics.timed("handler_seconds", handler="on_member_join")
+async def on_member_join(member):
+    if await register_members([member]):
         await save_user_mapping(user_mapping)
-        channel = bot.get_channel(NOTIFICATION_CHANNEL_ID)
-        if channel:
-            await channel.send(f"Người chơi {after.name} đã được tự động thêm vào danh sách.")
 
-    if user_id not in activity_data:
-        activity_data[user_id] = {"in_vinewood": False, "vinewood_start_time": None, "last_notified": None}
-    if user_id not in vinewood_activity_data:
-        vinewood_activity_data[user_id] = {"visits": []}
+@bot.event
+@metrics.timed("handler_seconds", handler="on_member_remove")
+async def on_member_remove(member):
+    user_id = str(member.id)
+    if user_mapping.get(user_id, {}).get("guild_id") == str(member.guild.id):
+        await unregister_users([user_id])
 
-    # Chỉ kết thúc on-duty khi người dùng offline
-    if after.status == discord.Status.offline and user_id in online_start_times:
-        if activity_data[user_id]["in_vinewood"]:
-            start_time_str = activity_data[user_id]["vinewood_start_time"]
-            if start_time_str:
-                start_time = datetime.fromisoformat(start_time_str).astimezone(VN_TIMEZONE)
-                time_spent_seconds = (current_time - start_time).total_seconds()
-                hours = int(time_spent_seconds // 3600)
-                minutes = int((time_spent_seconds % 3600) // 60)
-                seconds = int(time_spent_seconds % 60)
-                channel = bot.get_channel(VINEWOOD_CHANNEL_ID)
-                if channel:
-                    await channel.send(
-                        f"{after.name} đã rời khỏi khu vực Vinewood Park Dr sau {hours}h {minutes}m {seconds}s "
-                        f"vào lúc {current_time.strftime('%H:%M:%S %Y-%m-%d')} do offline (đang on-duty)."
-                    )
-                if vinewood_activity_data[user_id]["visits"] and not vinewood_activity_data[user_id]["visits"][-1].get("end_time"):
-                    vinewood_activity_data[user_id]["visits"][-1]["end_time"] = current_time.isoformat()
-            activity_data[user_id]["in_vinewood"] = False
-            activity_data[user_id]["vinewood_start_time"] = None
-            activity_data[user_id]["last_notified"] = current_time.isoformat()
-            await save_activity_data(activity_data)
-            await save_vinewood_activity_data(vinewood_activity_data)
-
-        start_time = online_start_times.pop(user_id)
-        time_online = (current_time - start_time).total_seconds() / 60
-        if user_id not in playtime_data:
-            playtime_data[user_id] = {"daily_online": {}}
-        current_date = start_time
-        while current_date.date() <= current_time.date():
-            date_str = current_date.date().isoformat()
-            playtime_data[user_id]["daily_online"].setdefault(date_str, 0)
-            end_of_period = min(current_time, datetime.combine(current_date.date() + timedelta(days=1), datetime.min.time(), tzinfo=VN_TIMEZONE) - timedelta(seconds=1))
-            start_of_period = max(start_time, datetime.combine(current_date.date(), datetime.min.time(), tzinfo=VN_TIMEZONE))
-            time_in_day = (end_of_period - start_of_period).total_seconds() / 60
-            playtime_data[user_id]["daily_online"][date_str] += time_in_day
-            current_date += timedelta(days=1)
-        await save_playtime_data(playtime_data, notify_changes=True)
-        await save_online_times(online_start_times)
-        channel = bot.get_channel(NOTIFICATION_CHANNEL_ID)
-        if channel:
-            hours = int(time_online // 60)
-            mins = int(time_online % 60)
-            await channel.send(f"{after.display_name} đã dừng on-duty lúc {current_time.strftime('%H:%M:%S %Y-%m-%d')}. Thời gian: {hours}h {mins}m (tự động do offline).")
+@bot.event
+@metrics.timed("handler_seconds", handler="on_member_update")
+async def on_member_update(before, after):
+    if before.display_name != after.display_name:
+        member_registry.refresh(after)
+        if sqlite_storage:
+            member_changes.add(str(after.id))
+            await save_user_mapping(user_mapping)
+
+@bot.event
+@metrics.timed("handler_seconds", handler="on_user_update")
+async def on_user_update(before, after):
+    member_registry.refresh_user(after.id)
+    if sqlite_storage and after.id in member_registry:
+        member_changes.add(str(after.id))
+        await save_user_mapping(user_mapping)
+
+@bot.event
+@metrics.timed("handler_seconds", handler="on_guild_join")
+async def on_guild_join(guild):
+    if await register_members(guild.members):
+        await save_user_mapping(user_mapping)
+
+@bot.event
+@metrics.timed("handler_seconds", handler="on_guild_remove")
+async def on_guild_remove(guild):
+    guild_id = str(guild.id)
+    await unregister_users([user_id for user_id, user_info in user_mapping.items() if user_info.get("guild_id") == guild_id])
+
+async def start_duty(member, current_time):
+    """Actor job: put member on duty at current_time. Returns the start of the session already running, or None.
+
+    Does nothing for a user owned by another shard process (see register_members).
+    """
+    user_id = str(member.id)
+    if user_id in duty_sessions:
+        return from_epoch(duty_sessions[user_id].start)
+    if await register_members([member]):
+        await save_user_mapping(user_mapping)
+    if not owns_user(user_id):
+        return None
+    record_event("on_duty", user_id, time=current_time.isoformat())
+    await save_online_times(duty_sessions)
+    return None
+
+async def stop_duty(user_id, current_time):
+    """Actor job: take user_id off duty at current_time. Returns the session start, or None if they were not on duty."""
+    if user_id not in duty_sessions:
+        return None
+    start_time = from_epoch(duty_sessions[user_id].start)
+    record_event("off_duty", user_id, start=start_time.isoformat(), time=current_time.isoformat())
+    await save_playtime_data(playtime_data, notify_changes=True)
+    await save_online_times(duty_sessions)
+    await close_zone_if_off_duty(user_id, current_time)
+    return start_time
+
+async def adjust_daily_online(user_id, date_str, delta_minutes, admin_id):
+    """Actor job: add delta_minutes (negative to subtract, floored at 0) to a user's on-duty time for one day."""
+    new_minutes = max(0, get_daily_online(user_id, date_str) + delta_minutes)
+    record_event("time_adjust", user_id, date=date_str, minutes=new_minutes, admin_id=admin_id)
+    await save_playtime_data(playtime_data, notify_changes=True)
 
 @bot.command()
 async def help(ctx):
@@ -438,8 +1115,11 @@ async def help(ctx):
                   "`!checkdays [ngày/tháng] hoặc [ngày/tháng-ngày/tháng]` - Xem thời gian on-duty.\n"
                   "`!checkduty` - Hiển thị danh sách người chơi đang on-duty.\n"
                   "`!checkoff` - Hiển thị danh sách người chơi đang off-duty.\n"
+                  "`!checkat giờ:phút [ngày/tháng]` - Xem ai on-duty vào một thời điểm.\n"
+                  "`!analytics [số_tuần]` - Thống kê nhân sự on-duty (file CSV).\n"
+                  "`!export ngày/tháng-ngày/tháng [@tag ...] [csv|jsonl]` - Xuất on-duty theo ngày, các phiên và lượt vào khu vực ra file.\n"
                   "`!checkreg` - Xem danh sách người chơi đã đăng ký.\n"
-                  "`!vinewood` - Xem người chơi đang ở Vinewood Park Dr.\n"
+                  "`!zone [khu_vực] [ngày/tháng]` - Xem người chơi đang ở các khu vực, hoặc lịch sử một ngày (`!vinewood` = Vinewood Park Dr).\n"
                   "`!checkstatus` - Kiểm tra trạng thái bot.\n"
                   "`!playtime [@tag]` - Xem tổng thời gian on-duty.\n"
                   "`!lichsu [@tag]` - Xem lịch sử on-duty 7 ngày gần nhất.\n"
@@ -457,21 +1137,17 @@ async def onduty(ctx):
     if not ctx.guild:
         await ctx.send("Lệnh !onduty chỉ có thể được sử dụng trong server.")
         return
-    user_id = str(ctx.author.id)
     current_time = datetime.now(VN_TIMEZONE)
-    if user_id in online_start_times:
-        start_time = online_start_times[user_id]
+    start_time = await state_actor.run(ctx.author.id, start_duty, ctx.author, current_time)
+    if str(ctx.author.id) in foreign_users:
+        await ctx.send(owned_elsewhere_message(ctx.author.display_name))
+        return
+    if start_time:
         time_online = (current_time - start_time).total_seconds() / 60
         hours = int(time_online // 60)
         mins = int(time_online % 60)
         await ctx.send(f"Bạn đã on-duty từ {start_time.strftime('%H:%M:%S %Y-%m-%d')}. Thời gian: {hours}h {mins}m.")
         return
-    if user_id not in user_mapping:
-        guild_id = str(ctx.guild.id)
-        user_mapping[user_id] = {"guild_id": guild_id}
-        await save_user_mapping(user_mapping)
-    online_start_times[user_id] = current_time
-    await save_online_times(online_start_times)
     await ctx.send(f"{ctx.author.display_name} đã bắt đầu on-duty lúc {current_time.strftime('%H:%M:%S %Y-%m-%d')}.")
 
 @bot.command()
@@ -481,29 +1157,15 @@ async def offduty(ctx):
         await ctx.send("Lệnh !offduty chỉ có thể được sử dụng trong server.")
         return
     user_id = str(ctx.author.id)
+    if user_id in foreign_users:
+        await ctx.send(owned_elsewhere_message(ctx.author.display_name))
+        return
     current_time = datetime.now(VN_TIMEZONE)
-    if user_id not in online_start_times:
+    start_time = await state_actor.run(user_id, stop_duty, user_id, current_time)
+    if start_time is None:
         await ctx.send("Bạn hiện không ở trạng thái on-duty.")
-        loaded_times = load_online_times()
-        if user_id in loaded_times:
-            await ctx.send(f"(Debug) Tuy nhiên, file online_times.json vẫn ghi nhận bạn on-duty từ {loaded_times[user_id].strftime('%H:%M:%S %Y-%m-%d')}. Đang sửa...")
-            online_start_times[user_id] = loaded_times[user_id]
         return
-    start_time = online_start_times.pop(user_id)
     time_online = (current_time - start_time).total_seconds() / 60
-    if user_id not in playtime_data:
-        playtime_data[user_id] = {"daily_online": {}}
-    current_date = start_time
-    while current_date.date() <= current_time.date():
-        date_str = current_date.date().isoformat()
-        playtime_data[user_id]["daily_online"].setdefault(date_str, 0)
-        end_of_period = min(current_time, datetime.combine(current_date.date() + timedelta(days=1), datetime.min.time(), tzinfo=VN_TIMEZONE) - timedelta(seconds=1))
-        start_of_period = max(start_time, datetime.combine(current_date.date(), datetime.min.time(), tzinfo=VN_TIMEZONE))
-        time_in_day = (end_of_period - start_of_period).total_seconds() / 60
-        playtime_data[user_id]["daily_online"][date_str] += time_in_day
-        current_date += timedelta(days=1)
-    await save_playtime_data(playtime_data, notify_changes=True)
-    await save_online_times(online_start_times)
     await ctx.send(f"{ctx.author.display_name} đã dừng on-duty. Thời gian: {int(time_online // 60)}h {int(time_online % 60)}m.")
 
 @bot.command()
@@ -514,21 +1176,17 @@ async def donduty(ctx, member: discord.Member):
     if not has_admin_role(ctx.author):
         await ctx.send(f"{ctx.author.mention}, chỉ admin mới có thể sử dụng lệnh này!")
         return
-    user_id = str(member.id)
     current_time = datetime.now(VN_TIMEZONE)
-    if user_id in online_start_times:
-        start_time = online_start_times[user_id]
+    start_time = await state_actor.run(member.id, start_duty, member, current_time)
+    if str(member.id) in foreign_users:
+        await ctx.send(owned_elsewhere_message(member.display_name))
+        return
+    if start_time:
         time_online = (current_time - start_time).total_seconds() / 60
         hours = int(time_online // 60)
         mins = int(time_online % 60)
         await ctx.send(f"{member.display_name} đã on-duty từ {start_time.strftime('%H:%M:%S %Y-%m-%d')}. Thời gian: {hours}h {mins}m.")
         return
-    if user_id not in user_mapping:
-        guild_id = str(ctx.guild.id)
-        user_mapping[user_id] = {"guild_id": guild_id}
-        await save_user_mapping(user_mapping)
-    online_start_times[user_id] = current_time
-    await save_online_times(online_start_times)
     await ctx.send(f"{member.display_name} đã được admin {ctx.author.display_name} buộc vào trạng thái on-duty lúc {current_time.strftime('%H:%M:%S %Y-%m-%d')}.")
 
 @bot.command()
@@ -540,25 +1198,15 @@ async def doffduty(ctx, member: discord.Member):
         await ctx.send(f"{ctx.author.mention}, chỉ admin mới có thể sử dụng lệnh này!")
         return
     user_id = str(member.id)
+    if user_id in foreign_users:
+        await ctx.send(owned_elsewhere_message(member.display_name))
+        return
     current_time = datetime.now(VN_TIMEZONE)
-    if user_id not in online_start_times:
+    start_time = await state_actor.run(user_id, stop_duty, user_id, current_time)
+    if start_time is None:
         await ctx.send(f"{member.display_name} hiện không ở trạng thái on-duty.")
         return
-    start_time = online_start_times.pop(user_id)
     time_online = (current_time - start_time).total_seconds() / 60
-    if user_id not in playtime_data:
-        playtime_data[user_id] = {"daily_online": {}}
-    current_date = start_time
-    while current_date.date() <= current_time.date():
-        date_str = current_date.date().isoformat()
-        playtime_data[user_id]["daily_online"].setdefault(date_str, 0)
-        end_of_period = min(current_time, datetime.combine(current_date.date() + timedelta(days=1), datetime.min.time(), tzinfo=VN_TIMEZONE) - timedelta(seconds=1))
-        start_of_period = max(start_time, datetime.combine(current_date.date(), datetime.min.time(), tzinfo=VN_TIMEZONE))
-        time_in_day = (end_of_period - start_of_period).total_seconds() / 60
-        playtime_data[user_id]["daily_online"][date_str] += time_in_day
-        current_date += timedelta(days=1)
-    await save_playtime_data(playtime_data, notify_changes=True)
-    await save_online_times(online_start_times)
     await ctx.send(f"{member.display_name} đã bị admin {ctx.author.display_name} buộc dừng on-duty. Thời gian: {int(time_online // 60)}h {int(time_online % 60)}m.")
 
 @bot.command()
@@ -598,33 +1246,21 @@ async def checkdays(ctx, *, date_range: str):
         except ValueError:
             await ctx.send("Định dạng: !checkdays ngày/tháng hoặc !checkdays ngày/tháng-ngày/tháng (ví dụ: 25/3 hoặc 25/3-30/3).")
             return
-        report = f"📊 **Thời gian on-duty từ {start_date.strftime('%d/%m/%Y')} đến {end_date.strftime('%d/%m/%Y')}**:\n"
-        users_reported = 0
-        users_to_remove = []
-        for user_id, user_info in user_mapping.items():
-            if not isinstance(user_info, dict):
-                users_to_remove.append(user_id)
-                continue
-            guild_id = user_info.get("guild_id")
-            if not guild_id or not (guild := bot.get_guild(int(guild_id))) or not (member := guild.get_member(int(user_id))):
-                users_to_remove.append(user_id)
-                continue
-            total_online = 0
-            daily_summary = ""
-            for date_str, minutes in playtime_data.get(user_id, {}).get("daily_online", {}).items():
-                date_obj = datetime.fromisoformat(date_str).date()
-                if start_date <= date_obj <= end_date:
-                    total_online += minutes
-                    hours = int(minutes // 60)
-                    mins = int(minutes % 60)
-                    daily_summary += f"  - {date_obj.strftime('%d/%m/%Y')}: {hours}h {mins}m\n"
-            if total_online > 0:
-                total_hours = int(total_online // 60)
-                total_mins = int(total_online % 60)
-                report += f"- {member.display_name}:\n{daily_summary}  Tổng: {total_hours}h {total_mins}m\n"
-                users_reported += 1
-        if users_reported == 0:
-            report += "Không có dữ liệu on-duty trong khoảng thời gian này.\n"
+        range_totals = await daily_online_between(start_date, end_date)
+        members = await report_members()
+
+        def body():
+            for user_id, display_name in members:
+                days = range_totals.get(user_id, [])
+                total_online = sum(minutes for _, minutes in days)
+                if total_online > 0:
+                    yield f"- {display_name}:"
+                    for date_str, minutes in days:
+                        yield f"  - {date.fromisoformat(date_str).strftime('%d/%m/%Y')}: {format_minutes(minutes)}"
+                    yield f"  Tổng: {format_minutes(total_online)}"
+
+        lines = report_lines(f"📊 **Thời gian on-duty từ {start_date.strftime('%d/%m/%Y')} đến {end_date.strftime('%d/%m/%Y')}**:",
+                             body(), "Không có dữ liệu on-duty trong khoảng thời gian này.")
     else:
         try:
             day, month = map(int, date_range.split("/"))
@@ -632,32 +1268,12 @@ async def checkdays(ctx, *, date_range: str):
         except ValueError:
             await ctx.send("Định dạng: !checkdays ngày/tháng (ví dụ: 25/3).")
             return
-        target_date_str = target_date.isoformat()
-        report = f"📊 **Thời gian on-duty ngày {target_date.strftime('%d/%m/%Y')}**:\n"
-        users_reported = 0
-        users_to_remove = []
-        for user_id, user_info in user_mapping.items():
-            if not isinstance(user_info, dict):
-                users_to_remove.append(user_id)
-                continue
-            guild_id = user_info.get("guild_id")
-            if not guild_id or not (guild := bot.get_guild(int(guild_id))) or not (member := guild.get_member(int(user_id))):
-                users_to_remove.append(user_id)
-                continue
-            total_online = playtime_data.get(user_id, {}).get("daily_online", {}).get(target_date_str, 0)
-            if total_online > 0:
-                hours = int(total_online // 60)
-                mins = int(total_online % 60)
-                report += f"- {member.display_name}: {hours}h {mins}m\n"
-                users_reported += 1
-        if users_reported == 0:
-            report += "Không có dữ liệu on-duty trong ngày này.\n"
-    await ctx.send(report)
-    if users_to_remove:
-        for user_id in users_to_remove:
-            if user_id in user_mapping:
-                del user_mapping[user_id]
-        await save_user_mapping(user_mapping)
+        daily_totals = await daily_online_on(target_date.isoformat())
+        body = (f"- {display_name}: {format_minutes(daily_totals[user_id])}"
+                for user_id, display_name in await report_members() if daily_totals.get(user_id, 0) > 0)
+        lines = report_lines(f"📊 **Thời gian on-duty ngày {target_date.strftime('%d/%m/%Y')}**:",
+                             body, "Không có dữ liệu on-duty trong ngày này.")
+    await send_report(ctx.send, lines, max_pages=REPORT_MAX_PAGES, filename="checkdays.txt")
 
 @bot.command(name="checkduty")
 async def checkduty(ctx):
@@ -668,32 +1284,58 @@ async def checkduty(ctx):
         await ctx.send(f"{ctx.author.mention}, chỉ admin mới có thể sử dụng lệnh này!")
         return
     current_time = datetime.now(VN_TIMEZONE)
-    report = "📊 **Danh sách người chơi đang on-duty**:\n"
-    users_reported = 0
-    users_to_remove = []
-    for user_id, user_info in user_mapping.items():
-        if not isinstance(user_info, dict):
-            users_to_remove.append(user_id)
-            continue
-        guild_id = user_info.get("guild_id")
-        if not guild_id or not (guild := bot.get_guild(int(guild_id))) or not (member := guild.get_member(int(user_id))):
-            users_to_remove.append(user_id)
-            continue
-        if user_id in online_start_times:
-            start_time = online_start_times[user_id]
+    on_duty = query_cache.get(("checkduty",), ("roster", "sessions"), lambda: [
+        (entry.display_name, from_epoch(duty_sessions[entry.key].start)) for entry in member_registry if entry.key in duty_sessions])
+
+    def body():
+        for display_name, start_time in on_duty:
             time_online = (current_time - start_time).total_seconds() / 60
-            hours = int(time_online // 60)
-            mins = int(time_online % 60)
-            report += f"- {member.display_name}: {hours}h {mins}m (bắt đầu từ {start_time.strftime('%H:%M:%S %Y-%m-%d')})\n"
-            users_reported += 1
-    if users_reported == 0:
-        report += "Không có ai đang on-duty.\n"
-    await ctx.send(report)
-    if users_to_remove:
-        for user_id in users_to_remove:
-            if user_id in user_mapping:
-                del user_mapping[user_id]
-        await save_user_mapping(user_mapping)
+            yield f"- {display_name}: {format_minutes(time_online)} (bắt đầu từ {start_time.strftime('%H:%M:%S %Y-%m-%d')})"
+
+    lines = report_lines("📊 **Danh sách người chơi đang on-duty**:", body(), "Không có ai đang on-duty.")
+    await send_report(ctx.send, lines, max_pages=REPORT_MAX_PAGES, filename="checkduty.txt")
+
+@bot.command(name="checkat")
+async def checkat(ctx, at: str, day: str = None):
+    if not ctx.guild:
+        await ctx.send("Lệnh !checkat chỉ có thể được sử dụng trong server.")
+        return
+    if not has_admin_role(ctx.author):
+        await ctx.send(f"{ctx.author.mention}, chỉ admin mới có thể sử dụng lệnh này!")
+        return
+    current_time = datetime.now(VN_TIMEZONE)
+    try:
+        hour, minute = map(int, at.split(":"))
+        target_date = current_time.date()
+        if day:
+            target_day, target_month = map(int, day.split("/"))
+            target_date = date(current_time.year, target_month, target_day)
+        moment = VN_TIMEZONE.localize(datetime.combine(target_date, datetime.min.time().replace(hour=hour, minute=minute)))
+    except ValueError:
+        await ctx.send("Định dạng: !checkat giờ:phút [ngày/tháng] (ví dụ: 21:00 hoặc 21:00 25/3).")
+        return
+    moment_epoch = int(moment.timestamp())
+    now_epoch = int(current_time.timestamp())
+    if MULTI_PROCESS:
+        # Người của các tiến trình khác chỉ có trong bot.db: đọc cả khoảng on-duty và phiên đang mở từ đó
+        await store.flush()
+        on_duty = await asyncio.to_thread(sqlite_storage.on_duty_at, moment.isoformat())
+        hour_intervals = await asyncio.to_thread(load_hour_intervals, moment_epoch, now_epoch)
+        open_sessions = {}
+    else:
+        on_duty = duty_intervals.on_duty_at(moment_epoch, {user_id: session.start for user_id, session in duty_sessions.items()})
+        hour_intervals = duty_intervals
+        open_sessions = {user_id: credited_from(user_id, session.start) for user_id, session in duty_sessions.items()}
+    members = await report_members()
+
+    def body():
+        for user_id, display_name in members:
+            if user_id in on_duty:
+                minutes = hour_intervals.hour_seconds(user_id, moment_epoch, open_sessions.get(user_id), now_epoch) / 60
+                yield f"- {display_name}: {format_minutes(minutes)} on-duty trong giờ {moment.strftime('%H')}:00"
+
+    lines = report_lines(f"🕘 **Người chơi on-duty lúc {moment.strftime('%H:%M %d/%m/%Y')}**:", body(), "Không có ai on-duty vào lúc này.")
+    await send_report(ctx.send, lines, max_pages=REPORT_MAX_PAGES, filename="checkat.txt")
 
 @bot.command(name="checkoff")
 async def checkoff(ctx):
@@ -703,28 +1345,10 @@ async def checkoff(ctx):
     if not has_admin_role(ctx.author):
         await ctx.send(f"{ctx.author.mention}, chỉ admin mới có thể sử dụng lệnh này!")
         return
-    report = "📊 **Danh sách người chơi đang off-duty**:\n"
-    users_reported = 0
-    users_to_remove = []
-    for user_id, user_info in user_mapping.items():
-        if not isinstance(user_info, dict):
-            users_to_remove.append(user_id)
-            continue
-        guild_id = user_info.get("guild_id")
-        if not guild_id or not (guild := bot.get_guild(int(guild_id))) or not (member := guild.get_member(int(user_id))):
-            users_to_remove.append(user_id)
-            continue
-        if user_id not in online_start_times:
-            report += f"- {member.display_name}\n"
-            users_reported += 1
-    if users_reported == 0:
-        report += "Không có ai đang off-duty.\n"
-    await ctx.send(report)
-    if users_to_remove:
-        for user_id in users_to_remove:
-            if user_id in user_mapping:
-                del user_mapping[user_id]
-        await save_user_mapping(user_mapping)
+    body = query_cache.get(("checkoff",), ("roster", "sessions"), lambda: [
+        f"- {entry.display_name}" for entry in member_registry if entry.key not in duty_sessions])
+    lines = report_lines("📊 **Danh sách người chơi đang off-duty**:", body, "Không có ai đang off-duty.")
+    await send_report(ctx.send, lines, max_pages=REPORT_MAX_PAGES, filename="checkoff.txt")
 
 @bot.command(name="checkreg")
 async def checkreg(ctx):
@@ -734,41 +1358,109 @@ async def checkreg(ctx):
     if not has_admin_role(ctx.author):
         await ctx.send(f"{ctx.author.mention}, chỉ admin mới có thể sử dụng lệnh này!")
         return
-    report = "📋 **Danh sách người chơi đã đăng ký**:\n"
-    users_reported = 0
-    for user_id, user_info in user_mapping.items():
-        guild_id = user_info.get("guild_id")
-        if guild_id and (guild := bot.get_guild(int(guild_id))) and (member := guild.get_member(int(user_id))):
-            report += f"- {member.display_name} (ID: {user_id})\n"
-            users_reported += 1
-    if users_reported == 0:
-        report += "Không có người chơi nào được đăng ký.\n"
-    await ctx.send(report)
+    body = query_cache.get(("checkreg",), ("roster",), lambda: [f"- {entry.display_name} (ID: {entry.key})" for entry in member_registry])
+    lines = report_lines("📋 **Danh sách người chơi đã đăng ký**:", body, "Không có người chơi nào được đăng ký.")
+    await send_report(ctx.send, lines, max_pages=REPORT_MAX_PAGES, filename="checkreg.txt")
 
-@bot.command()
-async def vinewood(ctx):
+@bot.command(name="zone", aliases=["vinewood"])
+async def zone_activity(ctx, zone_key: str = None, day: str = None):
     if not ctx.guild:
-        await ctx.send("Lệnh !vinewood chỉ có thể được sử dụng trong server.")
+        await ctx.send(f"Lệnh !{ctx.invoked_with} chỉ có thể được sử dụng trong server.")
         return
     if not has_admin_role(ctx.author):
         await ctx.send(f"{ctx.author.mention}, chỉ admin mới có thể sử dụng lệnh này!")
         return
-    report = "📍 **Danh sách người chơi đang ở Vinewood Park Dr**:\n"
-    users_reported = 0
+    # !vinewood ngày/tháng giữ cú pháp cũ: tham số đầu là ngày, khu vực mặc định là Vinewood
+    if zone_key and "/" in zone_key:
+        zone_key, day = None, zone_key
+    if zone_key is None and ctx.invoked_with == "vinewood":
+        zone_key = LEGACY_ZONE_KEY
+    if zone_key is not None and zone_index.get(zone_key) is None:
+        await ctx.send(f"Không có khu vực `{zone_key}`. Các khu vực: {', '.join(f'`{zone.key}`' for zone in zone_index)}.")
+        return
+    zone_keys = [zone_key] if zone_key else [zone.key for zone in zone_index]
     current_time = datetime.now(VN_TIMEZONE)
-    for user_id, user_info in user_mapping.items():
-        guild_id = user_info.get("guild_id")
-        if guild_id and (guild := bot.get_guild(int(guild_id))) and (member := guild.get_member(int(user_id))):
-            if activity_data.get(user_id, {}).get("in_vinewood", False):
-                start_time = datetime.fromisoformat(activity_data[user_id]["vinewood_start_time"]).astimezone(VN_TIMEZONE)
-                time_spent = (current_time - start_time).total_seconds() / 60
-                hours = int(time_spent // 60)
-                mins = int(time_spent % 60)
-                report += f"- {member.display_name}: {hours}h {mins}m\n"
-                users_reported += 1
-    if users_reported == 0:
-        report += "Không có ai đang ở Vinewood Park Dr.\n"
-    await ctx.send(report)
+    if day:
+        try:
+            target_day, target_month = map(int, day.split("/"))
+            target_date = date(current_time.year, target_month, target_day)
+        except ValueError:
+            await ctx.send(f"Định dạng: !{ctx.invoked_with} [khu_vực] ngày/tháng (ví dụ: 25/3).")
+            return
+
+        async def build_history():
+            visits_on_day = await zone_visits_on(target_date, zone_key)
+            visits_by_zone = {key: [] for key in zone_keys}
+            for entry in member_registry:
+                for key in zone_keys:
+                    daily_visits = [visit for visit in visits_on_day.get(entry.key, []) if visit.zone == key]
+                    if daily_visits:
+                        visits_by_zone[key].append((entry.display_name, daily_visits))
+            return visits_by_zone
+
+        if MULTI_PROCESS:
+            # Lịch sử đọc từ bot.db, nơi các tiến trình khác cũng ghi mà bộ đếm của tiến trình này không thấy: không dùng cache
+            visits_by_zone = await build_history()
+        else:
+            visits_by_zone = await query_cache.get_async(("zone", zone_key, target_date.isoformat()), ("roster", "zones"), build_history)
+
+        def history(key):
+            # Lượt chưa kết thúc được tính tới current_time, nên luôn định dạng lại
+            for display_name, daily_visits in visits_by_zone[key]:
+                yield f"- {display_name}:"
+                for visit in daily_visits:
+                    yield format_visit(visit, current_time)
+
+        def lines():
+            for index, key in enumerate(zone_keys):
+                zone_name = zone_index.name_of(key)
+                if index:
+                    yield ""
+                yield from report_lines(f"📍 **Hoạt động tại {zone_name} ngày {target_date.strftime('%d/%m/%Y')}**:",
+                                        history(key), f"Không có ai vào {zone_name} ngày này.")
+
+        await send_report(ctx.send, lines(), max_pages=REPORT_MAX_PAGES,
+                          filename=f"{zone_key or 'zones'}_{target_date.isoformat()}.txt")
+        return
+
+    def build_current():
+        in_zones = {key: [] for key in zone_keys}
+        for entry in member_registry:
+            state = activity_data.get(entry.key)
+            if state and state.zone in in_zones:
+                in_zones[state.zone].append((entry.display_name, from_epoch(state.zone_start)))
+        return in_zones
+
+    in_zones = query_cache.get(("zone", zone_key), ("roster", "zones"), build_current)
+
+    def body(key):
+        for display_name, start_time in in_zones[key]:
+            yield f"- {display_name}: {format_minutes((current_time - start_time).total_seconds() / 60)}"
+
+    def lines():
+        for index, key in enumerate(zone_keys):
+            zone_name = zone_index.name_of(key)
+            if index:
+                yield ""
+            yield from report_lines(f"📍 **Danh sách người chơi đang ở {zone_name}**:", body(key), f"Không có ai đang ở {zone_name}.")
+
+    await send_report(ctx.send, lines(), max_pages=REPORT_MAX_PAGES, filename=f"{zone_key or 'zones'}.txt")
+
+def format_seconds(seconds):
+    return "∞" if seconds == float("inf") else f"{seconds * 1000:g} ms"
+
+def format_bytes(nbytes):
+    for unit in ("B", "KB", "MB"):
+        if nbytes < 1024:
+            return f"{nbytes:.0f} {unit}"
+        nbytes /= 1024
+    return f"{nbytes:.1f} GB"
+
+def latency_summary(name, limit=8):
+    """One line per label, busiest first: call count and the p50 / p99 bucket bounds."""
+    rows = sorted(metrics.histograms(name).items(), key=lambda item: -item[1].count)[:limit]
+    lines = [f"{label}: {h.count} lần, {format_seconds(h.quantile(0.5))} / {format_seconds(h.quantile(0.99))}" for (label,), h in rows]
+    return "\n".join(lines) or "Chưa có"
 
 @bot.command()
 async def checkstatus(ctx):
@@ -787,6 +1479,18 @@ async def checkstatus(ctx):
     embed.add_field(name="Thời gian hoạt động", value=f"{int(uptime.total_seconds() // 3600)}h {int((uptime.total_seconds() % 3600) // 60)}m", inline=False)
     embed.add_field(name="Số server", value=str(len(bot.guilds)), inline=True)
     embed.add_field(name="Số người dùng", value=str(sum(guild.member_count for guild in bot.guilds)), inline=True)
+    embed.add_field(name="Độ trễ Discord", value=f"{bot.latency * 1000:.0f} ms", inline=True)
+    embed.add_field(name="Trễ event loop", value=f"hiện tại {loop_lag_monitor.last * 1000:.1f} ms, cao nhất {loop_lag_monitor.max * 1000:.1f} ms", inline=False)
+    embed.add_field(name="Xử lý sự kiện (p50 / p99)", value=latency_summary("handler_seconds"), inline=False)
+    embed.add_field(name="Lệnh (p50 / p99)", value=latency_summary("command_seconds"), inline=False)
+    saves = metrics.histograms("save_seconds")
+    save_lines = [f"{file}: {h.count} lần, {format_bytes(metrics.counter('save_bytes_total', file=file))}, p99 {format_seconds(h.quantile(0.99))}"
+                  for (file,), h in sorted(saves.items())]
+    embed.add_field(name="Ghi file", value="\n".join(save_lines) or "Chưa có", inline=False)
+    sends = metrics.histograms("discord_send_seconds").get(())
+    embed.add_field(name="Gửi thông báo", value=f"{outbound.sent} tin, p99 {format_seconds(sends.quantile(0.99) if sends else 0)}, "
+                                                 f"{outbound.rate_limited} lần 429, {outbound.pending()} đang chờ", inline=False)
+    embed.add_field(name="Trạng thái trong bộ nhớ", value=", ".join(f"{kind}: {size}" for kind, size in state_sizes().items()), inline=False)
     embed.set_footer(text=f"Thời gian hiện tại: {current_time.strftime('%H:%M:%S %Y-%m-%d')}")
     await ctx.send(embed=embed)
 
@@ -800,15 +1504,100 @@ async def playtime(ctx, member: discord.Member = None):
         return
     target = member or ctx.author
     user_id = str(target.id)
-    if user_id not in playtime_data or "daily_online" not in playtime_data[user_id]:
+    # None nếu người này chưa có dữ liệu on-duty
+    stored_minutes = await stored_playtime(user_id)
+    if stored_minutes is None:
         await ctx.send(f"{target.display_name} chưa có dữ liệu on-duty.")
         return
-    total_minutes = sum(playtime_data[user_id]["daily_online"].values())
+    # Tính cả phần của phiên đang on-duty chưa được cộng vào playtime
+    live_minutes = sum(open_session_days(user_id, datetime.now(VN_TIMEZONE)).values())
+    total_minutes = stored_minutes + live_minutes
     total_hours = int(total_minutes // 60)
     total_mins = int(total_minutes % 60)
     report = f"⏱ **Tổng thời gian on-duty của {target.display_name}**:\n- Tổng cộng: {total_hours}h {total_mins}m\n"
+    if live_minutes:
+        report += f"- Trong đó phiên đang on-duty: {format_minutes(live_minutes)}\n"
     await ctx.send(report)
 
+@bot.command(name="analytics")
+async def staffing(ctx, weeks: int = 4):
+    if not ctx.guild:
+        await ctx.send("Lệnh !analytics chỉ có thể được sử dụng trong server.")
+        return
+    if not has_admin_role(ctx.author):
+        await ctx.send(f"{ctx.author.mention}, chỉ admin mới có thể sử dụng lệnh này!")
+        return
+    if analytics.np is None:
+        await ctx.send("Bot chưa cài NumPy nên không thể thống kê (pip install numpy).")
+        return
+    if not 1 <= weeks <= 52:
+        await ctx.send("Số tuần phải từ 1 đến 52.")
+        return
+    current_time = datetime.now(VN_TIMEZONE)
+    if MULTI_PROCESS:
+        await store.flush()
+        raw_intervals = await asyncio.to_thread(sqlite_storage.load_duty_intervals)
+        online_times = await asyncio.to_thread(sqlite_storage.load_online_times)
+        intervals = {user_id: [(to_epoch(start), to_epoch(end)) for start, end in pairs] for user_id, pairs in raw_intervals.items()}
+        open_sessions = {user_id: to_epoch(start) for user_id, start in online_times.items()}
+    else:
+        intervals = {user_id: list(zip(user_intervals.starts, user_intervals.ends)) for user_id, user_intervals in duty_intervals.users.items()}
+        open_sessions = {user_id: session.start for user_id, session in duty_sessions.items()}
+    names = dict(await report_members())
+    files = await asyncio.to_thread(analytics.report, intervals, open_sessions, names, current_time, weeks, VN_TIMEZONE)
+    await ctx.send(f"📈 **Thống kê on-duty {weeks} tuần gần nhất**: số người on-duty theo giờ trong tuần, các khung giờ thiếu người và điểm đều đặn của từng người.",
+                   files=[discord.File(io.BytesIO(text.encode("utf-8")), filename=filename) for filename, text in files.items()])
+
+@bot.command(name="export")
+async def export_history(ctx, date_range: str, members: commands.Greedy[discord.Member], fmt: str = "csv"):
+    if not ctx.guild:
+        await ctx.send("Lệnh !export chỉ có thể được sử dụng trong server.")
+        return
+    if not has_admin_role(ctx.author):
+        await ctx.send(f"{ctx.author.mention}, chỉ admin mới có thể sử dụng lệnh này!")
+        return
+    current_time = datetime.now(VN_TIMEZONE)
+    try:
+        start_date_str, _, end_date_str = date_range.partition("-")
+        start_day, start_month = map(int, start_date_str.split("/"))
+        end_day, end_month = map(int, (end_date_str or start_date_str).split("/"))
+        start_date = date(current_time.year, start_month, start_day)
+        end_date = date(current_time.year, end_month, end_day)
+    except ValueError:
+        start_date = end_date = None
+    if start_date is None or fmt not in export.FORMATS:
+        await ctx.send("Định dạng: !export ngày/tháng-ngày/tháng [@tag ...] [csv|jsonl] (ví dụ: !export 1/9-30/9 @tag csv).")
+        return
+    if start_date > end_date:
+        await ctx.send("Ngày bắt đầu phải nhỏ hơn hoặc bằng ngày kết thúc.")
+        return
+    user_ids = [str(member.id) for member in members] or None
+    names = dict(await report_members())
+    spool = tempfile.SpooledTemporaryFile(max_size=ATTACHMENT_SPOOL_SIZE)
+    with spool:
+        if sqlite_storage:
+            # Đọc bằng kết nối riêng trong luồng phụ, theo từng lô dòng
+            await store.flush()
+            rows = export.records(export.SqliteExportSource(sqlite_storage), start_date, end_date, VN_TIMEZONE, user_ids, names, now=current_time)
+            written = await asyncio.to_thread(export.write_chunks, export.chunks(rows, fmt), spool)
+        else:
+            open_sessions = {user_id: credited_from(user_id, session.start) for user_id, session in duty_sessions.items()}
+            archived = await asyncio.to_thread(export.read_archived, zone_visits, start_date, end_date)
+            source = export.MemoryExportSource(playtime_data, duty_intervals, open_sessions, zone_visits, archived)
+            rows = export.records(source, start_date, end_date, VN_TIMEZONE, user_ids, names, now=current_time)
+            # Dữ liệu nằm trong bộ nhớ của event loop: ghi từng khối rồi nhường cho các sự kiện khác
+            written = 0
+            for chunk in export.chunks(rows, fmt):
+                written += export.write_chunks([chunk], spool)
+                await asyncio.sleep(0)
+        if written > EXPORT_MAX_BYTES:
+            await ctx.send(f"File xuất ra quá lớn ({format_bytes(written)}), hãy chọn khoảng ngắn hơn hoặc dùng `python export.py` trên máy chủ.")
+            return
+        spool.seek(0)
+        filename = f"export_{start_date.isoformat()}_{end_date.isoformat()}.{fmt}"
+        await ctx.send(f"📤 **Dữ liệu on-duty từ {start_date.strftime('%d/%m/%Y')} đến {end_date.strftime('%d/%m/%Y')}** ({format_bytes(written)}).",
+                       file=discord.File(spool, filename=filename))
+
 @bot.command()
 async def lichsu(ctx, member: discord.Member = None):
     if not ctx.guild:
@@ -819,20 +1608,22 @@ async def lichsu(ctx, member: discord.Member = None):
         return
     target = member or ctx.author
     user_id = str(target.id)
-    if user_id not in playtime_data or "daily_online" not in playtime_data[user_id]:
+    if await stored_playtime(user_id) is None:
         await ctx.send(f"{target.display_name} chưa có dữ liệu on-duty.")
         return
     report = f"📜 **Lịch sử on-duty của {target.display_name} (7 ngày gần nhất)**:\n"
     current_time = datetime.now(VN_TIMEZONE)
     seven_days_ago = current_time - timedelta(days=7)
     total_minutes = 0
-    for date_str, minutes in playtime_data[user_id]["daily_online"].items():
-        date_obj = datetime.fromisoformat(date_str).date()
-        if date_obj >= seven_days_ago.date():
-            hours = int(minutes // 60)
-            mins = int(minutes % 60)
-            report += f"- {date_obj.strftime('%d/%m/%Y')}: {hours}h {mins}m\n"
-            total_minutes += minutes
+    history = dict((await daily_online_between(seven_days_ago.date(), date.max, user_id)).get(user_id, []))
+    for date_str, minutes in open_session_days(user_id, current_time).items():
+        history[date_str] = history.get(date_str, 0) + minutes
+    for date_str, minutes in sorted(history.items()):
+        date_obj = date.fromisoformat(date_str)
+        hours = int(minutes // 60)
+        mins = int(minutes % 60)
+        report += f"- {date_obj.strftime('%d/%m/%Y')}: {hours}h {mins}m\n"
+        total_minutes += minutes
     total_hours = int(total_minutes // 60)
     total_mins = int(total_minutes % 60)
     report += f"**Tổng cộng**: {total_hours}h {total_mins}m\n"
@@ -892,21 +1683,41 @@ async def time(ctx, action: str, member: discord.Member, time_str: str):
         await ctx.send("Thời gian phải lớn hơn 0.")
         return
     user_id = str(member.id)
+    if MULTI_PROCESS and await register_members([member]):
+        await save_user_mapping(user_mapping)
+    if not owns_user(user_id):
+        # Tiến trình sở hữu người này ghi đè daily_online bằng tổng trong bộ nhớ của nó, nên không sửa được từ đây
+        await ctx.send(owned_elsewhere_message(member.display_name))
+        return
     current_time = datetime.now(VN_TIMEZONE)
     current_date_str = current_time.date().isoformat()
-    if user_id not in playtime_data:
-        playtime_data[user_id] = {"daily_online": {}}
-    playtime_data[user_id]["daily_online"].setdefault(current_date_str, 0)
     if action.lower() == "add":
-        playtime_data[user_id]["daily_online"][current_date_str] += total_minutes
+        delta_minutes = total_minutes
         action_str = "thêm"
     else:
-        playtime_data[user_id]["daily_online"][current_date_str] = max(0, playtime_data[user_id]["daily_online"][current_date_str] - total_minutes)
+        delta_minutes = -total_minutes
         action_str = "trừ"
-    await save_playtime_data(playtime_data, notify_changes=True)
+    await state_actor.run(user_id, adjust_daily_online, user_id, current_date_str, delta_minutes, str(ctx.author.id))
     hours = int(total_minutes // 60)
     mins = int(total_minutes % 60)
     time_display = f"{hours}h {mins}m" if hours > 0 else f"{mins}m"
     await ctx.send(f"Đã {action_str} {time_display} vào thời gian on-duty của {member.display_name} trong file playtime.json cho ngày {current_date_str}.")
 
-bot.run("Token")
+async def install_signal_handlers():
+    """setup_hook: close the bot on SIGTERM (docker stop, systemctl stop) like on Ctrl+C, so the final flush below runs."""
+    loop = asyncio.get_running_loop()
+    try:
+        loop.add_signal_handler(signal.SIGTERM, lambda: loop.create_task(bot.close()))
+    except NotImplementedError:
+        # Windows không hỗ trợ add_signal_handler
+        pass
+
+bot.setup_hook = install_signal_handlers
+
+if __name__ == "__main__":
+    bot.run("Token")
+    # Ghi nốt những thay đổi còn trong hàng đợi trước khi thoát
+    if event_log:
+        event_log.snapshot(state_snapshot())
+        event_log.store.flush_sync()
+    store.flush_sync()
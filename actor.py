@@ -0,0 +1,64 @@
+import asyncio
+import contextvars
+import time
+
+from metrics import metrics
+
+# Shard mà tác vụ hiện tại đang chạy bên trong (None nếu không nằm trong worker nào)
+_current_shard = contextvars.ContextVar("state_actor_shard", default=None)
+
+
+class StateActor:
+    """Single writer for per-user state, sharded by user id.
+
+    run(user_id, func, *args) queues the coroutine function on the shard the
+    user id maps to and returns its result (or raises its exception). Each
+    shard has one worker that awaits jobs one at a time in submission order,
+    so two jobs for the same user never interleave at an await, while the
+    shards of unrelated users run concurrently. A job that calls run() for
+    its own shard is executed inline instead of queued, which would deadlock.
+
+    Jobs should only touch state and queue saves/notifications; replies to
+    the user are sent by the caller once run() returns.
+    """
+
+    def __init__(self, shards=16):
+        self.shards = shards
+        self._queues = [None] * shards
+        self._workers = [None] * shards
+
+    def shard_of(self, user_id):
+        return int(user_id) % self.shards
+
+    async def run(self, user_id, func, *args):
+        shard = self.shard_of(user_id)
+        if _current_shard.get() == shard:
+            return await func(*args)
+        queue = self._queues[shard]
+        if queue is None:
+            queue = self._queues[shard] = asyncio.Queue()
+        worker = self._workers[shard]
+        if worker is None or worker.done():
+            self._workers[shard] = asyncio.get_running_loop().create_task(self._work(shard, queue))
+        future = asyncio.get_running_loop().create_future()
+        queue.put_nowait((func, args, future, time.perf_counter()))
+        return await future
+
+    async def _work(self, shard, queue):
+        _current_shard.set(shard)
+        while True:
+            func, args, future, queued_at = await queue.get()
+            metrics.observe("actor_wait_seconds", time.perf_counter() - queued_at)
+            try:
+                result = await func(*args)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+                else:
+                    print(f"Lỗi trong {func.__name__}: {e}")
+            else:
+                if not future.done():
+                    future.set_result(result)
+
+    def pending(self):
+        return sum(queue.qsize() for queue in self._queues if queue is not None)
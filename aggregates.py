@@ -0,0 +1,90 @@
+from bisect import bisect_left, bisect_right
+from datetime import date, timedelta
+
+
+def week_key(date_str):
+    """Monday of the ISO week, the key already used by weekly_online in playtime.json."""
+    day = date.fromisoformat(date_str)
+    return (day - timedelta(days=day.weekday())).isoformat()
+
+
+class UserAggregate:
+    """Daily on-duty minutes of one user as a date-ordered array, with a running total and a weekly rollup.
+
+    Updating a day is O(1) apart from inserting a new date (an append for
+    the most recent day, the common case); the total is O(1) and a date
+    range is found in O(log n).
+    """
+
+    __slots__ = ("dates", "minutes", "total_minutes", "weekly")
+
+    def __init__(self):
+        self.dates = []
+        self.minutes = []
+        self.total_minutes = 0
+        self.weekly = {}
+
+    def set(self, date_str, minutes):
+        index = bisect_left(self.dates, date_str)
+        if index < len(self.dates) and self.dates[index] == date_str:
+            delta = minutes - self.minutes[index]
+            self.minutes[index] = minutes
+        else:
+            delta = minutes
+            self.dates.insert(index, date_str)
+            self.minutes.insert(index, minutes)
+        if delta:
+            self.total_minutes += delta
+            week = week_key(date_str)
+            self.weekly[week] = self.weekly.get(week, 0) + delta
+
+    def total(self):
+        return self.total_minutes
+
+    def _bounds(self, start_date_str, end_date_str):
+        return bisect_left(self.dates, start_date_str), bisect_right(self.dates, end_date_str)
+
+    def days_between(self, start_date_str, end_date_str):
+        lo, hi = self._bounds(start_date_str, end_date_str)
+        return list(zip(self.dates[lo:hi], self.minutes[lo:hi]))
+
+
+class PlaytimeAggregates:
+    """Per-user UserAggregate, kept in step with every daily_online change."""
+
+    def __init__(self):
+        self.users = {}
+
+    def load(self, playtime_data):
+        self.users = {}
+        for user_id, user_data in playtime_data.items():
+            aggregate = self.users[user_id] = UserAggregate()
+            for date_str in sorted(user_data.get("daily_online", {})):
+                aggregate.dates.append(date_str)
+                minutes = user_data["daily_online"][date_str]
+                aggregate.minutes.append(minutes)
+                aggregate.total_minutes += minutes
+                week = week_key(date_str)
+                aggregate.weekly[week] = aggregate.weekly.get(week, 0) + minutes
+
+    def set(self, user_id, date_str, minutes):
+        aggregate = self.users.get(user_id)
+        if aggregate is None:
+            aggregate = self.users[user_id] = UserAggregate()
+        aggregate.set(date_str, minutes)
+        return aggregate
+
+    def total(self, user_id):
+        aggregate = self.users.get(user_id)
+        return aggregate.total() if aggregate else 0
+
+    def days_between(self, start_date_str, end_date_str, user_id=None):
+        """{user_id: [(date_str, minutes), ...]} for days in the range, oldest first."""
+        users = [user_id] if user_id is not None else list(self.users)
+        result = {}
+        for uid in users:
+            aggregate = self.users.get(uid)
+            days = aggregate.days_between(start_date_str, end_date_str) if aggregate else []
+            if days:
+                result[uid] = days
+        return result
@@ -0,0 +1,215 @@
+"""Staffing analytics over the raw duty intervals: hour-of-week heatmap, coverage gaps, consistency scores.
+
+Usage: python analytics.py [--dir .] [--db bot.db] [--weeks 4] [--min-staff 1] [--out .]
+Writes heatmap.csv, gaps.csv and consistency.csv. Needs NumPy (pip install numpy);
+the bot's !analytics command uses the same functions.
+
+Only time recorded as intervals (duty_intervals.json / the duty_intervals
+table) is covered; older days that only exist as daily_online totals are not.
+"""
+import argparse
+import csv
+import io
+import json
+import os
+from datetime import datetime
+
+import pytz
+
+from records import to_epoch
+from sqlite_storage import SqliteStorage
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+HOUR = 3600
+DAY = 24 * HOUR
+WEEK = 7 * DAY
+WEEKDAY_NAMES = ["Thứ 2", "Thứ 3", "Thứ 4", "Thứ 5", "Thứ 6", "Thứ 7", "Chủ nhật"]
+
+
+class DutyArrays:
+    """Every duty interval of the period as parallel int64 arrays (user index, start, end), built once."""
+
+    def __init__(self, user_ids, users, starts, ends, period_start, period_end, utc_offset):
+        self.user_ids = user_ids
+        self.users = users
+        self.starts = starts
+        self.ends = ends
+        self.period_start = period_start
+        self.period_end = period_end
+        self.utc_offset = utc_offset
+
+    @classmethod
+    def build(cls, intervals, open_sessions, period_start, period_end, utc_offset):
+        """intervals: {user_id: [(start, end), ...]} epoch seconds; open_sessions: {user_id: start}, counted up to period_end
+        from the end of the user's last interval (the part of the session already credited is an interval itself).
+
+        Intervals are clipped to [period_start, period_end); utc_offset (seconds) places the local hour/day boundaries.
+        """
+        user_ids = sorted(set(intervals) | set(open_sessions))
+        index = {user_id: i for i, user_id in enumerate(user_ids)}
+        users, starts, ends = [], [], []
+        for user_id, pairs in intervals.items():
+            for start, end in pairs:
+                users.append(index[user_id])
+                starts.append(start)
+                ends.append(end)
+        for user_id, start in open_sessions.items():
+            users.append(index[user_id])
+            starts.append(max([start] + [end for _, end in intervals.get(user_id, [])]))
+            ends.append(period_end)
+        starts = np.clip(np.asarray(starts, dtype=np.int64), period_start, period_end)
+        ends = np.clip(np.asarray(ends, dtype=np.int64), period_start, period_end)
+        keep = ends > starts
+        return cls(user_ids, np.asarray(users, dtype=np.int64)[keep], starts[keep], ends[keep],
+                   period_start, period_end, utc_offset)
+
+    def bin_seconds(self, width, origin=None):
+        """Split every interval over consecutive bins of `width` seconds starting at origin.
+
+        origin defaults to the local width boundary at or before period_start. Returns
+        (interval index, bin index, seconds) arrays and the origin used.
+        """
+        if origin is None:
+            origin = self.period_start - (self.period_start + self.utc_offset) % width
+        first = (self.starts - origin) // width
+        last = (self.ends - 1 - origin) // width
+        spans = last - first + 1
+        interval = np.repeat(np.arange(len(self.starts)), spans)
+        # Chỉ số bin của từng cặp (khoảng, bin): bin đầu của khoảng + thứ tự trong khoảng
+        offsets = np.arange(spans.sum()) - np.repeat(np.cumsum(spans) - spans, spans)
+        bins = first[interval] + offsets
+        bin_start = origin + bins * width
+        seconds = np.minimum(self.ends[interval], bin_start + width) - np.maximum(self.starts[interval], bin_start)
+        return interval, bins, seconds, origin
+
+    def hourly_headcount(self):
+        """(hour start epochs, average number of people on duty during each local hour of the period)."""
+        interval, bins, seconds, origin = self.bin_seconds(HOUR)
+        count = int((self.period_end - origin + HOUR - 1) // HOUR)
+        staffed = np.bincount(bins, weights=seconds, minlength=count)[:count]
+        return origin + np.arange(count, dtype=np.int64) * HOUR, staffed / HOUR
+
+
+def heatmap(arrays):
+    """7x24 array (Monday first) of the average on-duty headcount per local hour of the week."""
+    hours, headcount = arrays.hourly_headcount()
+    local = hours + arrays.utc_offset
+    # 1970-01-01 là thứ Năm: +3 ngày để thứ Hai là 0
+    slot = ((local // DAY + 3) % 7) * 24 + (local % DAY) // HOUR
+    totals = np.bincount(slot, weights=headcount, minlength=168)
+    samples = np.bincount(slot, minlength=168)
+    return np.divide(totals, samples, out=np.zeros(168), where=samples > 0).reshape(7, 24)
+
+
+def coverage_gaps(arrays, min_staff=1.0):
+    """[(start epoch, end epoch, lowest headcount)] of the runs of hours averaging fewer than min_staff people."""
+    hours, headcount = arrays.hourly_headcount()
+    below = np.concatenate(([False], headcount < min_staff, [False]))
+    edges = np.flatnonzero(np.diff(below.astype(np.int8)))
+    gaps = []
+    for run_start, run_end in zip(edges[::2], edges[1::2]):
+        gaps.append((int(hours[run_start]), int(hours[run_end - 1] + HOUR), float(headcount[run_start:run_end].min())))
+    return gaps
+
+
+def consistency(arrays):
+    """{user_id: (score 0-100, active week share, mean weekly minutes, weekly stdev)}.
+
+    Score = share of weeks with any duty / (1 + coefficient of variation of weekly minutes):
+    someone on duty a steady amount every week scores 100.
+    """
+    # Tuần ở đây là các khối 7 ngày tính từ đầu kỳ, không theo thứ Hai
+    interval, bins, seconds, origin = arrays.bin_seconds(WEEK, origin=arrays.period_start)
+    weeks = int((arrays.period_end - origin + WEEK - 1) // WEEK)
+    minutes = np.zeros((len(arrays.user_ids), weeks))
+    np.add.at(minutes, (arrays.users[interval], bins), seconds / 60)
+    mean = minutes.mean(axis=1)
+    stdev = minutes.std(axis=1)
+    active = (minutes > 0).mean(axis=1)
+    cv = np.divide(stdev, mean, out=np.zeros_like(mean), where=mean > 0)
+    score = 100 * active / (1 + cv)
+    return {user_id: (float(score[i]), float(active[i]), float(mean[i]), float(stdev[i]))
+            for i, user_id in enumerate(arrays.user_ids)}
+
+
+# --- Xuất CSV ---
+
+def heatmap_csv(grid):
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(["ngày"] + [f"{hour:02d}:00" for hour in range(24)])
+    for day_index, row in enumerate(grid):
+        writer.writerow([WEEKDAY_NAMES[day_index]] + [f"{value:.2f}" for value in row])
+    return out.getvalue()
+
+
+def gaps_csv(gaps, tz):
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(["bắt đầu", "kết thúc", "số giờ", "số người thấp nhất"])
+    for start, end, lowest in gaps:
+        writer.writerow([datetime.fromtimestamp(start, tz).strftime("%Y-%m-%d %H:%M"),
+                         datetime.fromtimestamp(end, tz).strftime("%Y-%m-%d %H:%M"), (end - start) // HOUR, f"{lowest:.2f}"])
+    return out.getvalue()
+
+
+def consistency_csv(scores, names):
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(["user_id", "tên", "điểm", "tỉ lệ tuần có on-duty", "phút trung bình/tuần", "độ lệch chuẩn"])
+    for user_id, (score, active, mean, stdev) in sorted(scores.items(), key=lambda item: -item[1][0]):
+        writer.writerow([user_id, names.get(user_id, user_id), f"{score:.1f}", f"{active:.2f}", f"{mean:.0f}", f"{stdev:.0f}"])
+    return out.getvalue()
+
+
+def report(intervals, open_sessions, names, now, weeks, tz, min_staff=1.0):
+    """{filename: CSV text} for the last `weeks` weeks up to now (a tz-aware datetime)."""
+    period_end = int(now.timestamp())
+    arrays = DutyArrays.build(intervals, open_sessions, period_end - weeks * WEEK, period_end, int(now.utcoffset().total_seconds()))
+    return {
+        "heatmap.csv": heatmap_csv(heatmap(arrays)),
+        "gaps.csv": gaps_csv(coverage_gaps(arrays, min_staff), tz),
+        "consistency.csv": consistency_csv(consistency(arrays), names),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Thống kê nhân sự on-duty từ các khoảng on-duty đã lưu.")
+    parser.add_argument("--dir", default=".", help="thư mục chứa các file JSON")
+    parser.add_argument("--db", help="đọc từ file SQLite thay vì JSON")
+    parser.add_argument("--weeks", type=int, default=4, help="số tuần gần nhất")
+    parser.add_argument("--min-staff", type=float, default=1.0, help="giờ có ít người on-duty hơn mức này là thiếu người")
+    parser.add_argument("--out", default=".", help="thư mục ghi các file CSV")
+    args = parser.parse_args()
+    if np is None:
+        raise SystemExit("Cần cài NumPy: pip install numpy")
+
+    tz = pytz.timezone("Asia/Ho_Chi_Minh")
+    if args.db:
+        storage = SqliteStorage(args.db)
+        raw_intervals, online_times, names = storage.load_duty_intervals(), storage.load_online_times(), storage.member_names()
+        storage.close()
+    else:
+        def load_json(name):
+            path = os.path.join(args.dir, name)
+            if not os.path.exists(path):
+                return {}
+            with open(path, "r") as f:
+                return json.load(f)
+        raw_intervals, online_times, names = load_json("duty_intervals.json"), load_json("online_times.json"), {}
+    intervals = {user_id: [(to_epoch(start), to_epoch(end)) for start, end in pairs] for user_id, pairs in raw_intervals.items()}
+    open_sessions = {user_id: to_epoch(start) for user_id, start in online_times.items()}
+    files = report(intervals, open_sessions, names, datetime.now(tz), args.weeks, tz, args.min_staff)
+    os.makedirs(args.out, exist_ok=True)
+    for filename, text in files.items():
+        with open(os.path.join(args.out, filename), "w", newline="", encoding="utf-8") as f:
+            f.write(text)
+        print(f"Đã ghi {os.path.join(args.out, filename)}")
+
+
+if __name__ == "__main__":
+    main()
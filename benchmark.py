@@ -0,0 +1,295 @@
+"""Offline load benchmark: drives the real Bot.py handlers with fake guilds, members and channels.
+
+Usage: python benchmark.py [--members 1000,10000,50000] [--events 20000] [--storage json|sqlite]
+                           [--baseline bench_baseline.json] [--save-baseline] [--tolerance 0.25]
+
+Each scenario imports Bot.py in a fresh temporary directory (nothing touches
+the real data files or the network), registers synthetic members, replays a
+seeded presence stream (online/offline, Vinewood enter/leave, vehicle
+changes) through on_presence_update and !onduty, then times the reconciliation
+loop, save_playtime_data and the report commands. With --baseline, results are
+compared against the stored baseline and the exit code is 1 on a regression.
+"""
+import argparse
+import asyncio
+import copy
+import importlib
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import discord
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+MEMBERS_PER_GUILD = 5000
+ON_DUTY_RATIO = 0.3
+VEHICLES = ["Porsche 911 Turbo S SASD", "2018 Dodge Charger LEO Edition", "Sultan RS", "Bati 801"]
+EVENT_WEIGHTS = {"online": 3, "vinewood_enter": 2, "vinewood_leave": 2, "vehicle_change": 2, "offline": 1}
+# Chỉ số càng thấp càng tốt; riêng throughput_eps càng cao càng tốt
+HIGHER_IS_BETTER = {"throughput_eps"}
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.members = []
+        self._members_by_id = {}
+
+    @property
+    def member_count(self):
+        return len(self.members)
+
+    def add_member(self, member):
+        self.members.append(member)
+        self._members_by_id[member.id] = member
+
+    def get_member(self, user_id):
+        return self._members_by_id.get(user_id)
+
+
+class FakeMember:
+    def __init__(self, user_id, guild, name):
+        self.id = user_id
+        self.guild = guild
+        self.name = name
+        self.display_name = name
+        self.mention = f"<@{user_id}>"
+        self.status = discord.Status.offline
+        self.activities = ()
+
+    def snapshot(self):
+        return copy.copy(self)
+
+
+class FakeChannel:
+    def __init__(self, channel_id):
+        self.id = channel_id
+        self.messages = 0
+        self.bytes = 0
+
+    async def send(self, content=None, file=None, embed=None):
+        self.messages += 1
+        self.bytes += len(content or "")
+
+
+class FakeContext:
+    def __init__(self, guild, author, channel):
+        self.guild = guild
+        self.author = author
+        self.channel = channel
+
+    async def send(self, content=None, **kwargs):
+        await self.channel.send(content, **kwargs)
+
+
+def game_activity(state=None):
+    return discord.Activity(type=discord.ActivityType.playing, name="FiveM - gta5vn.net", state=state, details="gta5vn.net")
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] if ordered else 0.0
+
+
+async def monitor_loop_lag(samples, interval=0.01):
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - start - interval)
+
+
+def build_guilds(member_count):
+    guilds = []
+    members = []
+    for user_index in range(member_count):
+        if user_index % MEMBERS_PER_GUILD == 0:
+            guilds.append(FakeGuild(1_000_000_000_000_000 + len(guilds)))
+        member = FakeMember(2_000_000_000_000_000 + user_index, guilds[-1], f"officer{user_index}")
+        guilds[-1].add_member(member)
+        members.append(member)
+    return guilds, members
+
+
+async def timed(coro):
+    start = time.perf_counter()
+    await coro
+    return (time.perf_counter() - start) * 1000
+
+
+async def apply_event(bot_module, member, kind, rng, channel):
+    before = member.snapshot()
+    if kind == "offline":
+        member.status = discord.Status.offline
+        member.activities = ()
+    else:
+        member.status = discord.Status.online
+        if kind == "online":
+            member.activities = (game_activity("Đang lái xe tại Mirror Park"),)
+        elif kind in ("vinewood_enter", "vehicle_change"):
+            member.activities = (game_activity(f"Vinewood Park Dr bên trong xe {rng.choice(VEHICLES)}"),)
+        else:
+            member.activities = (game_activity("Đang đi bộ tại Sandy Shores"),)
+    await bot_module.on_presence_update(before, member.snapshot())
+    if kind == "online" and str(member.id) not in bot_module.duty_sessions:
+        await bot_module.onduty.callback(FakeContext(member.guild, member, channel))
+
+
+async def run_scenario(member_count, event_count, seed, history_days):
+    rng = random.Random(seed)
+    sys.modules.pop("Bot", None)
+    bot_module = importlib.import_module("Bot")
+    persistence = importlib.import_module("persistence")
+
+    channels = {}
+    bot_module.outbound.get_channel = lambda channel_id: channels.setdefault(channel_id, FakeChannel(channel_id))
+    bot_module.outbound.batch_window = 0
+    command_channel = FakeChannel(0)
+
+    guilds, members = build_guilds(member_count)
+    now = datetime.now(bot_module.VN_TIMEZONE)
+    for member in members:
+        bot_module.register_user(member)
+        for days_ago in range(1, history_days + 1):
+            date_str = (now.date().fromordinal(now.date().toordinal() - days_ago)).isoformat()
+            bot_module.set_daily_online(str(member.id), date_str, rng.randint(0, 600))
+    for member in rng.sample(members, int(member_count * ON_DUTY_RATIO)):
+        member.status = discord.Status.online
+        member.activities = (game_activity(),)
+        bot_module.record_event("on_duty", str(member.id), time=now.isoformat())
+    await bot_module.save_user_mapping(bot_module.user_mapping)
+    await bot_module.save_playtime_data(bot_module.playtime_data)
+    await bot_module.save_online_times(bot_module.duty_sessions)
+    await flush_all(bot_module)
+
+    kinds = list(EVENT_WEIGHTS)
+    weights = list(EVENT_WEIGHTS.values())
+    stream = [(rng.choice(members), rng.choices(kinds, weights)[0]) for _ in range(event_count)]
+    io_before = dict(persistence.io_stats)
+    db_before = sqlite_size(bot_module)
+
+    lag_samples = []
+    monitor = asyncio.get_running_loop().create_task(monitor_loop_lag(lag_samples))
+    latencies = []
+    start = time.perf_counter()
+    for member, kind in stream:
+        event_start = time.perf_counter()
+        await apply_event(bot_module, member, kind, rng, command_channel)
+        latencies.append((time.perf_counter() - event_start) * 1000)
+        await asyncio.sleep(0)
+    # Các cập nhật presence còn chờ gộp thuộc về luồng sự kiện; hàng đợi thông báo gửi qua rate limit thì không
+    await bot_module.presence_gate.flush()
+    elapsed = time.perf_counter() - start
+    await flush_all(bot_module)
+
+    admin = FakeMember(int(bot_module.ADMIN_USER_IDS[0]), guilds[0], "admin")
+    ctx = FakeContext(guilds[0], admin, command_channel)
+    operations = {
+        "check_zone_activity_ms": await timed(bot_module.check_zone_activity.coro()),
+        "save_playtime_data_ms": await timed(bot_module.save_playtime_data(bot_module.playtime_data, notify_changes=True)),
+        "checkduty_ms": await timed(bot_module.checkduty.callback(ctx)),
+        "checkdays_ms": await timed(bot_module.checkdays.callback(ctx, date_range=f"{now.day}/{now.month}")),
+        "daily_report_ms": await timed(bot_module.daily_report(now)),
+    }
+    await flush_all(bot_module)
+    monitor.cancel()
+
+    bytes_written = persistence.io_stats["bytes"] - io_before["bytes"] + max(0, sqlite_size(bot_module) - db_before)
+    result = {
+        "throughput_eps": event_count / elapsed,
+        "p50_ms": percentile(latencies, 0.50),
+        "p99_ms": percentile(latencies, 0.99),
+        "mean_ms": statistics.fmean(latencies),
+        "max_loop_lag_ms": max(lag_samples, default=0.0) * 1000,
+        "bytes_per_event": bytes_written / event_count,
+    }
+    result.update(operations)
+    if bot_module.sqlite_storage:
+        bot_module.sqlite_storage.close()
+    return result
+
+
+async def flush_all(bot_module):
+    await bot_module.presence_gate.flush()
+    await bot_module.outbound.drain()
+    if bot_module.event_log:
+        await bot_module.event_log.store.flush()
+    await bot_module.store.flush()
+
+
+def sqlite_size(bot_module):
+    if not bot_module.sqlite_storage:
+        return 0
+    return sum(os.path.getsize(path) for path in (bot_module.SQLITE_FILE, bot_module.SQLITE_FILE + "-wal") if os.path.exists(path))
+
+
+def compare(results, baseline, tolerance):
+    """Return the list of regressions (scenario, metric, baseline, current)."""
+    regressions = []
+    for scenario, metrics in results.items():
+        for metric, value in metrics.items():
+            base = baseline.get(scenario, {}).get(metric)
+            if not base:
+                continue
+            if metric in HIGHER_IS_BETTER:
+                worse = value < base * (1 - tolerance)
+            else:
+                worse = value > base * (1 + tolerance)
+            if worse:
+                regressions.append((scenario, metric, base, value))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark các handler của bot với gateway giả lập.")
+    parser.add_argument("--members", default="1000,10000,50000", help="số thành viên của từng kịch bản, cách nhau bởi dấu phẩy")
+    parser.add_argument("--events", type=int, default=20000, help="số sự kiện presence mỗi kịch bản")
+    parser.add_argument("--history-days", type=int, default=7, help="số ngày playtime có sẵn của mỗi thành viên")
+    parser.add_argument("--storage", choices=["json", "sqlite"], default="json")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--baseline", default=os.path.join(REPO_DIR, "bench_baseline.json"))
+    parser.add_argument("--save-baseline", action="store_true", help="ghi kết quả lần chạy này làm baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="mức chậm hơn baseline cho phép (0.25 = 25%%)")
+    args = parser.parse_args()
+
+    os.environ["BOT_STORAGE"] = args.storage
+    sys.path.insert(0, REPO_DIR)
+    original_dir = os.getcwd()
+    results = {}
+    for member_count in (int(count) for count in args.members.split(",")):
+        scenario = f"{args.storage}-{member_count}"
+        with tempfile.TemporaryDirectory(prefix="botniap-bench-") as work_dir:
+            os.chdir(work_dir)
+            try:
+                results[scenario] = asyncio.run(run_scenario(member_count, args.events, args.seed, args.history_days))
+            finally:
+                os.chdir(original_dir)
+        print(f"{scenario}:")
+        for metric, value in results[scenario].items():
+            print(f"  {metric}: {value:.3f}")
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, "r") as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=4)
+        print(f"Đã lưu baseline vào {args.baseline}")
+        return
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for scenario, metric, base, value in regressions:
+            print(f"CHẬM HƠN: {scenario} {metric}: {value:.3f} (baseline {base:.3f})")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
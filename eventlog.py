@@ -0,0 +1,121 @@
+import json
+import os
+import time
+
+from persistence import record_write, write_text_atomic
+
+
+class EventLog:
+    """Append-only JSON-lines log of duty events, compacted by periodic snapshots.
+
+    Events are buffered and appended + fsynced in batches by a WriteBehindStore
+    (one fsync per flush window, not per event). `snapshot` stores the full
+    state at the current sequence number and then drops the log lines it
+    covers, so recovery only replays the tail written since.
+    """
+
+    def __init__(self, log_path, snapshot_path, store, snapshot_every=1000):
+        self.log_path = log_path
+        self.snapshot_path = snapshot_path
+        self.store = store
+        self.snapshot_every = snapshot_every
+        self.seq = 0
+        self._buffer = []
+        self._pending_snapshot = None
+        self._since_snapshot = 0
+
+    def recover(self):
+        """Return (snapshot state or None, events logged after that snapshot)."""
+        snapshot = None
+        if os.path.exists(self.snapshot_path):
+            try:
+                with open(self.snapshot_path, "r") as f:
+                    snapshot = json.load(f)
+            except json.JSONDecodeError:
+                print(f"Error loading {self.snapshot_path}: Invalid JSON. Ignoring snapshot.")
+        base_seq = snapshot["seq"] if snapshot else 0
+        events = []
+        for event in self._read_log():
+            if event["seq"] > base_seq:
+                events.append(event)
+        self.seq = max([base_seq] + [event["seq"] for event in events])
+        self._since_snapshot = len(events)
+        return (snapshot["state"] if snapshot else None), events
+
+    def _read_log(self):
+        if not os.path.exists(self.log_path):
+            return []
+        events = []
+        torn = False
+        with open(self.log_path, "r") as f:
+            for line in f:
+                try:
+                    events.append(json.loads(line))
+                except json.JSONDecodeError:
+                    torn = True
+                    break
+        if torn:
+            # Dòng cuối bị ghi dở khi bot bị tắt đột ngột: cắt bỏ để các sự kiện mới không bị nối vào nó
+            print(f"Bỏ qua dòng hỏng cuối {self.log_path}.")
+            write_text_atomic(self.log_path, "".join(json.dumps(event) + "\n" for event in events))
+        return events
+
+    def append(self, event_type, **fields):
+        self.seq += 1
+        event = {"seq": self.seq, "type": event_type, **fields}
+        self._buffer.append(json.dumps(event))
+        self._since_snapshot += 1
+        self._mark_dirty()
+        return event
+
+    def _mark_dirty(self):
+        self.store.mark_dirty(self.log_path, self._take_batch, writer=self._write_batch)
+
+    def _take_batch(self):
+        batch = (self._buffer, self._pending_snapshot)
+        self._buffer, self._pending_snapshot = [], None
+        return batch
+
+    def _write_batch(self, batch):
+        # Log và snapshot đi chung một lượt ghi để thứ tự append/thu gọn luôn đúng
+        lines, snapshot = batch
+        if lines:
+            try:
+                start = time.perf_counter()
+                text = "\n".join(lines) + "\n"
+                with open(self.log_path, "a") as f:
+                    f.write(text)
+                    f.flush()
+                    os.fsync(f.fileno())
+                record_write(self.log_path, len(text.encode("utf-8")), time.perf_counter() - start)
+            except Exception:
+                self._buffer[:0] = lines
+                self._restore_snapshot(snapshot)
+                raise
+        if snapshot:
+            try:
+                self._write_snapshot(snapshot)
+            except Exception:
+                self._restore_snapshot(snapshot)
+                raise
+
+    def _restore_snapshot(self, snapshot):
+        if snapshot and self._pending_snapshot is None:
+            self._pending_snapshot = snapshot
+
+    def needs_snapshot(self):
+        return self._since_snapshot >= self.snapshot_every
+
+    def snapshot(self, state):
+        """Queue a snapshot of state at the current sequence number; the log is compacted once it is written."""
+        seq = self.seq
+        text = json.dumps({"seq": seq, "state": state})
+        self._since_snapshot = 0
+        self._pending_snapshot = (seq, text)
+        self._mark_dirty()
+
+    def _write_snapshot(self, snapshot):
+        seq, text = snapshot
+        write_text_atomic(self.snapshot_path, text)
+        tail = [json.dumps(event) for event in self._read_log() if event["seq"] > seq]
+        write_text_atomic(self.log_path, "".join(line + "\n" for line in tail))
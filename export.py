@@ -0,0 +1,314 @@
+"""Streaming export of daily totals, on-duty sessions and zone visits for a date range, as CSV or JSONL.
+
+Usage: python export.py --from 2026-09-01 --to 2026-09-30 [--format csv|jsonl] [--users id1,id2]
+                        [--kinds daily,sessions,visits] [--dir .] [--db bot.db] [--out export.csv]
+
+Records are produced by generators (one user or one day at a time) and
+written out in chunks of about CHUNK_SIZE characters, so memory use does not
+grow with the length of the range. The bot's !export command uses the same
+pipeline and attaches the file.
+
+Sessions are rebuilt from the credited duty intervals (parts split at
+midnight or by a restore are joined back) and clipped to the range; a
+session still open has no end and is counted up to now.
+"""
+import argparse
+import csv
+import heapq
+import io
+import json
+import os
+from bisect import bisect_left
+from datetime import date, datetime, time, timedelta
+
+import pytz
+
+from intervals import DutyIntervals
+from records import ZoneVisit, to_epoch, to_iso
+from sqlite_storage import SqliteStorage
+from visits import VisitIndex
+
+FIELDS = ["type", "user_id", "name", "date", "start", "end", "minutes", "zone", "vehicle", "unauthorized"]
+KINDS = ("daily", "sessions", "visits")
+FORMATS = ("csv", "jsonl")
+CHUNK_SIZE = 64 * 1024
+
+
+class MemoryExportSource:
+    """Export rows from in-memory state: playtime_data, DutyIntervals, open sessions and a VisitIndex.
+
+    Each user's rows are copied out before they are yielded, so the bot can
+    keep mutating its state between chunks. Archived days are read from
+    their gzip files as they come up unless archived (see read_archived)
+    already holds them, which keeps that blocking I/O off the bot's loop.
+    """
+
+    def __init__(self, playtime_data, duty_intervals, open_sessions, visit_index, archived=None):
+        self.playtime_data = playtime_data
+        self.duty_intervals = duty_intervals
+        # {user_id: epoch start of the part not yet credited}
+        self.open_sessions = open_sessions
+        self.visit_index = visit_index
+        self.archived = archived
+
+    def daily(self, start_date_str, end_date_str, user_ids):
+        """(user_id, date_str, minutes), by user then date."""
+        for user_id in sorted(list(self.playtime_data), key=int):
+            if user_ids is not None and user_id not in user_ids:
+                continue
+            daily_online = self.playtime_data.get(user_id, {}).get("daily_online", {})
+            days = sorted((date_str, minutes) for date_str, minutes in list(daily_online.items())
+                          if start_date_str <= date_str <= end_date_str)
+            for date_str, minutes in days:
+                yield user_id, date_str, minutes
+
+    def intervals(self, period_start, period_end, user_ids):
+        """(user_id, start, end) epoch intervals overlapping the period, by user then start; open sessions have end None."""
+        open_sessions = sorted((int(user_id), start) for user_id, start in list(self.open_sessions.items())
+                               if (user_ids is None or user_id in user_ids) and start < period_end)
+        return merge_open_sessions(self._credited(period_start, period_end, user_ids), open_sessions)
+
+    def _credited(self, period_start, period_end, user_ids):
+        for user_id in sorted(list(self.duty_intervals.users), key=int):
+            if user_ids is not None and user_id not in user_ids:
+                continue
+            intervals = self.duty_intervals.users[user_id]
+            # Khoảng đầu tiên có thể chồng lên đầu kỳ là khoảng ngay trước vị trí chèn period_start
+            lo = max(0, bisect_left(intervals.starts, period_start) - 1)
+            hi = bisect_left(intervals.starts, period_end)
+            for start, end in zip(intervals.starts[lo:hi], intervals.ends[lo:hi]):
+                if end > period_start:
+                    yield int(user_id), start, end
+
+    def visits(self, start_date, end_date, user_ids):
+        """ZoneVisit records started in [start_date, end_date], by day then start."""
+        day = start_date
+        while day <= end_date:
+            day_str = day.isoformat()
+            if day_str in self.visit_index.days:
+                partition = self.visit_index.visits_on(day_str)
+            elif self.archived is not None:
+                partition = self.archived.get(day_str, {})
+            else:
+                partition = self.visit_index.read_archive(day_str)
+            day_visits = [visit for user_id, visits in list(partition.items()) if user_ids is None or user_id in user_ids
+                          for visit in visits]
+            yield from sorted(day_visits, key=lambda visit: (visit.start, visit.user_id))
+            day += timedelta(days=1)
+
+
+def read_archived(visit_index, start_date, end_date):
+    """{day_str: partition} of the archived days in [start_date, end_date] not held in memory (blocking; run in a worker thread)."""
+    archived = {}
+    day = start_date
+    while day <= end_date:
+        day_str = day.isoformat()
+        if day_str not in visit_index.days and visit_index.is_archived(day_str):
+            archived[day_str] = visit_index.read_archive(day_str)
+        day += timedelta(days=1)
+    return archived
+
+
+class SqliteExportSource:
+    """Export rows read from bot.db through SqliteStorage.iter_query (a separate read-only connection)."""
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def daily(self, start_date_str, end_date_str, user_ids):
+        for user_id, date_str, minutes in self.storage.iter_query(
+                "SELECT user_id, date, minutes FROM daily_online WHERE date BETWEEN ? AND ? ORDER BY user_id, date",
+                (start_date_str, end_date_str)):
+            if user_ids is None or str(user_id) in user_ids:
+                yield str(user_id), date_str, minutes
+
+    def intervals(self, period_start, period_end, user_ids):
+        open_sessions = sorted((user_id, to_epoch(start_time)) for user_id, start_time in self.storage.iter_query(
+            "SELECT user_id, start_time FROM sessions WHERE end_time IS NULL")
+            if (user_ids is None or str(user_id) in user_ids) and to_epoch(start_time) < period_end)
+        return merge_open_sessions(self._credited(period_start, period_end, user_ids), open_sessions)
+
+    def _credited(self, period_start, period_end, user_ids):
+        # Thời điểm lưu dạng ISO theo giờ địa phương: lọc thô theo ngày (nới thêm một ngày mỗi bên), lọc chính xác theo epoch
+        lower = (datetime.fromtimestamp(period_start, pytz.utc).date() - timedelta(days=1)).isoformat()
+        upper = (datetime.fromtimestamp(period_end, pytz.utc).date() + timedelta(days=1)).isoformat()
+        for user_id, start_time, end_time in self.storage.iter_query(
+                "SELECT user_id, start_time, end_time FROM duty_intervals WHERE start_time < ? AND end_time > ? "
+                "ORDER BY user_id, start_time", (upper, lower)):
+            if user_ids is not None and str(user_id) not in user_ids:
+                continue
+            start, end = to_epoch(start_time), to_epoch(end_time)
+            if start < period_end and end > period_start:
+                yield user_id, start, end
+
+    def visits(self, start_date, end_date, user_ids):
+        for user_id, start_time, end_time, vehicle, unauthorized, zone in self.storage.iter_query(
+                "SELECT user_id, start_time, end_time, vehicle, unauthorized, zone FROM vinewood_visits "
+                "WHERE start_time >= ? AND start_time < ? ORDER BY start_time",
+                (start_date.isoformat(), (end_date + timedelta(days=1)).isoformat())):
+            if user_ids is None or str(user_id) in user_ids:
+                yield ZoneVisit.from_json(user_id, {"start_time": start_time, "end_time": end_time, "vehicle": vehicle,
+                                                    "unauthorized": bool(unauthorized), "zone": zone})
+
+
+def day_bounds(start_date, end_date, tz):
+    """Epoch seconds of the local midnight starting start_date and of the one after end_date."""
+    start = tz.localize(datetime.combine(start_date, time.min))
+    end = tz.localize(datetime.combine(end_date + timedelta(days=1), time.min))
+    return int(start.timestamp()), int(end.timestamp())
+
+
+def merge_open_sessions(credited, open_sessions):
+    """Merge sorted (user_id, start, end) credited intervals with sorted (user_id, start) open sessions (end None).
+
+    Both are ordered by (int user_id, start); on a tie the credited interval comes first.
+    """
+    return heapq.merge(credited, ((user_id, start, None) for user_id, start in open_sessions),
+                       key=lambda interval: (interval[0], interval[1]))
+
+
+def join_sessions(intervals):
+    """Join consecutive (user_id, start, end) intervals of the same user that touch into sessions.
+
+    An open session (end None) continues from the end of the user's last
+    credited interval if it overlaps it, and absorbs the user's intervals
+    that start after it: the sessions table keeps the original start of a
+    session, whose parts up to the last midnight or restore are already
+    credited.
+    """
+    current = None
+    for user_id, start, end in intervals:
+        if current and current[0] == user_id and current[2] is None:
+            continue
+        if current and current[0] == user_id and current[2] is not None and start <= current[2]:
+            current = (user_id, current[1], None if end is None else max(end, current[2]))
+            continue
+        if current:
+            yield current
+        current = (user_id, start, end)
+    if current:
+        yield current
+
+
+def records(source, start_date, end_date, tz, user_ids=None, names=None, kinds=KINDS, now=None):
+    """Yield one dict per exported row: daily totals, then sessions, then zone visits."""
+    names = names or {}
+    user_ids = set(user_ids) if user_ids else None
+    period_start, period_end = day_bounds(start_date, end_date, tz)
+    now = int((now or datetime.now(tz)).timestamp())
+    if "daily" in kinds:
+        for user_id, date_str, minutes in source.daily(start_date.isoformat(), end_date.isoformat(), user_ids):
+            yield {"type": "daily", "user_id": user_id, "name": names.get(user_id, user_id), "date": date_str,
+                   "minutes": round(minutes, 2)}
+    if "sessions" in kinds:
+        for user_id, start, end in join_sessions(source.intervals(period_start, period_end, user_ids)):
+            user_id = str(user_id)
+            clipped_start = max(start, period_start)
+            clipped_end = min(period_end, now if end is None else end)
+            if clipped_end <= clipped_start:
+                continue
+            yield {"type": "session", "user_id": user_id, "name": names.get(user_id, user_id),
+                   "date": datetime.fromtimestamp(clipped_start, tz).date().isoformat(),
+                   "start": to_iso(clipped_start, tz), "end": None if end is None else to_iso(clipped_end, tz),
+                   "minutes": round((clipped_end - clipped_start) / 60, 2)}
+    if "visits" in kinds:
+        for visit in source.visits(start_date, end_date, user_ids):
+            user_id = str(visit.user_id)
+            yield {"type": "visit", "user_id": user_id, "name": names.get(user_id, user_id),
+                   "date": datetime.fromtimestamp(visit.start, tz).date().isoformat(),
+                   "start": to_iso(visit.start, tz), "end": to_iso(visit.end, tz),
+                   "minutes": round((visit.end - visit.start) / 60, 2) if visit.end is not None else None,
+                   "zone": visit.zone, "vehicle": visit.vehicle, "unauthorized": visit.unauthorized}
+
+
+def csv_chunks(rows, chunk_size=CHUNK_SIZE):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, FIELDS)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= chunk_size:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def jsonl_chunks(rows, chunk_size=CHUNK_SIZE):
+    lines = []
+    size = 0
+    for row in rows:
+        line = json.dumps(row, ensure_ascii=False) + "\n"
+        lines.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            yield "".join(lines)
+            lines = []
+            size = 0
+    if lines:
+        yield "".join(lines)
+
+
+def chunks(rows, fmt, chunk_size=CHUNK_SIZE):
+    return csv_chunks(rows, chunk_size) if fmt == "csv" else jsonl_chunks(rows, chunk_size)
+
+
+def write_chunks(text_chunks, f):
+    """Write the chunks UTF-8 encoded to a binary file object. Returns the number of bytes written."""
+    written = 0
+    for chunk in text_chunks:
+        data = chunk.encode("utf-8")
+        f.write(data)
+        written += len(data)
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Xuất dữ liệu on-duty và lượt vào khu vực ra CSV/JSONL.")
+    parser.add_argument("--from", dest="start", required=True, type=date.fromisoformat, help="ngày bắt đầu (YYYY-MM-DD)")
+    parser.add_argument("--to", dest="end", required=True, type=date.fromisoformat, help="ngày kết thúc (YYYY-MM-DD)")
+    parser.add_argument("--format", choices=FORMATS, default="csv")
+    parser.add_argument("--users", help="các user id cách nhau bởi dấu phẩy (mặc định: tất cả)")
+    parser.add_argument("--kinds", default=",".join(KINDS), help="các loại dữ liệu: daily, sessions, visits")
+    parser.add_argument("--dir", default=".", help="thư mục chứa các file JSON")
+    parser.add_argument("--db", help="đọc từ file SQLite thay vì JSON")
+    parser.add_argument("--out", help="file kết quả (mặc định: export_<từ>_<đến>.<định dạng>)")
+    args = parser.parse_args()
+    if args.start > args.end:
+        raise SystemExit("Ngày bắt đầu phải nhỏ hơn hoặc bằng ngày kết thúc.")
+    kinds = [kind for kind in args.kinds.split(",") if kind]
+    if any(kind not in KINDS for kind in kinds):
+        raise SystemExit(f"--kinds chỉ nhận: {', '.join(KINDS)}")
+
+    tz = pytz.timezone("Asia/Ho_Chi_Minh")
+    storage = None
+    if args.db:
+        storage = SqliteStorage(args.db)
+        source, names = SqliteExportSource(storage), storage.member_names()
+    else:
+        def load_json(name):
+            path = os.path.join(args.dir, name)
+            if not os.path.exists(path):
+                return {}
+            with open(path, "r") as f:
+                return json.load(f)
+        source = MemoryExportSource(
+            load_json("playtime.json"),
+            DutyIntervals.from_json(load_json("duty_intervals.json"), tz),
+            {user_id: to_epoch(start) for user_id, start in load_json("online_times.json").items()},
+            VisitIndex.from_json(load_json("vinewood_activity.json"), tz, os.path.join(args.dir, "vinewood_archive")),
+        )
+        names = {}
+    out = args.out or f"export_{args.start.isoformat()}_{args.end.isoformat()}.{args.format}"
+    user_ids = args.users.split(",") if args.users else None
+    rows = records(source, args.start, args.end, tz, user_ids, names, kinds)
+    with open(out, "wb") as f:
+        written = write_chunks(chunks(rows, args.format), f)
+    if storage:
+        storage.close()
+    print(f"Đã ghi {written} byte vào {out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+from bisect import bisect_right
+from datetime import date, datetime, time, timedelta
+
+from records import to_epoch, to_iso
+
+HOUR = 3600
+
+
+class UserIntervals:
+    """One user's credited on-duty intervals [start, end) in epoch seconds, sorted and non-overlapping."""
+
+    __slots__ = ("starts", "ends", "cache")
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+        # (kỳ, khóa) -> số giây, tính khi được hỏi tới và xóa mỗi khi có khoảng mới
+        self.cache = {}
+
+    def add(self, start, end):
+        """Insert the parts of [start, end) not already covered. Returns the inserted (start, end) pieces."""
+        added = []
+        index = bisect_right(self.starts, start)
+        if index and self.ends[index - 1] > start:
+            start = self.ends[index - 1]
+        while start < end:
+            # Khoảng trống từ start tới khoảng đã có kế tiếp (hoặc tới end)
+            covered = index < len(self.starts) and self.starts[index] < end
+            gap_end = self.starts[index] if covered else end
+            if gap_end > start:
+                self.starts.insert(index, start)
+                self.ends.insert(index, gap_end)
+                added.append((start, gap_end))
+                index += 1
+            if not covered:
+                break
+            start = self.ends[index]
+            index += 1
+        if added:
+            self.cache.clear()
+        return added
+
+    def seconds_between(self, start, end):
+        """On-duty seconds inside [start, end)."""
+        total = 0
+        index = max(0, bisect_right(self.starts, start) - 1)
+        while index < len(self.starts) and self.starts[index] < end:
+            total += max(0, min(end, self.ends[index]) - max(start, self.starts[index]))
+            index += 1
+        return total
+
+    def covers(self, moment):
+        index = bisect_right(self.starts, moment) - 1
+        return index >= 0 and self.ends[index] > moment
+
+
+class DutyIntervals:
+    """Raw on-duty intervals per user, kept alongside the per-day totals in playtime_data.
+
+    Every credited part of a session (off-duty, restore, midnight split) is
+    kept with its real start and end, so sub-day questions such as "who was
+    on duty at 21:00?" can be answered; hour totals are computed on first
+    use and cached. Day and week totals stay in playtime_data, which also
+    holds !time adjustments that have no interval, so the two differ by
+    those adjustments. Open sessions are not stored here; callers pass them
+    in to get live totals.
+    """
+
+    def __init__(self, tz):
+        self.tz = tz
+        self.users = {}
+        self._day_bounds = {}
+        self._dirty = []
+
+    def day_bounds(self, day_str):
+        """Epoch seconds of the local midnight starting day_str and of the next one."""
+        bounds = self._day_bounds.get(day_str)
+        if bounds is None:
+            day = date.fromisoformat(day_str)
+            start = self.tz.localize(datetime.combine(day, time.min))
+            end = self.tz.localize(datetime.combine(day + timedelta(days=1), time.min))
+            bounds = self._day_bounds[day_str] = (int(start.timestamp()), int(end.timestamp()))
+        return bounds
+
+    def day_of(self, epoch):
+        return datetime.fromtimestamp(epoch, self.tz).date().isoformat()
+
+    def split_by_day(self, start, end):
+        """Yield (day_str, seconds) for each local day that [start, end) touches."""
+        day_str = self.day_of(start)
+        while start < end:
+            day_end = self.day_bounds(day_str)[1]
+            yield day_str, min(end, day_end) - start
+            start = day_end
+            day_str = (date.fromisoformat(day_str) + timedelta(days=1)).isoformat()
+
+    def add(self, user_id, start, end):
+        """Record [start, end) for user_id. Returns the (day_str, seconds) split of the parts actually added."""
+        intervals = self.users.get(user_id)
+        if intervals is None:
+            intervals = self.users[user_id] = UserIntervals()
+        split = []
+        for piece_start, piece_end in intervals.add(start, end):
+            self._dirty.append((user_id, piece_start, piece_end))
+            split.extend(self.split_by_day(piece_start, piece_end))
+        return split
+
+    def mark_all_dirty(self):
+        """Queue every interval again (after rebuilding from a snapshot); backends ignore ones they already have."""
+        self._dirty = [(user_id, start, end) for user_id, intervals in self.users.items()
+                       for start, end in zip(intervals.starts, intervals.ends)]
+
+    def take_dirty(self):
+        """(user_id, start, end) intervals added since the last call, for incremental backends."""
+        dirty, self._dirty = self._dirty, []
+        return dirty
+
+    # --- Truy vấn ---
+
+    def _cached(self, user_id, key, start, end):
+        intervals = self.users.get(user_id)
+        if intervals is None:
+            return 0
+        seconds = intervals.cache.get(key)
+        if seconds is None:
+            seconds = intervals.cache[key] = intervals.seconds_between(start, end)
+        return seconds
+
+    def hour_seconds(self, user_id, hour_start, open_start=None, now=None):
+        """Credited seconds in the hour starting at epoch hour_start, plus the overlap of an open session [open_start, now) if given."""
+        hour_start -= hour_start % HOUR
+        seconds = self._cached(user_id, ("hour", hour_start), hour_start, hour_start + HOUR)
+        if open_start is not None:
+            seconds += max(0, min(now, hour_start + HOUR) - max(open_start, hour_start))
+        return seconds
+
+    def on_duty_at(self, moment, open_sessions=None):
+        """User ids on duty at epoch moment; open_sessions is {user_id: start} of the sessions still running."""
+        users = {user_id for user_id, intervals in self.users.items() if intervals.covers(moment)}
+        for user_id, open_start in (open_sessions or {}).items():
+            if open_start <= moment:
+                users.add(user_id)
+        return users
+
+    # --- Lưu trữ ---
+
+    def to_json(self):
+        return {user_id: [[to_iso(start, self.tz), to_iso(end, self.tz)] for start, end in zip(intervals.starts, intervals.ends)]
+                for user_id, intervals in self.users.items()}
+
+    @classmethod
+    def from_json(cls, data, tz):
+        store = cls(tz)
+        for user_id, pairs in data.items():
+            intervals = store.users[user_id] = UserIntervals()
+            for start_time, end_time in sorted(pairs):
+                intervals.add(to_epoch(start_time), to_epoch(end_time))
+        return store
@@ -0,0 +1,84 @@
+class MemberEntry:
+    __slots__ = ("user_id", "key", "guild", "member", "display_name")
+
+    def __init__(self, member):
+        self.user_id = member.id
+        self.key = str(member.id)
+        self.guild = member.guild
+        self.member = member
+        self.display_name = member.display_name
+
+
+class MemberRegistry:
+    """Resolved members of the registered players, keyed by int user id.
+
+    Built once from the guild caches and then kept current from gateway
+    events (member join/remove/update, guild join/remove), so commands and
+    loops never repeat the int()/get_guild/get_member lookups per user.
+    on_change() is called whenever the set of entries or a display name changes.
+    """
+
+    def __init__(self, on_change=None):
+        self._entries = {}
+        self.on_change = on_change or (lambda: None)
+
+    def rebuild(self, guilds, user_mapping):
+        """Resolve every mapped user. Returns the user ids whose guild no longer exists.
+
+        A member only missing from the guild's cache (not chunked yet, or a
+        large guild) is not a departure: it gets no entry until add() is
+        called for one of its gateway events, and stays mapped. Members who
+        really leave are reported by on_member_remove.
+        """
+        self._entries = {}
+        guilds_by_id = {str(guild.id): guild for guild in guilds}
+        missing = []
+        for user_id, user_info in user_mapping.items():
+            guild = guilds_by_id.get(user_info.get("guild_id"))
+            if guild is None:
+                missing.append(user_id)
+                continue
+            member = guild.get_member(int(user_id))
+            if member:
+                self._entries[member.id] = MemberEntry(member)
+        self.on_change()
+        return missing
+
+    def add(self, member):
+        self._entries[member.id] = MemberEntry(member)
+        self.on_change()
+
+    def remove(self, user_id):
+        entry = self._entries.pop(int(user_id), None)
+        if entry:
+            self.on_change()
+        return entry
+
+    def refresh(self, member):
+        """Update the cached display name/member object if the user is registered in this guild."""
+        entry = self._entries.get(member.id)
+        if entry and entry.guild.id == member.guild.id:
+            entry.member = member
+            self._set_display_name(entry, member.display_name)
+
+    def refresh_user(self, user_id):
+        entry = self._entries.get(int(user_id))
+        if entry:
+            self._set_display_name(entry, entry.member.display_name)
+
+    def _set_display_name(self, entry, display_name):
+        if entry.display_name != display_name:
+            entry.display_name = display_name
+            self.on_change()
+
+    def get(self, user_id):
+        return self._entries.get(int(user_id))
+
+    def __contains__(self, user_id):
+        return int(user_id) in self._entries
+
+    def __iter__(self):
+        return iter(list(self._entries.values()))
+
+    def __len__(self):
+        return len(self._entries)
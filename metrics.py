@@ -0,0 +1,219 @@
+import asyncio
+import functools
+import threading
+import time
+
+# Giới hạn trên (giây) của các bucket histogram, giống mặc định của thư viện Prometheus
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Cumulative-bucket latency histogram (Prometheus layout)."""
+
+    __slots__ = ("buckets", "counts", "count", "sum")
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th observation (inf if it is past the last bucket)."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class Metrics:
+    """Process-wide counters, histograms and gauges, rendered in the Prometheus text format.
+
+    observe/inc only touch a dict and a few integers under one lock, so they
+    are cheap enough to call on every event and safe from worker threads.
+    Gauges are callables evaluated at render time, so state sizes cost
+    nothing between scrapes.
+    """
+
+    def __init__(self, prefix="bot"):
+        self.prefix = prefix
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def gauge(self, name, func, label=None):
+        """Register func() as a gauge; with label, func returns {label_value: value}."""
+        self._gauges[name] = (func, label)
+
+    def histograms(self, name):
+        """{label_value_tuple: Histogram} for every label set observed under name."""
+        with self._lock:
+            return {tuple(value for _, value in labels): histogram
+                    for (key_name, labels), histogram in self._histograms.items() if key_name == name}
+
+    def counter(self, name, **labels):
+        return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def timed(self, name, **labels):
+        """Decorator recording the wall time of each call of a coroutine function."""
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    self.observe(name, time.perf_counter() - start, **labels)
+            return wrapper
+        return decorator
+
+    # --- Xuất theo định dạng Prometheus ---
+
+    def _full_name(self, name):
+        return f"{self.prefix}_{name}"
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+        return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + "}"
+
+    def _header(self, lines, name, kind):
+        full_name = self._full_name(name)
+        if name in self._help:
+            lines.append(f"# HELP {full_name} {self._help[name]}")
+        lines.append(f"# TYPE {full_name} {kind}")
+
+    def render(self):
+        with self._lock:
+            histograms = {key: (list(h.counts), h.count, h.sum, h.buckets) for key, h in self._histograms.items()}
+            counters = dict(self._counters)
+        lines = []
+        for name in sorted({name for name, _ in histograms}):
+            self._header(lines, name, "histogram")
+            full_name = self._full_name(name)
+            for (key_name, labels), (counts, count, total, buckets) in sorted(histograms.items()):
+                if key_name != name:
+                    continue
+                cumulative = 0
+                for bound, bucket_count in zip(buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f"{full_name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{full_name}_bucket{self._labels(labels, [('le', '+Inf')])} {count}")
+                lines.append(f"{full_name}_sum{self._labels(labels)} {total}")
+                lines.append(f"{full_name}_count{self._labels(labels)} {count}")
+        for name in sorted({name for name, _ in counters}):
+            self._header(lines, name, "counter")
+            for (key_name, labels), value in sorted(counters.items()):
+                if key_name == name:
+                    lines.append(f"{self._full_name(name)}{self._labels(labels)} {value}")
+        for name, (func, label) in sorted(self._gauges.items()):
+            try:
+                value = func()
+            except Exception as e:
+                print(f"Lỗi khi đọc gauge {name}: {e}")
+                continue
+            self._header(lines, name, "gauge")
+            if label is None:
+                lines.append(f"{self._full_name(name)} {value}")
+            else:
+                for label_value, item in sorted(value.items()):
+                    lines.append(f"{self._full_name(name)}{self._labels([(label, label_value)])} {item}")
+        return "\n".join(lines) + "\n"
+
+
+# Dùng chung cho mọi module (persistence, outbound, Bot.py)
+metrics = Metrics()
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes up a task that sleeps `interval` seconds."""
+
+    def __init__(self, metrics, interval=0.5):
+        self.metrics = metrics
+        self.interval = interval
+        self.last = 0.0
+        self.max = 0.0
+        self._task = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.last = max(0.0, loop.time() - start - self.interval)
+            self.max = max(self.max, self.last)
+            self.metrics.observe("event_loop_lag_seconds", self.last)
+
+
+class MetricsServer:
+    """Minimal HTTP endpoint serving metrics.render() on GET /metrics, for a local Prometheus scraper."""
+
+    def __init__(self, metrics, host="127.0.0.1", port=9108):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self._server = None
+
+    async def start(self):
+        if self._server is not None:
+            return
+        try:
+            self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        except OSError as e:
+            print(f"Không mở được cổng metrics {self.host}:{self.port}: {e}")
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", self.metrics.render().encode("utf-8")
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
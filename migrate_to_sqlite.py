@@ -0,0 +1,59 @@
+"""One-shot import of the legacy JSON state files into the SQLite backend.
+
+Usage: python migrate_to_sqlite.py [--dir .] [--db bot.db]
+Then start the bot with BOT_STORAGE=sqlite.
+"""
+import argparse
+import glob
+import gzip
+import json
+import os
+
+from sqlite_storage import SqliteStorage
+
+
+def load_json(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def load_vinewood(directory):
+    """vinewood_activity.json plus the per-day archives in vinewood_archive/, in the per-day layout."""
+    vinewood = load_json(os.path.join(directory, "vinewood_activity.json"))
+    archives = sorted(glob.glob(os.path.join(directory, "vinewood_archive", "*.json.gz")))
+    if not archives:
+        return vinewood
+    if vinewood and "days" not in vinewood:
+        print("vinewood_activity.json dùng định dạng cũ, chạy bot một lần để chuyển sang định dạng theo ngày trước.")
+        return vinewood
+    days = dict(vinewood.get("days", {}))
+    for path in archives:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            days.setdefault(os.path.basename(path)[:-len(".json.gz")], {}).update(json.load(f))
+    return {"days": days}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chuyển dữ liệu JSON cũ sang SQLite.")
+    parser.add_argument("--dir", default=".", help="thư mục chứa các file JSON")
+    parser.add_argument("--db", default="bot.db", help="đường dẫn file SQLite")
+    args = parser.parse_args()
+
+    storage = SqliteStorage(args.db)
+    counts = storage.import_json(
+        playtime=load_json(os.path.join(args.dir, "playtime.json")),
+        online_times=load_json(os.path.join(args.dir, "online_times.json")),
+        activity=load_json(os.path.join(args.dir, "activity.json")),
+        vinewood=load_vinewood(args.dir),
+        user_mapping=load_json(os.path.join(args.dir, "user_mapping.json")),
+        duty_intervals=load_json(os.path.join(args.dir, "duty_intervals.json")),
+    )
+    storage.close()
+    for table, count in counts.items():
+        print(f"{table}: {count} dòng")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+import asyncio
+import time
+
+import discord
+
+from metrics import metrics
+
+MESSAGE_LIMIT = 2000
+
+
+def split_message(text, limit=MESSAGE_LIMIT):
+    """Split text into chunks of at most limit characters, on line breaks where possible."""
+    chunks = []
+    current = ""
+    for line in text.split("\n"):
+        while len(line) > limit:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(line[:limit])
+            line = line[limit:]
+        if current and len(current) + 1 + len(line) > limit:
+            chunks.append(current)
+            current = line
+        else:
+            current = f"{current}\n{line}" if current else line
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class RateLimitBucket:
+    """Token bucket of `rate` sends per `per` seconds, pausable after a 429."""
+
+    def __init__(self, rate, per):
+        self.rate = rate
+        self.per = per
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.per)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) * self.per / self.rate)
+
+    def block(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class OutboundDispatcher:
+    """Per-channel outbound queues for bot notifications.
+
+    `send` only enqueues and returns. One worker per channel waits
+    `batch_window` seconds, merges everything queued meanwhile into as few
+    messages as fit under the 2,000-character limit and sends them through a
+    per-channel rate-limit bucket, plus one global bucket shared by all channels.
+    """
+
+    def __init__(self, get_channel, batch_window=1.0, channel_rate=5, channel_per=5.0, global_rate=50, global_per=1.0):
+        self.get_channel = get_channel
+        self.batch_window = batch_window
+        self.channel_rate = channel_rate
+        self.channel_per = channel_per
+        self.global_bucket = RateLimitBucket(global_rate, global_per)
+        self._queues = {}
+        self._buckets = {}
+        self._workers = {}
+        self.sent = 0
+        self.rate_limited = 0
+
+    def send(self, channel_id, text):
+        self._queues.setdefault(channel_id, []).append(text)
+        worker = self._workers.get(channel_id)
+        if worker is None or worker.done():
+            self._workers[channel_id] = asyncio.get_running_loop().create_task(self._run(channel_id))
+
+    def pending(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    async def _run(self, channel_id):
+        bucket = self._buckets.setdefault(channel_id, RateLimitBucket(self.channel_rate, self.channel_per))
+        while self._queues.get(channel_id):
+            await asyncio.sleep(self.batch_window)
+            texts = self._queues.pop(channel_id, [])
+            channel = self.get_channel(channel_id)
+            if not channel:
+                print(f"Không tìm thấy kênh với ID {channel_id}, bỏ {len(texts)} tin nhắn.")
+                continue
+            for chunk in split_message("\n".join(texts)):
+                await self._send_chunk(channel, bucket, chunk)
+
+    async def _send_chunk(self, channel, bucket, chunk, retries=3):
+        for _ in range(retries):
+            await bucket.acquire()
+            await self.global_bucket.acquire()
+            start = time.perf_counter()
+            try:
+                await channel.send(chunk)
+                self.sent += 1
+                return
+            except discord.HTTPException as e:
+                if e.status != 429:
+                    metrics.inc("discord_send_errors_total")
+                    print(f"Lỗi khi gửi tin nhắn tới kênh {channel.id}: {e}")
+                    return
+                self.rate_limited += 1
+                metrics.inc("discord_rate_limited_total")
+                bucket.block(getattr(e, "retry_after", None) or self.channel_per)
+            finally:
+                metrics.observe("discord_send_seconds", time.perf_counter() - start)
+        print(f"Bỏ tin nhắn tới kênh {channel.id} sau {retries} lần bị giới hạn tốc độ.")
+
+    async def drain(self):
+        """Wait until every queued message has been sent."""
+        while any(not worker.done() for worker in self._workers.values()):
+            await asyncio.gather(*self._workers.values(), return_exceptions=True)
@@ -0,0 +1,133 @@
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+
+from metrics import metrics
+
+# Số lần ghi file và tổng số byte đã ghi (file JSON, event log), dùng cho benchmark và thống kê
+io_stats = {"writes": 0, "bytes": 0}
+_io_stats_lock = threading.Lock()
+
+
+def record_write(file_path, nbytes, seconds):
+    with _io_stats_lock:
+        io_stats["writes"] += 1
+        io_stats["bytes"] += nbytes
+    metrics.observe("save_seconds", seconds, file=os.path.basename(file_path))
+    metrics.inc("save_bytes_total", nbytes, file=os.path.basename(file_path))
+
+
+def write_text_atomic(file_path, text):
+    """Write text to file_path via a temp file + rename so readers never see a partial file."""
+    start = time.perf_counter()
+    directory = os.path.dirname(os.path.abspath(file_path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(file_path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+            size = os.fstat(f.fileno()).st_size
+        os.replace(tmp_path, file_path)
+        record_write(file_path, size, time.perf_counter() - start)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def write_json_atomic(file_path, data):
+    write_text_atomic(file_path, json.dumps(data, indent=4))
+
+
+def _write_snapshots(snapshots):
+    failed = []
+    for file_path, snapshot, writer in snapshots:
+        try:
+            if writer is None:
+                write_json_atomic(file_path, json.loads(snapshot))
+            else:
+                writer(snapshot)
+        except Exception as e:
+            print(f"Error saving {file_path}: {e}")
+            failed.append(file_path)
+    return failed
+
+
+class WriteBehindStore:
+    """Coalesce repeated saves of the same JSON file into one delayed, off-loop write.
+
+    `mark_dirty` only records that a file changed; the file is written at most
+    once per `delay` seconds, or immediately once `max_pending` changes have
+    piled up. The data is snapshotted on the event loop (compact C encoder) and
+    pretty-printed/written in a worker thread.
+
+    Non-JSON sinks (e.g. the SQLite backend) pass a `writer`: the source is
+    then called on the loop to take a detached snapshot and `writer(snapshot)`
+    runs in the worker thread.
+    """
+
+    def __init__(self, delay=2.0, max_pending=100):
+        self.delay = delay
+        self.max_pending = max_pending
+        self._sources = {}
+        self._writers = {}
+        self._pending = {}
+        self._timer = None
+        self._lock = asyncio.Lock()
+
+    def mark_dirty(self, file_path, source, writer=None):
+        """Record that file_path must be rewritten from source (data or a zero-arg callable)."""
+        self._sources[file_path] = source
+        self._writers[file_path] = writer
+        self._pending[file_path] = self._pending.get(file_path, 0) + 1
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Chưa có event loop (lúc import): sẽ được ghi ở lần flush kế tiếp hoặc khi tắt bot.
+            return
+        if sum(self._pending.values()) >= self.max_pending:
+            self._cancel_timer()
+            loop.create_task(self.flush())
+        elif self._timer is None:
+            self._timer = loop.call_later(self.delay, lambda: loop.create_task(self.flush()))
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _take_snapshots(self):
+        snapshots = []
+        for file_path in list(self._pending):
+            source = self._sources[file_path]
+            writer = self._writers[file_path]
+            try:
+                data = source() if callable(source) else source
+                snapshots.append((file_path, json.dumps(data) if writer is None else data, writer))
+            except (TypeError, ValueError) as e:
+                print(f"Error saving {file_path}: {e}")
+        self._pending.clear()
+        return snapshots
+
+    async def flush(self):
+        """Write every dirty file now. Safe to call concurrently; writes are serialized."""
+        async with self._lock:
+            self._cancel_timer()
+            if not self._pending:
+                return
+            snapshots = self._take_snapshots()
+            failed = await asyncio.to_thread(_write_snapshots, snapshots)
+            for file_path in failed:
+                self.mark_dirty(file_path, self._sources[file_path], self._writers[file_path])
+
+    def flush_sync(self):
+        """Blocking flush for shutdown, when the event loop is already gone."""
+        self._cancel_timer()
+        if self._pending:
+            _write_snapshots(self._take_snapshots())
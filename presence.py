@@ -0,0 +1,140 @@
+import asyncio
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+import discord
+
+from metrics import metrics
+
+PresenceMatch = namedtuple("PresenceMatch", ["game_active", "zone", "vehicle", "authorized"])
+
+IN_VEHICLE_MARKER = "bên trong xe"
+
+
+def activity_key(activity):
+    """(name, state, details) of a Rich Presence activity; discord.Game has no state/details."""
+    return (activity.name, getattr(activity, "state", None), getattr(activity, "details", None))
+
+
+def activity_fingerprint(activities):
+    return tuple(activity_key(activity) for activity in activities
+                 if isinstance(activity, (discord.Game, discord.Activity)))
+
+
+class PresenceMatcher:
+    """Parse FiveM Rich Presence into a PresenceMatch.
+
+    Game keywords are compiled into one regex and zone names are looked up
+    in the ZoneIndex trie in one pass; the result for every (name, state,
+    details) tuple is kept in a bounded LRU, since most presence payloads
+    repeat. PresenceMatch.zone is the key of the matched zone.
+    """
+
+    def __init__(self, game_keywords, zone_index, cache_size=4096):
+        self.game_re = re.compile("|".join(re.escape(keyword) for keyword in game_keywords))
+        self.zone_index = zone_index
+        self.match_activity = lru_cache(maxsize=cache_size)(self._match_activity)
+
+    def _match_activity(self, name, state, details):
+        game_active = self.game_re.search(str(name).lower()) is not None
+        activity_text = f"{name} {state or ''} {details or ''}"
+        zone = self.zone_index.find(activity_text)
+        if zone is None:
+            return PresenceMatch(game_active, None, None, False)
+        if IN_VEHICLE_MARKER not in activity_text:
+            if zone.require_vehicle:
+                return PresenceMatch(game_active, None, None, False)
+            return PresenceMatch(game_active, zone.key, None, True)
+        vehicle_part = activity_text.rsplit(IN_VEHICLE_MARKER, 1)[-1].strip()
+        vehicle = vehicle_part.split(" tại ")[0].split(" vào ")[0].strip() or "CARNOTFOUND"
+        return PresenceMatch(game_active, zone.key, vehicle, zone.is_authorized(vehicle))
+
+    def match(self, activities):
+        """Combine the per-activity results: game_active if any activity is the game, zone/vehicle from the first in a zone."""
+        game_active = False
+        zone_result = None
+        for activity in activities:
+            if not isinstance(activity, (discord.Game, discord.Activity)):
+                continue
+            result = self.match_activity(*activity_key(activity))
+            game_active = game_active or result.game_active
+            if zone_result is None and result.zone:
+                zone_result = result
+        if zone_result is None:
+            return PresenceMatch(game_active, None, None, False)
+        return zone_result._replace(game_active=game_active)
+
+
+class PresenceGate:
+    """Front stage of on_presence_update: drops duplicates and collapses bursts per user.
+
+    A member who shares several guilds with the bot produces one identical
+    update per guild; copies whose (offline, activity fingerprint) equals the
+    user's last seen state are dropped. Other updates are held for `window`
+    seconds and only the latest is handed to `handler(before, after, presence)`,
+    with the `before` of the first update of the burst. An update that goes
+    offline, comes back, or changes zone (PresenceMatch.zone) is handed over at
+    once, so the handler sees every such transition in order.
+    """
+
+    def __init__(self, matcher, handler, window=2.0):
+        self.matcher = matcher
+        self.handler = handler
+        self.window = window
+        # user_id -> (offline, fingerprint) của bản cập nhật gần nhất đã nhận
+        self._last_seen = {}
+        # user_id -> (offline, zone) của bản cập nhật gần nhất đã chuyển cho handler
+        self._delivered = {}
+        self._pending = {}
+        self._timers = {}
+
+    async def submit(self, before, after):
+        user_id = after.id
+        offline = after.status == discord.Status.offline
+        seen = (offline, activity_fingerprint(after.activities))
+        if self._last_seen.get(user_id) == seen:
+            metrics.inc("presence_updates_total", outcome="duplicate")
+            return
+        self._last_seen[user_id] = seen
+        pending = self._pending.pop(user_id, None)
+        if pending:
+            before = pending[0]
+            metrics.inc("presence_updates_total", outcome="coalesced")
+        presence = self.matcher.match(after.activities)
+        if self.window <= 0 or self._delivered.get(user_id) != (offline, presence.zone):
+            timer = self._timers.pop(user_id, None)
+            if timer:
+                timer.cancel()
+            await self._deliver(user_id, before, after, presence)
+            return
+        self._pending[user_id] = (before, after, presence)
+        if user_id not in self._timers:
+            self._timers[user_id] = asyncio.get_running_loop().create_task(self._deliver_later(user_id))
+
+    def pending(self):
+        return len(self._pending)
+
+    async def _deliver_later(self, user_id):
+        await asyncio.sleep(self.window)
+        self._timers.pop(user_id, None)
+        pending = self._pending.pop(user_id, None)
+        if pending:
+            await self._deliver(user_id, *pending)
+
+    async def _deliver(self, user_id, before, after, presence):
+        self._delivered[user_id] = (after.status == discord.Status.offline, presence.zone)
+        metrics.inc("presence_updates_total", outcome="delivered")
+        try:
+            await self.handler(before, after, presence)
+        except Exception as e:
+            print(f"Lỗi khi xử lý presence của {user_id}: {e}")
+
+    async def flush(self):
+        """Hand every held update to the handler now."""
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        pending, self._pending = self._pending, {}
+        for user_id, item in pending.items():
+            await self._deliver(user_id, *item)
@@ -0,0 +1,81 @@
+from collections import OrderedDict
+
+from metrics import metrics
+
+
+class Generations:
+    """Mutation counters per state domain (e.g. roster, sessions, zones, playtime).
+
+    Every code path that changes a domain calls bump(); a cached result
+    stores the counters of the domains it read and is stale as soon as one
+    of them has moved.
+    """
+
+    def __init__(self, *domains):
+        self.counters = dict.fromkeys(domains, 0)
+
+    def bump(self, *domains):
+        for domain in domains:
+            self.counters[domain] += 1
+
+    def snapshot(self, domains):
+        return tuple(self.counters[domain] for domain in domains)
+
+
+class QueryCache:
+    """Results of admin queries keyed by (command, arguments), tagged with the generations they were built at.
+
+    Cached values are the data behind a report (names, start times, visit
+    lists), not the rendered text, so callers still compute time-relative
+    fields such as "on duty for 1h 20m" on every call. Least recently used
+    entries are evicted past max_entries.
+    """
+
+    def __init__(self, generations, max_entries=256):
+        self.generations = generations
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, key, tag):
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == tag:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            metrics.inc("query_cache_total", outcome="hit")
+            return True, entry[1]
+        self.misses += 1
+        metrics.inc("query_cache_total", outcome="miss")
+        return False, None
+
+    def _store(self, key, tag, value):
+        self._entries[key] = (tag, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, key, domains, build):
+        """The cached value for key if none of domains changed since it was built, else build() (and cache it)."""
+        tag = self.generations.snapshot(domains)
+        found, value = self._lookup(key, tag)
+        if not found:
+            value = build()
+            self._store(key, tag, value)
+        return value
+
+    async def get_async(self, key, domains, build):
+        """Same as get for a coroutine function build.
+
+        The tag is taken before awaiting build(), so a mutation that lands
+        while it runs makes the stored entry stale instead of hiding it.
+        """
+        tag = self.generations.snapshot(domains)
+        found, value = self._lookup(key, tag)
+        if not found:
+            value = await build()
+            self._store(key, tag, value)
+        return value
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,81 @@
+from datetime import datetime
+
+# Khu vực của dữ liệu cũ (trước khi có nhiều khu vực): lượt vào và sự kiện không có "zone" thuộc về Vinewood
+LEGACY_ZONE_KEY = "vinewood"
+
+
+def to_epoch(time_str):
+    """ISO timestamp (as stored in JSON, SQLite and the event log) -> int epoch seconds."""
+    return int(datetime.fromisoformat(time_str).timestamp()) if time_str else None
+
+
+def to_iso(epoch, tz):
+    return datetime.fromtimestamp(epoch, tz).isoformat() if epoch is not None else None
+
+
+class ActivityState:
+    """Per-user zone tracking state; timestamps are epoch seconds. zone is the key of the zone the user is in, or None."""
+
+    __slots__ = ("zone", "zone_start", "last_notified", "duty_credited_until")
+
+    def __init__(self, zone=None, zone_start=None, last_notified=None, duty_credited_until=None):
+        self.zone = zone
+        self.zone_start = zone_start
+        self.last_notified = last_notified
+        self.duty_credited_until = duty_credited_until
+
+    def to_json(self, tz):
+        data = {
+            "zone": self.zone,
+            "zone_start_time": to_iso(self.zone_start, tz),
+            "last_notified": to_iso(self.last_notified, tz),
+        }
+        if self.duty_credited_until is not None:
+            data["duty_credited_until"] = to_iso(self.duty_credited_until, tz)
+        return data
+
+    @classmethod
+    def from_json(cls, data):
+        if "zone" in data:
+            zone, zone_start = data["zone"], data.get("zone_start_time")
+        else:
+            # Định dạng cũ chỉ theo dõi Vinewood
+            zone = LEGACY_ZONE_KEY if data.get("in_vinewood") else None
+            zone_start = data.get("vinewood_start_time")
+        return cls(zone, to_epoch(zone_start), to_epoch(data.get("last_notified")), to_epoch(data.get("duty_credited_until")))
+
+
+class DutySession:
+    """An open on-duty session."""
+
+    __slots__ = ("user_id", "start")
+
+    def __init__(self, user_id, start):
+        self.user_id = user_id
+        self.start = start
+
+
+class ZoneVisit:
+    __slots__ = ("user_id", "start", "end", "vehicle", "unauthorized", "zone")
+
+    def __init__(self, user_id, start, end=None, vehicle=None, unauthorized=False, zone=LEGACY_ZONE_KEY):
+        self.user_id = user_id
+        self.start = start
+        self.end = end
+        self.vehicle = vehicle
+        self.unauthorized = unauthorized
+        self.zone = zone
+
+    def to_json(self, tz):
+        return {
+            "start_time": to_iso(self.start, tz),
+            "vehicle": self.vehicle,
+            "end_time": to_iso(self.end, tz),
+            "unauthorized": self.unauthorized,
+            "zone": self.zone,
+        }
+
+    @classmethod
+    def from_json(cls, user_id, data):
+        return cls(int(user_id), to_epoch(data["start_time"]), to_epoch(data.get("end_time")),
+                   data.get("vehicle", "CARNOTFOUND"), bool(data.get("unauthorized", False)), data.get("zone") or LEGACY_ZONE_KEY)
@@ -0,0 +1,68 @@
+import tempfile
+
+import discord
+
+from outbound import MESSAGE_LIMIT, split_message
+
+# Báo cáo đính kèm được giữ trong RAM tới kích thước này, lớn hơn thì ghi ra file tạm
+ATTACHMENT_SPOOL_SIZE = 1024 * 1024
+
+
+def report_lines(header, body, empty_line):
+    """Header, then the body lines, or empty_line if the body yields nothing."""
+    yield header
+    empty = True
+    for line in body:
+        empty = False
+        yield line
+    if empty:
+        yield empty_line
+
+
+def paginate(lines, limit=MESSAGE_LIMIT):
+    """Pack lines into pages of at most limit characters, yielding each page as soon as it is full."""
+    page = []
+    size = 0
+    for line in lines:
+        for part in split_message(line, limit) if len(line) > limit else [line]:
+            if page and size + 1 + len(part) > limit:
+                yield "\n".join(page)
+                page = []
+                size = 0
+            size += len(part) + (1 if page else 0)
+            page.append(part)
+    if page:
+        yield "\n".join(page)
+
+
+async def send_report(send, lines, max_pages=None, filename="report.txt"):
+    """Stream a report to `send` (e.g. ctx.send) one page at a time.
+
+    Only one page is held in memory. If max_pages is set and the report is
+    longer, the remaining pages are not posted; the full report is attached
+    as a text file after the last page instead.
+    """
+    if max_pages is None:
+        for page in paginate(lines):
+            await send(page)
+        return
+    spool = tempfile.SpooledTemporaryFile(max_size=ATTACHMENT_SPOOL_SIZE)
+
+    def tee(lines):
+        for line in lines:
+            spool.write((line + "\n").encode("utf-8"))
+            yield line
+
+    pages_sent = 0
+    truncated = False
+    with spool:
+        for page in paginate(tee(lines)):
+            if pages_sent < max_pages:
+                await send(page)
+                pages_sent += 1
+            else:
+                truncated = True
+        if truncated:
+            spool.seek(0)
+            await send(f"Báo cáo dài hơn {max_pages} trang, xem đầy đủ trong file đính kèm.",
+                       file=discord.File(spool, filename=filename))
@@ -0,0 +1,118 @@
+import asyncio
+import heapq
+import json
+import os
+from datetime import datetime, time, timedelta
+
+from persistence import write_json_atomic
+
+
+class DailyAt:
+    """Fire every day at hour:minute in tz, or only on the given weekdays (0 = Monday)."""
+
+    def __init__(self, tz, hour, minute=0, weekdays=None):
+        self.tz = tz
+        self.at = time(hour, minute)
+        self.weekdays = set(weekdays) if weekdays is not None else None
+
+    def _at(self, day):
+        return self.tz.localize(datetime.combine(day, self.at))
+
+    def _matches(self, day):
+        return self.weekdays is None or day.weekday() in self.weekdays
+
+    def next_after(self, moment):
+        day = moment.astimezone(self.tz).date()
+        for offset in range(8):
+            candidate_day = day + timedelta(days=offset)
+            if self._matches(candidate_day) and self._at(candidate_day) > moment:
+                return self._at(candidate_day)
+        raise ValueError("DailyAt rule never fires")
+
+    def previous_at_or_before(self, moment):
+        day = moment.astimezone(self.tz).date()
+        for offset in range(8):
+            candidate_day = day - timedelta(days=offset)
+            if self._matches(candidate_day) and self._at(candidate_day) <= moment:
+                return self._at(candidate_day)
+        raise ValueError("DailyAt rule never fires")
+
+
+class Scheduler:
+    """Run timed jobs at their exact due time from a heap of next-fire times.
+
+    The last run of every job is persisted, so after downtime missed runs are
+    caught up (at most `max_catch_up` per job) and a run is never repeated.
+    Callbacks receive the scheduled time of the run they handle.
+    """
+
+    def __init__(self, state_path, max_catch_up=7):
+        self.state_path = state_path
+        self.max_catch_up = max_catch_up
+        self.jobs = {}
+        self.last_runs = self._load_state()
+        self._heap = []
+        self._task = None
+
+    def _load_state(self):
+        if not os.path.exists(self.state_path):
+            return {}
+        try:
+            with open(self.state_path, "r") as f:
+                return {name: datetime.fromisoformat(time_str) for name, time_str in json.load(f).items()}
+        except (json.JSONDecodeError, ValueError):
+            print(f"Error loading {self.state_path}: Invalid JSON. Initializing with default value.")
+            return {}
+
+    async def _save_state(self):
+        data = {name: time.isoformat() for name, time in self.last_runs.items()}
+        await asyncio.to_thread(write_json_atomic, self.state_path, data)
+
+    def add_job(self, name, rule, callback, catch_up=True):
+        self.jobs[name] = (rule, callback, catch_up)
+
+    def _due_runs(self, name, now):
+        """Scheduled times to (re)run now for a job that missed runs while the bot was down."""
+        rule, _, catch_up = self.jobs[name]
+        last_run = self.last_runs.get(name)
+        if last_run is None or not catch_up:
+            return []
+        runs = []
+        moment = rule.previous_at_or_before(now)
+        while moment > last_run and len(runs) < self.max_catch_up:
+            runs.append(moment)
+            moment = rule.previous_at_or_before(moment - timedelta(seconds=1))
+        return sorted(runs)
+
+    def start(self):
+        """Start the scheduler task once; later calls (e.g. on reconnect) are no-ops."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        now = datetime.now().astimezone()
+        for name, (rule, _, _) in self.jobs.items():
+            for scheduled_time in self._due_runs(name, now):
+                heapq.heappush(self._heap, (scheduled_time, name))
+            if name not in self.last_runs:
+                # Lần đầu chạy: không chạy bù, chỉ đánh dấu mốc
+                self.last_runs[name] = now
+            heapq.heappush(self._heap, (rule.next_after(now), name))
+        await self._save_state()
+        while self._heap:
+            scheduled_time, name = self._heap[0]
+            delay = (scheduled_time - datetime.now().astimezone()).total_seconds()
+            if delay > 0:
+                await asyncio.sleep(min(delay, 60))
+                continue
+            heapq.heappop(self._heap)
+            rule, callback, _ = self.jobs[name]
+            if scheduled_time > self.last_runs.get(name, scheduled_time - timedelta(seconds=1)):
+                try:
+                    await callback(scheduled_time)
+                except Exception as e:
+                    print(f"Lỗi khi chạy tác vụ {name}: {e}")
+                self.last_runs[name] = scheduled_time
+                await self._save_state()
+            if not any(queued_name == name for _, queued_name in self._heap):
+                heapq.heappush(self._heap, (rule.next_after(scheduled_time), name))
@@ -0,0 +1,368 @@
+import json
+import sqlite3
+import threading
+from datetime import datetime
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    start_time TEXT NOT NULL,
+    end_time TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_user_start ON sessions (user_id, start_time);
+CREATE INDEX IF NOT EXISTS idx_sessions_open ON sessions (user_id) WHERE end_time IS NULL;
+
+CREATE TABLE IF NOT EXISTS duty_intervals (
+    user_id INTEGER NOT NULL,
+    start_time TEXT NOT NULL,
+    end_time TEXT NOT NULL,
+    PRIMARY KEY (user_id, start_time)
+);
+CREATE INDEX IF NOT EXISTS idx_duty_intervals_start ON duty_intervals (start_time);
+
+CREATE TABLE IF NOT EXISTS daily_online (
+    user_id INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    minutes REAL NOT NULL,
+    PRIMARY KEY (user_id, date)
+);
+CREATE INDEX IF NOT EXISTS idx_daily_online_date ON daily_online (date);
+
+CREATE TABLE IF NOT EXISTS vinewood_visits (
+    user_id INTEGER NOT NULL,
+    start_time TEXT NOT NULL,
+    end_time TEXT,
+    vehicle TEXT,
+    unauthorized INTEGER NOT NULL DEFAULT 0,
+    zone TEXT NOT NULL DEFAULT 'vinewood'
+);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_visits_user_start ON vinewood_visits (user_id, start_time);
+CREATE INDEX IF NOT EXISTS idx_visits_start ON vinewood_visits (start_time);
+
+CREATE TABLE IF NOT EXISTS activity (
+    user_id INTEGER PRIMARY KEY,
+    state TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS members (
+    user_id INTEGER PRIMARY KEY,
+    guild_id TEXT NOT NULL,
+    display_name TEXT
+);
+"""
+
+
+class SqliteStorage:
+    """SQLite backend for playtime, online sessions, duty intervals, zone visits, activity state and the member mapping.
+
+    Writes are queued as SQL statements on the event loop and applied in one
+    transaction by the write-behind store's worker thread. Reads go through
+    `query`, which callers run with `asyncio.to_thread` after a flush.
+
+    The database is opened in WAL mode so several shard processes can share
+    it: each process only writes rows for the users it owns, and readers see
+    every process's committed writes.
+    """
+
+    def __init__(self, path, busy_timeout=5.0):
+        self.path = path
+        self._conn = sqlite3.connect(path, timeout=busy_timeout, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._migrate()
+        self._conn.executescript(SCHEMA)
+        self._db_lock = threading.Lock()
+        self._ops = []
+        # Bản đã ghi gần nhất, dùng để chỉ ghi những dòng thay đổi
+        self._open_sessions = {}
+        self._activity_rows = {}
+        self._members = {}
+
+    def _migrate(self):
+        """Bring tables created by older versions up to SCHEMA."""
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(vinewood_visits)")}
+        if columns and "zone" not in columns:
+            # Các lượt cũ đều là Vinewood
+            self._conn.execute("ALTER TABLE vinewood_visits ADD COLUMN zone TEXT NOT NULL DEFAULT 'vinewood'")
+            self._conn.commit()
+
+    # --- Ghi ---
+
+    def take_ops(self):
+        ops, self._ops = self._ops, []
+        return ops
+
+    def write_ops(self, ops):
+        if not ops:
+            return
+        with self._db_lock:
+            try:
+                with self._conn:
+                    for sql, params in ops:
+                        self._conn.execute(sql, params)
+            except Exception:
+                self._ops[:0] = ops
+                raise
+
+    def queue_daily_online(self, user_id, date_str, minutes):
+        self._ops.append((
+            "INSERT INTO daily_online (user_id, date, minutes) VALUES (?, ?, ?) "
+            "ON CONFLICT (user_id, date) DO UPDATE SET minutes = excluded.minutes",
+            (int(user_id), date_str, minutes),
+        ))
+
+    def queue_duty_intervals(self, intervals):
+        """Insert the (user_id, start ISO, end ISO) intervals credited since the last write."""
+        for user_id, start_time, end_time in intervals:
+            self._ops.append((
+                "INSERT OR IGNORE INTO duty_intervals (user_id, start_time, end_time) VALUES (?, ?, ?)",
+                (int(user_id), start_time, end_time),
+            ))
+
+    def queue_online_times(self, online_times, now, user_ids=None):
+        """Diff {user_id: ISO start time} against the last write and queue session starts/ends.
+
+        Only user_ids are compared (every user if None); a user id missing
+        from online_times has no open session.
+        """
+        if user_ids is None:
+            user_ids = set(self._open_sessions) | set(online_times)
+        for user_id in user_ids:
+            start_time = online_times.get(user_id)
+            if self._open_sessions.get(user_id) == start_time:
+                continue
+            if user_id in self._open_sessions:
+                self._ops.append((
+                    "UPDATE sessions SET end_time = ? WHERE user_id = ? AND end_time IS NULL",
+                    (now.isoformat(), int(user_id)),
+                ))
+                del self._open_sessions[user_id]
+            if start_time is not None:
+                self._ops.append((
+                    "INSERT INTO sessions (user_id, start_time) VALUES (?, ?)",
+                    (int(user_id), start_time),
+                ))
+                self._open_sessions[user_id] = start_time
+
+    def queue_activity(self, activity_data):
+        """Upsert the rows of {user_id: state} that differ from the last write; callers pass only the users that changed."""
+        for user_id, state in activity_data.items():
+            row = json.dumps(state)
+            if self._activity_rows.get(user_id) != row:
+                self._ops.append((
+                    "INSERT INTO activity (user_id, state) VALUES (?, ?) "
+                    "ON CONFLICT (user_id) DO UPDATE SET state = excluded.state",
+                    (int(user_id), row),
+                ))
+                self._activity_rows[user_id] = row
+
+    def queue_vinewood_visits(self, changed_visits):
+        """Upsert the (user_id, visit) pairs opened or closed since the last write."""
+        for user_id, visit in changed_visits:
+            self._queue_visit(user_id, visit)
+
+    def queue_user_mapping(self, user_mapping, display_names, user_ids=None):
+        """Diff {user_id: {"guild_id": ...}} and {user_id: display_name} against the last write, for user_ids (every user if None).
+
+        A stored row keeps its guild: it is only updated, or deleted, while
+        it still names the guild this writer has for the user, so a process
+        never takes over or drops a user another process registered.
+        """
+        if user_ids is None:
+            user_ids = set(self._members) | set(user_mapping)
+        for user_id in user_ids:
+            user_info = user_mapping.get(user_id)
+            if user_info is None:
+                if user_id in self._members:
+                    self._ops.append(("DELETE FROM members WHERE user_id = ? AND guild_id = ?", (int(user_id), self._members[user_id][0])))
+                    del self._members[user_id]
+                continue
+            row = (user_info["guild_id"], display_names.get(user_id, self._members.get(user_id, (None, None))[1]))
+            if self._members.get(user_id) != row:
+                self._ops.append((
+                    "INSERT INTO members (user_id, guild_id, display_name) VALUES (?, ?, ?) "
+                    "ON CONFLICT (user_id) DO UPDATE SET display_name = excluded.display_name WHERE members.guild_id = excluded.guild_id",
+                    (int(user_id), *row),
+                ))
+                self._members[user_id] = row
+
+    def _queue_visit(self, user_id, visit):
+        self._ops.append((
+            "INSERT INTO vinewood_visits (user_id, start_time, end_time, vehicle, unauthorized, zone) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (user_id, start_time) DO UPDATE SET end_time = excluded.end_time",
+            (int(user_id), visit["start_time"], visit.get("end_time"), visit.get("vehicle"), int(bool(visit.get("unauthorized"))),
+             visit.get("zone") or "vinewood"),
+        ))
+
+    # --- Đọc ---
+
+    def query(self, sql, params=()):
+        with self._db_lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def iter_query(self, sql, params=(), batch_size=1000):
+        """Yield rows batch by batch from a separate read-only connection (blocking; run in a worker thread).
+
+        A long export neither holds the write lock nor keeps every row in memory;
+        in WAL mode it reads a consistent snapshot while the bot keeps writing.
+        """
+        conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        try:
+            cursor = conn.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    return
+                yield from rows
+        finally:
+            conn.close()
+
+    def load_playtime(self):
+        data = {}
+        for user_id, date_str, minutes in self.query("SELECT user_id, date, minutes FROM daily_online ORDER BY user_id, date"):
+            data.setdefault(str(user_id), {"daily_online": {}})["daily_online"][date_str] = minutes
+        return data
+
+    def load_duty_intervals(self):
+        data = {}
+        for user_id, start_time, end_time in self.query("SELECT user_id, start_time, end_time FROM duty_intervals ORDER BY user_id, start_time"):
+            data.setdefault(str(user_id), []).append([start_time, end_time])
+        return data
+
+    def load_online_times(self):
+        rows = self.query("SELECT user_id, start_time FROM sessions WHERE end_time IS NULL")
+        return {str(user_id): start_time for user_id, start_time in rows}
+
+    def remember_online_times(self, online_times):
+        self._open_sessions = dict(online_times)
+
+    def load_user_mapping(self, owns_guild=None):
+        """{user_id: {"guild_id": ...}} for the members whose guild passes owns_guild (all if None)."""
+        data = {}
+        for user_id, guild_id, display_name in self.query("SELECT user_id, guild_id, display_name FROM members"):
+            if owns_guild is None or owns_guild(guild_id):
+                data[str(user_id)] = {"guild_id": guild_id}
+                self._members[str(user_id)] = (guild_id, display_name)
+        return data
+
+    def member_guilds(self):
+        """{user_id: guild_id} of every member, whichever process owns them."""
+        return {str(user_id): guild_id for user_id, guild_id in self.query("SELECT user_id, guild_id FROM members")}
+
+    def claim_members(self, rows):
+        """Insert (user_id, guild_id, display_name) rows for users not stored yet and return {user_id: stored guild_id}.
+
+        Written at once, not queued, so two processes registering the same
+        user agree on its guild: the first insert wins (blocking; run in a
+        worker thread).
+        """
+        with self._db_lock:
+            with self._conn:
+                self._conn.executemany("INSERT INTO members (user_id, guild_id, display_name) VALUES (?, ?, ?) "
+                                       "ON CONFLICT (user_id) DO NOTHING", rows)
+            return {str(user_id): self._conn.execute("SELECT guild_id FROM members WHERE user_id = ?", (user_id,)).fetchone()[0]
+                    for user_id, _, _ in rows}
+
+    def member_names(self):
+        """{user_id: display_name} of every member, whichever process owns them."""
+        return {str(user_id): display_name or str(user_id)
+                for user_id, display_name in self.query("SELECT user_id, display_name FROM members ORDER BY user_id")}
+
+    def load_activity(self):
+        data = {}
+        for user_id, row in self.query("SELECT user_id, state FROM activity"):
+            data[str(user_id)] = json.loads(row)
+            self._activity_rows[str(user_id)] = row
+        return data
+
+    def load_open_vinewood_visits(self):
+        """Only open visits are kept in memory; closed history is read with range queries."""
+        data = {}
+        for user_id, start_time, vehicle, unauthorized, zone in self.query(
+                "SELECT user_id, start_time, vehicle, unauthorized, zone FROM vinewood_visits WHERE end_time IS NULL ORDER BY start_time"):
+            # Thời điểm trong bộ nhớ được làm tròn tới giây: chuẩn hoá dòng cũ để lần đóng lượt sau khớp khoá
+            whole_seconds = datetime.fromisoformat(start_time).replace(microsecond=0).isoformat()
+            if whole_seconds != start_time:
+                self.write_ops([("UPDATE vinewood_visits SET start_time = ? WHERE user_id = ? AND start_time = ?",
+                                 (whole_seconds, user_id, start_time))])
+                start_time = whole_seconds
+            data.setdefault(str(user_id), {"visits": []})["visits"].append(
+                {"start_time": start_time, "vehicle": vehicle, "end_time": None, "unauthorized": bool(unauthorized), "zone": zone})
+        return data
+
+    def daily_online_on(self, date_str):
+        return self.query("SELECT user_id, minutes FROM daily_online WHERE date = ?", (date_str,))
+
+    def daily_online_between(self, start_date_str, end_date_str, user_id=None):
+        if user_id is None:
+            return self.query(
+                "SELECT user_id, date, minutes FROM daily_online WHERE date BETWEEN ? AND ? ORDER BY user_id, date",
+                (start_date_str, end_date_str))
+        return self.query(
+            "SELECT user_id, date, minutes FROM daily_online WHERE user_id = ? AND date BETWEEN ? AND ? ORDER BY date",
+            (int(user_id), start_date_str, end_date_str))
+
+    def playtime_total(self, user_id):
+        """Sum of the user's daily_online minutes, or None if they have no row."""
+        return self.query("SELECT SUM(minutes) FROM daily_online WHERE user_id = ?", (int(user_id),))[0][0]
+
+    def duty_intervals_between(self, start_iso, end_iso):
+        return self.query("SELECT user_id, start_time, end_time FROM duty_intervals WHERE start_time < ? AND end_time > ?",
+                          (end_iso, start_iso))
+
+    def on_duty_at(self, moment_iso):
+        """User ids with a credited interval or an open session covering the moment, across every process."""
+        rows = self.query(
+            "SELECT user_id FROM duty_intervals WHERE start_time <= ? AND end_time > ? "
+            "UNION SELECT user_id FROM sessions WHERE end_time IS NULL AND start_time <= ?",
+            (moment_iso, moment_iso, moment_iso))
+        return {str(user_id) for user_id, in rows}
+
+    def zone_visits_between(self, start_iso, end_iso):
+        rows = self.query(
+            "SELECT user_id, start_time, end_time, vehicle, unauthorized, zone FROM vinewood_visits "
+            "WHERE start_time >= ? AND start_time < ? ORDER BY start_time", (start_iso, end_iso))
+        return [(user_id, {"start_time": start_time, "end_time": end_time, "vehicle": vehicle, "unauthorized": bool(unauthorized), "zone": zone})
+                for user_id, start_time, end_time, vehicle, unauthorized, zone in rows]
+
+    # --- Chuyển dữ liệu ---
+
+    def import_json(self, playtime=None, online_times=None, activity=None, vinewood=None, user_mapping=None, duty_intervals=None):
+        """One-shot import of the JSON state files (already parsed). Returns row counts.
+
+        vinewood may use the per-day {"days": {day: {user_id: [visit, ...]}}} layout or the legacy per-user one.
+        """
+        counts = {"daily_online": 0, "sessions": 0, "activity": 0, "vinewood_visits": 0, "members": 0, "duty_intervals": 0}
+        for user_id, user_data in (playtime or {}).items():
+            for date_str, minutes in user_data.get("daily_online", {}).items():
+                self.queue_daily_online(user_id, date_str, minutes)
+                counts["daily_online"] += 1
+        for user_id, pairs in (duty_intervals or {}).items():
+            self.queue_duty_intervals((user_id, start_time, end_time) for start_time, end_time in pairs)
+            counts["duty_intervals"] += len(pairs)
+        for user_id, start_time in (online_times or {}).items():
+            self._ops.append(("DELETE FROM sessions WHERE user_id = ? AND end_time IS NULL", (int(user_id),)))
+            self._ops.append(("INSERT INTO sessions (user_id, start_time) VALUES (?, ?)", (int(user_id), start_time)))
+            counts["sessions"] += 1
+        self.queue_activity(activity or {})
+        counts["activity"] = len(activity or {})
+        vinewood = vinewood or {}
+        if "days" in vinewood:
+            user_visits = [(user_id, visits) for users in vinewood["days"].values() for user_id, visits in users.items()]
+        else:
+            user_visits = [(user_id, user_data.get("visits", [])) for user_id, user_data in vinewood.items()]
+        for user_id, visits in user_visits:
+            for visit in visits:
+                self._queue_visit(user_id, visit)
+                counts["vinewood_visits"] += 1
+        user_mapping = {user_id: user_info for user_id, user_info in (user_mapping or {}).items()
+                        if isinstance(user_info, dict) and "guild_id" in user_info}
+        self.queue_user_mapping(user_mapping, {})
+        counts["members"] = len(user_mapping)
+        self.write_ops(self.take_ops())
+        return counts
+
+    def close(self):
+        with self._db_lock:
+            self._conn.close()
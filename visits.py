@@ -0,0 +1,142 @@
+import gzip
+import json
+import os
+from datetime import datetime
+
+from records import ZoneVisit
+
+
+class VisitIndex:
+    """ZoneVisit records partitioned by day (local date of the start), then by user id.
+
+    Each user's open visit is also kept by reference, so closing it is O(1)
+    and a day's report reads one partition instead of every visit ever
+    recorded. Partitions past the retention window are moved to gzip files
+    in archive_dir (one per day) and read back on demand.
+    """
+
+    def __init__(self, tz, archive_dir=None):
+        self.tz = tz
+        self.archive_dir = archive_dir
+        self.days = {}
+        self.open_visits = {}
+        self._dirty = []
+
+    def day_of(self, epoch):
+        return datetime.fromtimestamp(epoch, self.tz).date().isoformat()
+
+    def add(self, visit):
+        """Insert a visit (open if it has no end). Re-adding the same start time is a no-op."""
+        user_id = str(visit.user_id)
+        visits = self.days.setdefault(self.day_of(visit.start), {}).setdefault(user_id, [])
+        if visits and visits[-1].start == visit.start:
+            return False
+        visits.append(visit)
+        if visit.end is None:
+            self.open_visits[user_id] = visit
+        self._dirty.append(visit)
+        return True
+
+    def close(self, user_id, end):
+        visit = self.open_visits.pop(user_id, None)
+        if visit is None:
+            return False
+        visit.end = end
+        self._dirty.append(visit)
+        return True
+
+    def mark_all_dirty(self):
+        """Queue every visit again (after rebuilding from a snapshot); backends upsert by start time."""
+        self._dirty = [visit for users in self.days.values() for visits in users.values() for visit in visits]
+
+    def take_dirty(self):
+        """Visits added or closed since the last call, for incremental backends."""
+        dirty, self._dirty = self._dirty, []
+        return dirty
+
+    def visits_on(self, day_str):
+        """{user_id: [visit, ...]} held in memory for the day; see read_archive for archived days."""
+        return self.days.get(day_str, {})
+
+    def zones_on(self, day_str):
+        """Keys of the zones with a visit in the day's partition."""
+        return {visit.zone for visits in self.days.get(day_str, {}).values() for visit in visits}
+
+    def is_archived(self, day_str):
+        return self.archive_dir is not None and os.path.exists(self._archive_path(day_str))
+
+    # --- Lưu trữ ---
+
+    def to_json(self):
+        return {"days": {day_str: self._partition_to_json(users) for day_str, users in self.days.items()}}
+
+    def _partition_to_json(self, users):
+        return {user_id: [visit.to_json(self.tz) for visit in visits] for user_id, visits in users.items()}
+
+    @staticmethod
+    def _partition_from_json(users):
+        return {user_id: [ZoneVisit.from_json(user_id, visit) for visit in visits] for user_id, visits in users.items()}
+
+    @classmethod
+    def from_json(cls, data, tz, archive_dir=None):
+        """Build from {"days": ...}, or from the legacy {user_id: {"visits": [...]}} layout."""
+        index = cls(tz, archive_dir)
+        if "days" in data:
+            for day_str, users in data["days"].items():
+                index.days[day_str] = cls._partition_from_json(users)
+                for user_id, visits in index.days[day_str].items():
+                    for visit in visits:
+                        if visit.end is None:
+                            index.open_visits[user_id] = visit
+        else:
+            for user_id, user_data in data.items():
+                for visit in user_data.get("visits", []):
+                    index.add(ZoneVisit.from_json(user_id, visit))
+            index.take_dirty()
+        return index
+
+    # --- Lưu trữ dài hạn ---
+
+    def _archive_path(self, day_str):
+        return os.path.join(self.archive_dir, f"{day_str}.json.gz")
+
+    def expired_days(self, cutoff_day_str):
+        """Days before cutoff with no open visit, oldest first."""
+        open_days = {self.day_of(visit.start) for visit in self.open_visits.values()}
+        return sorted(day_str for day_str in self.days if day_str < cutoff_day_str and day_str not in open_days)
+
+    def write_archive(self, day_str):
+        """Write one closed partition to its gzip file (blocking; run in a worker thread)."""
+        os.makedirs(self.archive_dir, exist_ok=True)
+        path = self._archive_path(day_str)
+        partition = self._partition_to_json(self.days[day_str])
+        if os.path.exists(path):
+            partition = self._merge(self._read_archive_file(path), partition)
+        with gzip.open(path + ".tmp", "wt", encoding="utf-8") as f:
+            json.dump(partition, f)
+        os.replace(path + ".tmp", path)
+
+    def drop(self, day_str):
+        self.days.pop(day_str, None)
+
+    def read_archive(self, day_str):
+        """{user_id: [visit, ...]} from the day's archive file, or {} (blocking; run in a worker thread)."""
+        if not self.is_archived(day_str):
+            return {}
+        return self._partition_from_json(self._read_archive_file(self._archive_path(day_str)))
+
+    def _read_archive_file(self, path):
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"Error loading {path}: {e}")
+            return {}
+
+    @staticmethod
+    def _merge(archived, partition):
+        merged = {user_id: list(visits) for user_id, visits in archived.items()}
+        for user_id, visits in partition.items():
+            known = {visit["start_time"] for visit in merged.get(user_id, [])}
+            merged.setdefault(user_id, []).extend(visit for visit in visits if visit["start_time"] not in known)
+        return merged
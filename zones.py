@@ -0,0 +1,100 @@
+import json
+import os
+
+from records import LEGACY_ZONE_KEY
+
+
+class Zone:
+    """A watched location: the name matched in Rich Presence, its alert channel, vehicle policy and retention."""
+
+    __slots__ = ("key", "name", "channel_id", "require_vehicle", "authorized_vehicles", "retention_days", "notify_cooldown")
+
+    def __init__(self, key, name, channel_id, require_vehicle=True, authorized_vehicles=(), retention_days=30, notify_cooldown=300):
+        self.key = key
+        self.name = name
+        self.channel_id = channel_id
+        self.require_vehicle = require_vehicle
+        self.authorized_vehicles = frozenset(authorized_vehicles)
+        self.retention_days = retention_days
+        self.notify_cooldown = notify_cooldown
+
+    def is_authorized(self, vehicle):
+        """An empty authorized_vehicles list allows every vehicle."""
+        return not self.authorized_vehicles or vehicle in self.authorized_vehicles
+
+    @classmethod
+    def from_json(cls, data, defaults):
+        """Build from one zones.json entry; missing fields fall back to defaults (a dict of the same keys)."""
+        fields = dict(defaults)
+        fields.update(data)
+        return cls(fields["key"], fields["name"], int(fields["channel_id"]), bool(fields.get("require_vehicle", True)),
+                   fields.get("authorized_vehicles") or (), int(fields.get("retention_days", 30)),
+                   int(fields.get("notify_cooldown", 300)))
+
+
+class ZoneIndex:
+    """Zones by key, plus a character trie over their lower-cased names.
+
+    find() scans the presence text once from left to right and walks the
+    trie from each position, so the cost depends on the text and the longest
+    zone name, not on how many zones are configured.
+    """
+
+    def __init__(self, zones):
+        self.zones = {}
+        self._trie = {}
+        for zone in zones:
+            if zone.key in self.zones:
+                raise ValueError(f"Khu vực bị trùng key: {zone.key}")
+            self.zones[zone.key] = zone
+            node = self._trie
+            for char in zone.name.lower():
+                node = node.setdefault(char, {})
+            # Khóa None đánh dấu cuối một tên khu vực
+            node[None] = zone
+
+    def find(self, text):
+        """The zone whose name appears first in text (the longest one if several start there), or None."""
+        text = text.lower()
+        for start in range(len(text)):
+            node = self._trie.get(text[start])
+            found = None
+            position = start + 1
+            while node is not None:
+                found = node.get(None, found)
+                if position == len(text):
+                    break
+                node = node.get(text[position])
+                position += 1
+            if found is not None:
+                return found
+        return None
+
+    def get(self, key):
+        return self.zones.get(key)
+
+    def name_of(self, key):
+        """Display name of a zone key, or the key itself if the zone is no longer configured."""
+        zone = self.zones.get(key)
+        return zone.name if zone else key
+
+    def max_retention_days(self, keys):
+        return max((self.zones[key].retention_days for key in keys if key in self.zones), default=0)
+
+    def __iter__(self):
+        return iter(self.zones.values())
+
+    def __len__(self):
+        return len(self.zones)
+
+
+def load_zones(path, defaults, fallback):
+    """Zones from the JSON list in path, or [fallback] (the built-in Vinewood zone) if the file does not exist."""
+    if not os.path.exists(path):
+        return ZoneIndex([Zone.from_json(fallback, defaults)])
+    with open(path, "r", encoding="utf-8") as f:
+        entries = json.load(f)
+    zones = [Zone.from_json(entry, defaults) for entry in entries]
+    if LEGACY_ZONE_KEY not in {zone.key for zone in zones}:
+        print(f"{path} không có khu vực '{LEGACY_ZONE_KEY}': lịch sử Vinewood cũ sẽ hiển thị theo key.")
+    return ZoneIndex(zones)